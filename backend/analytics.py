@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Серверная аналитика трендов веса и калорий на NumPy.
+Ряды пользователей раскладываются в матрицу «пользователь x календарный день» (пропуски — NaN),
+и все показатели считаются векторно сразу для всех строк: один пользователь для API
+и тысячи пользователей для ночных пакетных расчетов обрабатываются одним и тем же кодом.
+"""
+
+import numpy as np
+
+DEFAULT_WINDOW = 7
+DEFAULT_ALPHA = 0.3
+DEFAULT_TREND_DAYS = 28
+DENSITY_PERCENTILES = (10, 25, 50, 75, 90)
+
+# Сколько пользователей обрабатывается за один проход в пакетном режиме
+BATCH_USERS = 1000
+
+
+class Series:
+    """Показатели группы пользователей в виде матриц (строка — пользователь, столбец — день)"""
+
+    def __init__(self, user_ids, start_dates, weight, kcal, density):
+        self.user_ids = user_ids
+        self.start_dates = start_dates
+        self.weight = weight
+        self.kcal = kcal
+        self.density = density
+
+    @property
+    def logged(self):
+        return ~(np.isnan(self.weight) & np.isnan(self.kcal) & np.isnan(self.density))
+
+
+def _fetch_rows(conn, user_ids=None, stage_id=None, date_from=None, date_to=None):
+    conditions, params = [], []
+    if user_ids is not None:
+        conditions.append(f"user_id IN ({','.join('?' * len(user_ids))})")
+        params += list(user_ids)
+    if stage_id is not None:
+        conditions.append('stage_id = ?')
+        params.append(stage_id)
+    if date_from:
+        conditions.append('entry_date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('entry_date <= ?')
+        params.append(date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return conn.execute(f'''SELECT user_id, entry_date, weight, total_kcal, kcal_density FROM daily_metrics
+                            {where} ORDER BY user_id, entry_date''', params).fetchall()
+
+
+def _as_float(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def build_series(rows):
+    """Раскладывает строки (user_id, entry_date, weight, total_kcal, kcal_density) в матрицы"""
+    if not rows:
+        empty = np.empty((0, 0))
+        return Series(np.empty(0, dtype=np.int64), np.empty(0, dtype='datetime64[D]'), empty, empty, empty)
+    columns = list(zip(*rows))
+    users = np.array(columns[0], dtype=np.int64)
+    days = np.array(columns[1], dtype='datetime64[D]')
+
+    user_ids, row_index = np.unique(users, return_inverse=True)
+    start_dates = np.full(len(user_ids), np.datetime64('9999-12-31'), dtype='datetime64[D]')
+    np.minimum.at(start_dates, row_index, days)
+    # Начало ряда выравниваем на понедельник, чтобы недели считались как календарные
+    # (1970-01-01 — четверг, поэтому день эпохи + 3 дает номер дня недели с понедельника)
+    weekday = (start_dates.astype(np.int64) + 3) % 7
+    start_dates = start_dates - weekday.astype('timedelta64[D]')
+    offsets = (days - start_dates[row_index]).astype(np.int64)
+    n_days = int(offsets.max()) + 1
+
+    def matrix(values):
+        result = np.full((len(user_ids), n_days), np.nan)
+        result[row_index, offsets] = values
+        return result
+
+    return Series(user_ids, start_dates, matrix(_as_float(columns[2])),
+                  matrix(_as_float(columns[3])), matrix(_as_float(columns[4])))
+
+
+def rolling_mean(values, window):
+    """Скользящее среднее за window календарных дней с пропуском NaN"""
+    valid = ~np.isnan(values)
+    pad = np.zeros((values.shape[0], 1))
+    sums = np.hstack([pad, np.cumsum(np.where(valid, values, 0.0), axis=1)])
+    counts = np.hstack([pad, np.cumsum(valid, axis=1)])
+    end = np.arange(values.shape[1]) + 1
+    start = np.maximum(0, end - window)
+    window_sums = sums[:, end] - sums[:, start]
+    window_counts = counts[:, end] - counts[:, start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+
+def exponential_smoothing(values, alpha):
+    """Экспоненциально сглаженный ряд; в дни без замера держится последнее значение"""
+    result = np.full(values.shape, np.nan)
+    state = np.full(values.shape[0], np.nan)
+    for day in range(values.shape[1]):
+        x = values[:, day]
+        state = np.where(np.isnan(x), state, np.where(np.isnan(state), x, alpha * x + (1 - alpha) * state))
+        result[:, day] = state
+    return result
+
+
+def linear_trend(values, trend_days=None):
+    """
+    Линейная регрессия веса по дням для каждой строки.
+    Возвращает (наклон кг/день, значение тренда в последний день с замером,
+    номер последнего дня с замером или -1, число точек).
+    """
+    n_rows, n_days = values.shape
+    x = np.broadcast_to(np.arange(n_days, dtype=np.float64), values.shape)
+    valid = ~np.isnan(values)
+    last_day = np.where(valid.any(axis=1), n_days - 1 - np.argmax(valid[:, ::-1], axis=1), -1)
+    if trend_days:
+        valid &= x > (last_day[:, None] - trend_days)
+    n = valid.sum(axis=1).astype(np.float64)
+    xs = np.where(valid, x, 0.0)
+    ys = np.where(valid, values, 0.0)
+    sx, sy = xs.sum(axis=1), ys.sum(axis=1)
+    sxx, sxy = (xs * xs).sum(axis=1), (xs * ys).sum(axis=1)
+    denominator = n * sxx - sx * sx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where((n >= 2) & (denominator != 0), (n * sxy - sx * sy) / denominator, np.nan)
+        intercept = (sy - slope * sx) / n
+    fitted_last = intercept + slope * last_day
+    return slope, fitted_last, last_day, n.astype(np.int64)
+
+
+def weekly_calories(kcal):
+    """Суммы и средние калорий по календарным неделям: матрицы (пользователь x неделя)"""
+    n_rows, n_days = kcal.shape
+    n_weeks = -(-n_days // 7)
+    padded = np.full((n_rows, n_weeks * 7), np.nan)
+    padded[:, :n_days] = kcal
+    weeks = padded.reshape(n_rows, n_weeks, 7)
+    days = (~np.isnan(weeks)).sum(axis=2)
+    totals = np.nansum(weeks, axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = np.where(days > 0, totals / days, np.nan)
+    return totals, averages, days
+
+
+def density_percentiles(density, percentiles=DENSITY_PERCENTILES):
+    """Перцентили калорийной плотности по каждой строке: матрица (пользователь x перцентиль)"""
+    result = np.full((density.shape[0], len(percentiles)), np.nan)
+    has_values = (~np.isnan(density)).any(axis=1)
+    if has_values.any():
+        result[has_values] = np.nanpercentile(density[has_values], percentiles, axis=1).T
+    return result
+
+
+def _number(value, digits=3):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def _day(start, offset):
+    return str(start + np.timedelta64(int(offset), 'D'))
+
+
+def compute(series, window=DEFAULT_WINDOW, alpha=DEFAULT_ALPHA, trend_days=DEFAULT_TREND_DAYS,
+            goal_weights=None, include_series=True):
+    """
+    Считает тренды для всех строк Series за один векторный проход.
+    goal_weights — словарь {user_id: целевой вес} для прогноза даты достижения цели.
+    Возвращает словарь {user_id: результат}.
+    """
+    results = {}
+    if not len(series.user_ids):
+        return results
+    rolling = rolling_mean(series.weight, window)
+    smoothed = exponential_smoothing(series.weight, alpha)
+    slope, fitted_last, last_day, points = linear_trend(series.weight, trend_days)
+    week_totals, week_averages, week_days = weekly_calories(series.kcal)
+    percentiles = density_percentiles(series.density)
+    logged = series.logged
+    goal_weights = goal_weights or {}
+
+    for row, user_id in enumerate(series.user_ids.tolist()):
+        start = series.start_dates[row]
+        trend = {
+            'slope_per_day': _number(slope[row], 4),
+            'slope_per_week': _number(slope[row] * 7, 3),
+            'current_trend_weight': _number(fitted_last[row]),
+            'points': int(points[row]),
+        }
+        projection = None
+        goal = goal_weights.get(user_id)
+        if goal is not None and last_day[row] >= 0:
+            projection = {'goal_weight': goal, 'goal_date': None, 'days_to_goal': None}
+            gap = goal - fitted_last[row]
+            if gap >= 0:
+                projection['days_to_goal'] = 0
+                projection['goal_date'] = _day(start, last_day[row])
+            elif not np.isnan(slope[row]) and slope[row] < 0:
+                days_to_goal = int(np.ceil(gap / slope[row]))
+                projection['days_to_goal'] = days_to_goal
+                projection['goal_date'] = _day(start, last_day[row] + days_to_goal)
+
+        result = {
+            'latest': {
+                'rolling_weight': _number(rolling[row, last_day[row]]) if last_day[row] >= 0 else None,
+                'smoothed_weight': _number(smoothed[row, last_day[row]]) if last_day[row] >= 0 else None,
+            },
+            'trend': trend,
+            'projection': projection,
+            'weekly_calories': [
+                {'week_start': _day(start, week * 7), 'days': int(week_days[row, week]),
+                 'total_kcal': _number(week_totals[row, week], 1), 'avg_kcal': _number(week_averages[row, week], 1)}
+                for week in np.flatnonzero(week_days[row] > 0)
+            ],
+            'kcal_density_percentiles': {
+                f'p{p}': _number(percentiles[row, i]) for i, p in enumerate(DENSITY_PERCENTILES)
+            },
+        }
+        if include_series:
+            days = np.flatnonzero(logged[row])
+            result['series'] = [
+                {'date': _day(start, day), 'weight': _number(series.weight[row, day]),
+                 'rolling_weight': _number(rolling[row, day]), 'smoothed_weight': _number(smoothed[row, day]),
+                 'total_kcal': _number(series.kcal[row, day], 1)}
+                for day in days
+            ]
+        results[user_id] = result
+    return results
+
+
+def user_trends(conn, user_id, stage_id=None, date_from=None, date_to=None, goal_weight=None, **options):
+    """Тренды одного пользователя (или одного этапа пользователя)"""
+    series = build_series(_fetch_rows(conn, [user_id], stage_id, date_from, date_to))
+    goals = {int(user_id): goal_weight} if goal_weight is not None else None
+    return compute(series, goal_weights=goals, **options).get(int(user_id))
+
+
+def batch_trends(conn, user_ids=None, batch_users=BATCH_USERS, **options):
+    """
+    Тренды многих пользователей для ночных расчетов.
+    Пользователи обрабатываются пачками по batch_users, каждая пачка — один векторный проход.
+    Отдает пары (user_id, результат) по мере расчета.
+    """
+    if user_ids is None:
+        user_ids = [row[0] for row in conn.execute('SELECT DISTINCT user_id FROM daily_metrics ORDER BY user_id')]
+    options.setdefault('include_series', False)
+    for start in range(0, len(user_ids), batch_users):
+        chunk = user_ids[start:start + batch_users]
+        yield from compute(build_series(_fetch_rows(conn, chunk)), **options).items()
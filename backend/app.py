@@ -5,24 +5,156 @@
 Дата: 2025-11-01
 """
 
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import (Flask, Response, abort, request, jsonify, make_response, send_from_directory, render_template,
+                   stream_with_context)
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import ClosingIterator, wrap_file
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import os
+import json
+import functools
+import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 # Импортируем наши модули
-from database import Database
+from sharding import open_database, UnknownUserError
+from cache import ProductCache, SessionCache
 from auth import AuthManager
-from reports import ReportGenerator
+from reports import ReportGenerator, FORMAT_EXTENSIONS as REPORT_FORMATS
+from report_store import ReportStore
+from report_jobs import ReportJobQueue, JobLimitError
+from nutrition_ref import open_reference
+import analytics
+import bulk
+import changelog
+import metrics
+import search
 
 # Инициализация Flask приложения
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)  # Разрешаем кросс-доменные запросы
 
 # Инициализация компонентов
-db = Database()
-auth_manager = AuthManager(db)
-report_generator = ReportGenerator(db)
+db = open_database(
+    # С DB_SHARD_DIR пользователи раскладываются по файлам-шардам (DB_SHARD_BUCKETS=0 — шард на пользователя)
+    shard_dir=os.environ.get('DB_SHARD_DIR') or None,
+    shard_buckets=int(os.environ.get('DB_SHARD_BUCKETS', 16)) or None,
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 8)),
+    product_cache=ProductCache(
+        max_users=int(os.environ.get('PRODUCT_CACHE_USERS', 1000)),
+        max_bytes=int(os.environ.get('PRODUCT_CACHE_MB', 64)) * 1024 * 1024,
+    ),
+    # Записи собираются в пачки не дольше этой задержки и фиксируются одной транзакцией
+    write_batch_delay=float(os.environ.get('DB_WRITE_BATCH_DELAY_MS', 2)) / 1000,
+    # Снимок базы для трендов и отчетов за период, обновляется раз в DB_REPLICA_INTERVAL секунд
+    replica_path=os.environ.get('DB_REPLICA_PATH') or None,
+    replica_interval=float(os.environ.get('DB_REPLICA_INTERVAL', 60)),
+    # server.py с несколькими воркерами: в базу пишут несколько процессов
+    shared=int(os.environ.get('SERVER_WORKERS', 1)) > 1,
+)
+atexit.register(db.close)
+auth_manager = AuthManager(db, session_cache=SessionCache(
+    ttl=int(os.environ.get('SESSION_CACHE_TTL', 300)),
+    max_entries=int(os.environ.get('SESSION_CACHE_SIZE', 10000)),
+))
+report_store = ReportStore(
+    'reports',
+    max_bytes=int(os.environ.get('REPORT_STORE_MB', 1024)) * 1024 * 1024,
+    # Сжатие отчетов при хранении: gzip, zstd (нужен пакет zstandard) или none
+    compression=os.environ.get('REPORT_STORE_COMPRESSION', 'gzip'),
+)
+atexit.register(report_store.close)
+report_generator = ReportGenerator(db, store=report_store)
+report_jobs = ReportJobQueue(
+    report_generator,
+    max_workers=int(os.environ.get('REPORT_WORKERS', 4)),
+    max_processes=int(os.environ.get('REPORT_PROCESSES', 2)),
+    per_user_limit=int(os.environ.get('REPORT_JOBS_PER_USER', 3)),
+    # У воркеров server.py id заданий начинаются с номера воркера: w3-...
+    job_prefix=f"w{os.environ['SERVER_WORKER_ID']}-" if os.environ.get('SERVER_WORKER_ID') else '',
+)
+atexit.register(report_jobs.shutdown)
+# Общий справочник продуктов (python manage.py build-reference); без файла поиск идет только по своим продуктам
+nutrition_ref = open_reference(os.environ.get('NUTRITION_REF_PATH', 'nutrition_ref.bin'))
+if nutrition_ref is not None:
+    atexit.register(nutrition_ref.close)
+
+# Отчеты отдаются потоком кусками по 64 КБ
+REPORT_CHUNK_SIZE = 64 * 1024
+REPORT_MIMETYPES = {
+    '.html': 'text/html',
+    '.pdf': 'application/pdf',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Отчеты неизменяемы: в имени файла хэш содержимого
+REPORT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Создаем таблицы и применяем недостающие миграции при старте
+db.init_database()
+
+# SQL-выражения дольше этого порога попадают в журнал медленных запросов
+metrics.slow_query_seconds = float(os.environ.get('METRICS_SLOW_QUERY_MS', 100)) / 1000
+metrics.registry.stats_gauges('product_cache', 'Кэш продуктов', db.product_cache.stats)
+metrics.registry.stats_gauges('session_cache', 'Кэш сессий', auth_manager.sessions.stats)
+metrics.registry.stats_gauges('report_store', 'Хранилище отчетов', report_store.stats)
+if getattr(db, 'writer', None) is not None:
+    metrics.registry.stats_gauges('db_writer', 'Поток-писатель с групповой фиксацией', db.writer.stats)
+if nutrition_ref is not None:
+    metrics.registry.stats_gauges('nutrition_ref', 'Справочник продуктов', nutrition_ref.stats)
+
+
+@app.before_request
+def start_timer():
+    request.environ['app.started'] = time.perf_counter()
+
+
+@app.after_request
+def record_timing(response):
+    """Задержка и ошибки по маршруту (шаблону пути, а не конкретному URL); для потоковых ответов — до начала отдачи"""
+    started = request.environ.get('app.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def not_modified(etag, last_modified):
+    """Совпадает ли копия клиента (If-None-Match важнее If-Modified-Since)"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified <= since.timestamp()
+
+
+def conditional_by_user(view):
+    """
+    Условный GET для данных одного пользователя: ETag и Last-Modified берутся из версии его данных
+    (db.data_version, в памяти), поэтому неизмененные данные отдаются ответом 304 до запросов к базе.
+    Версия читается до выполнения маршрута: тело ответа не старше своего ETag.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = kwargs.get('user_id') or request.args.get('user_id', type=int)
+        if not user_id:
+            return view(*args, **kwargs)
+        version, modified = db.data_version(user_id)
+        etag = f'u{user_id}-v{version}'
+        if not_modified(etag, modified):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.last_modified = modified
+        response.set_etag(etag)
+        # Клиент хранит ответ, но каждый раз сверяет его с сервером
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
 
 
 # ==================== МАРШРУТЫ ДЛЯ СТАТИЧЕСКИХ ФАЙЛОВ ====================
@@ -41,12 +173,20 @@ def login_page():
 
 # ==================== API АВТОРИЗАЦИИ ====================
 
+def session_token(data=None):
+    """Токен сессии из заголовка Authorization: Bearer или из поля token тела запроса"""
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):].strip()
+    return (data or {}).get('token')
+
+
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     """
     Вход пользователя или создание нового пользователя
     Принимает: {"username": "имя_пользователя"}
-    Возвращает: {"success": true, "user_id": 1, "is_new": false, "current_stage": {...}}
+    Возвращает: {"success": true, "user_id": 1, "is_new": false, "current_stage": {...}, "token": "..."}
     """
     try:
         data = request.get_json()
@@ -63,7 +203,8 @@ def login():
             "user_id": user['id'],
             "username": user['username'],
             "is_new": user['is_new'],
-            "current_stage": user['current_stage']
+            "current_stage": user['current_stage'],
+            "token": user['token']
         })
 
     except Exception as e:
@@ -74,23 +215,30 @@ def login():
 def check_auth():
     """
     Проверка авторизации пользователя
-    Принимает: {"user_id": 1}
-    Возвращает: {"success": true, "username": "имя", "current_stage": {...}}
+    Принимает: заголовок "Authorization: Bearer <token>" или {"token": "..."}; по-старому — {"user_id": 1}
+    Возвращает: {"success": true, "user_id": 1, "username": "имя", "current_stage": {...}}
     """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
+        token = session_token(data)
         user_id = data.get('user_id')
 
-        if not user_id:
+        if token:
+            # Пользователь и этап берутся из кэша сессий, база нужна только при промахе
+            user = auth_manager.get_user_by_token(token)
+            if not user:
+                return jsonify({"success": False, "error": "Сессия недействительна, войдите заново"}), 401
+        elif user_id:
+            user = auth_manager.get_user_by_id(user_id)
+        else:
             return jsonify({"success": False, "error": "Не указан user_id"}), 400
 
-        user = auth_manager.get_user_by_id(user_id)
-
         if not user:
             return jsonify({"success": False, "error": "Пользователь не найден"}), 404
 
         return jsonify({
             "success": True,
+            "user_id": user['id'],
             "username": user['username'],
             "current_stage": user['current_stage']
         })
@@ -140,6 +288,8 @@ def create_stage():
             "message": "Этап программы успешно создан"
         })
 
+    except UnknownUserError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -170,17 +320,37 @@ def complete_stage():
 
 
 @app.route('/api/stage/current/<int:user_id>', methods=['GET'])
+@conditional_by_user
 def get_current_stage(user_id):
     """
     Получение информации о текущем активном этапе
     """
     try:
-        stage = db.get_active_stage(user_id)
+        # С действующим токеном этого пользователя этап берется из кэша сессий
+        user = auth_manager.get_user_by_token(session_token()) if session_token() else None
+        stage = user['current_stage'] if user and user['id'] == user_id else db.get_active_stage(user_id)
 
         if not stage:
-            return jsonify({"success": True, "stage": None})
+            return jsonify({"success": True, "stage": None, "summary": None})
+
+        return jsonify({"success": True, "stage": stage, "summary": db.get_stage_summary(stage['id'])})
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        return jsonify({"success": True, "stage": stage})
+
+@app.route('/api/stage/summary/<int:stage_id>', methods=['GET'])
+def get_stage_summary(stage_id):
+    """
+    Сводка этапа: дней заполнено, сброшено с начального веса, средние калории, лучший и худший день
+    """
+    try:
+        summary = db.get_stage_summary(stage_id)
+
+        if not summary:
+            return jsonify({"success": False, "error": "Этап не найден"}), 404
+
+        return jsonify({"success": True, "summary": summary})
 
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -220,11 +390,87 @@ def save_entry():
             "message": "Запись успешно сохранена"
         })
 
+    except UnknownUserError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/entry/patch', methods=['PATCH', 'POST'])
+def patch_entry():
+    """
+    Частичное изменение ежедневной записи (только изменившиеся данные)
+    Принимает: {
+        "user_id": 1,
+        "stage_id": 1,
+        "entry_date": "2025-11-01",
+        "daily_params": {"morning_weight": 84.9, "edema": null},  // null удаляет параметр
+        "meal_ops": [
+            {"op": "set", "path": [0, "dishes", 2, "mass"], "value": 150},
+            {"op": "append", "path": [1, "dishes"], "value": {"name": "Гречка", "mass": 200, "calories": 220}},
+            {"op": "remove", "path": [3]}
+        ]
+    }
+    """
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        stage_id = data.get('stage_id')
+        entry_date = data.get('entry_date')
+        daily_params = data.get('daily_params') or {}
+        meal_ops = data.get('meal_ops') or []
+
+        if not all([user_id, stage_id, entry_date]):
+            return jsonify({"success": False, "error": "Не указаны обязательные параметры"}), 400
+        if not isinstance(daily_params, dict) or not isinstance(meal_ops, list):
+            return jsonify({"success": False, "error": "daily_params должен быть объектом, meal_ops — списком"}), 400
+
+        try:
+            entry_id = db.patch_daily_entry(user_id, stage_id, entry_date, daily_params, meal_ops)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        return jsonify({
+            "success": True,
+            "entry_id": entry_id,
+            "message": "Запись успешно обновлена"
+        })
+
+    except UnknownUserError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/entry/delete', methods=['POST'])
+def delete_entry():
+    """
+    Удаление записи за день
+    Принимает: {"user_id": 1, "entry_date": "2025-11-01", "stage_id": 1}  // stage_id опционально
+    """
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        entry_date = data.get('entry_date')
+
+        if not all([user_id, entry_date]):
+            return jsonify({"success": False, "error": "Не указаны обязательные параметры"}), 400
+
+        deleted = db.delete_daily_entry(user_id, entry_date, data.get('stage_id'))
+
+        if not deleted:
+            return jsonify({"success": False, "error": "Запись не найдена"}), 404
+
+        return jsonify({"success": True, "message": "Запись удалена"})
+
+    except UnknownUserError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route('/api/entry/get', methods=['GET'])
+@conditional_by_user
 def get_entry():
     """
     Получение записи за определенную дату
@@ -246,17 +492,49 @@ def get_entry():
 
 
 @app.route('/api/entry/history/<int:user_id>', methods=['GET'])
+@conditional_by_user
 def get_entry_history(user_id):
     """
-    Получение истории записей пользователя
-    Параметры: limit (опционально)
+    Получение истории записей пользователя постранично, от новых к старым
+    Параметры: limit (опционально, целое от 1; больше 200 урезается), cursor (next_cursor предыдущей страницы),
+               from / to (диапазон дат ГГГГ-ММ-ДД), fields (через запятую, например entry_date,weight —
+               без тяжелых meals и daily_params)
+    Возвращает: {"success": true, "entries": [...], "next_cursor": "..." или null}
     """
     try:
-        limit = request.args.get('limit', 30, type=int)
+        # Проверяется в entries.history_query: не число или меньше 1 — ошибка 400
+        limit = request.args.get('limit', 30)
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
 
-        entries = db.get_user_entries(user_id, limit)
+        try:
+            page = db.get_entry_history(user_id, limit, request.args.get('cursor'),
+                                        request.args.get('from'), request.args.get('to'), fields or None)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
-        return jsonify({"success": True, "entries": entries})
+        return jsonify({"success": True, **page})
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/sync/<int:user_id>', methods=['GET'])
+def sync(user_id):
+    """
+    Дельта-синхронизация: только записи, продукты и этапы, изменившиеся после версии клиента
+    Параметры: since (последняя полученная версия, 0 — все данные), limit (опционально, до 5000)
+    Возвращает: {"success": true, "version": 42, "reset": false, "has_more": false,
+                 "entries": [...], "products": [...], "stages": [...],
+                 "deleted": {"entries": [...], "products": [], "stages": []}}
+    При reset=true клиент заменяет локальные данные полученными; при has_more запрашивает снова с новой версией.
+    """
+    try:
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', changelog.DEFAULT_LIMIT, type=int)
+
+        changes = db.get_changes(user_id, max(since, 0), limit)
+
+        return jsonify({"success": True, **changes})
 
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -291,6 +569,8 @@ def add_product():
             "message": "Продукт добавлен в базу данных"
         })
 
+    except UnknownUserError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -298,13 +578,17 @@ def add_product():
 @app.route('/api/products/search/<int:user_id>', methods=['GET'])
 def search_products(user_id):
     """
-    Поиск продуктов в базе данных пользователя
-    Параметры: query (поисковый запрос)
+    Поиск продуктов в базе данных пользователя и в общем справочнике
+    Параметры: query (поисковый запрос), limit (опционально, не больше 100)
+    У каждого продукта source: user (свой) или reference (из справочника, id = null)
     """
     try:
         query = request.args.get('query', '')
+        limit = request.args.get('limit', 20, type=int)
 
-        products = db.search_products(user_id, query)
+        products = db.search_products(user_id, query, limit)
+        reference = nutrition_ref.search(query, limit) if nutrition_ref is not None else []
+        products = search.merge_reference(products, reference, limit)
 
         return jsonify({"success": True, "products": products})
 
@@ -313,6 +597,7 @@ def search_products(user_id):
 
 
 @app.route('/api/products/list/<int:user_id>', methods=['GET'])
+@conditional_by_user
 def list_products(user_id):
     """
     Получение всех продуктов пользователя
@@ -326,6 +611,56 @@ def list_products(user_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# ==================== API ИМПОРТА И ЭКСПОРТА ====================
+
+BULK_FORMATS = ('ndjson', 'csv')
+
+
+@app.route('/api/import/<int:user_id>', methods=['POST'])
+def import_data(user_id):
+    """
+    Массовый импорт дневника: тело запроса — NDJSON (этапы, записи дней, продукты) или CSV
+    Параметры: format (ndjson | csv, по умолчанию ndjson)
+    Возвращает поток NDJSON: строка прогресса после каждой пачки
+    {"stages": 0, "entries": 1000, "products": 0, "errors": 0, "batches": 1, "error_lines": [...]},
+    последняя строка — с "done": true
+    """
+    data_format = request.args.get('format', 'ndjson')
+    if data_format not in BULK_FORMATS:
+        return jsonify({"success": False, "error": "Формат должен быть ndjson или csv"}), 400
+    if db.get_user_by_id(user_id) is None:
+        return jsonify({"success": False, "error": "Пользователь не найден"}), 404
+
+    def progress():
+        try:
+            for state in bulk.import_stream(db, user_id, request.stream, data_format):
+                yield json.dumps(state, ensure_ascii=False) + '\n'
+        except Exception as e:
+            yield json.dumps({"success": False, "error": str(e)}, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(progress()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/export/<int:user_id>', methods=['GET'])
+def export_data(user_id):
+    """
+    Выгрузка дневника пользователя потоком
+    Параметры: format (ndjson — этапы, продукты и записи; csv — одна таблица),
+               kind (для csv: entries | products)
+    """
+    data_format = request.args.get('format', 'ndjson')
+    kind = request.args.get('kind', 'entries')
+    if data_format not in BULK_FORMATS or kind not in ('entries', 'products'):
+        return jsonify({"success": False, "error": "Неизвестный формат выгрузки"}), 400
+
+    if data_format == 'csv':
+        lines, mimetype, filename = bulk.export_csv(db, user_id, kind), 'text/csv', f'{kind}_{user_id}.csv'
+    else:
+        lines, mimetype, filename = bulk.export_ndjson(db, user_id), 'application/x-ndjson', f'diary_{user_id}.ndjson'
+    return Response(stream_with_context(line.encode('utf-8') for line in lines), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
 # ==================== API ОТЧЕТОВ ====================
 
 @app.route('/api/report/generate', methods=['POST'])
@@ -347,8 +682,8 @@ def generate_report():
         if not all([user_id, report_date]):
             return jsonify({"success": False, "error": "Не указаны обязательные параметры"}), 400
 
-        # Генерируем отчет
-        report_file = report_generator.generate_report(user_id, report_date, report_format)
+        # Генерируем отчет (PDF и Excel — в процессах очереди отчетов)
+        report_file = report_jobs.render('daily', {'user_id': user_id, 'date': report_date, 'format': report_format})
 
         return jsonify({
             "success": True,
@@ -360,24 +695,169 @@ def generate_report():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/api/report/jobs', methods=['POST'])
+def submit_report_job():
+    """
+    Постановка отчета в очередь, ответ приходит сразу
+    Принимает: {"user_id": 1, "date": "2025-11-01", "format": "html"}
+    Возвращает: {"success": true, "job_id": "...", "status_url": "/api/report/jobs/..."}
+    """
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        report_date = data.get('date')
+        report_format = data.get('format', 'html')
+
+        if not all([user_id, report_date]):
+            return jsonify({"success": False, "error": "Не указаны обязательные параметры"}), 400
+
+        try:
+            job = report_jobs.submit(user_id, 'daily', {'user_id': user_id, 'date': report_date, 'format': report_format})
+        except JobLimitError as e:
+            return jsonify({"success": False, "error": str(e)}), 429
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        return jsonify({
+            "success": True,
+            "job_id": job['job_id'],
+            "status": job['status'],
+            "status_url": f"/api/report/jobs/{job['job_id']}"
+        }), 202
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/report/jobs/<job_id>', methods=['GET'])
+def get_report_job(job_id):
+    """
+    Статус задания на отчет: queued, running, retrying, done (есть report_url) или failed
+    """
+    try:
+        job = report_jobs.status(job_id)
+
+        if not job:
+            return jsonify({"success": False, "error": "Задание не найдено или устарело"}), 404
+
+        return jsonify({"success": True, "job": job})
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/report/range', methods=['POST'])
+def submit_range_report():
+    """
+    Отчет за период или за весь этап, строится в очереди заданий
+    Принимает: {
+        "user_id": 1,
+        "date_from": "2025-01-01",  // и/или date_to
+        "date_to": "2025-12-31",
+        "stage_id": 3,              // вместо дат или вместе с ними
+        "format": "excel"           // html, pdf, excel
+    }
+    Возвращает: {"success": true, "job_id": "...", "status_url": "/api/report/jobs/..."}
+    """
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        params = {
+            'user_id': user_id,
+            'date_from': data.get('date_from'),
+            'date_to': data.get('date_to'),
+            'stage_id': data.get('stage_id'),
+            'format': data.get('format', 'html'),
+        }
+
+        if not user_id or not any([params['date_from'], params['date_to'], params['stage_id']]):
+            return jsonify({"success": False, "error": "Укажите период или этап"}), 400
+        if params['format'] not in REPORT_FORMATS:
+            return jsonify({"success": False, "error": "Неизвестный формат отчета"}), 400
+
+        try:
+            job = report_jobs.submit(user_id, 'range', params)
+        except JobLimitError as e:
+            return jsonify({"success": False, "error": str(e)}), 429
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        return jsonify({
+            "success": True,
+            "job_id": job['job_id'],
+            "status": job['status'],
+            "status_url": f"/api/report/jobs/{job['job_id']}"
+        }), 202
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 @app.route('/reports/<filename>')
 def serve_report(filename):
-    """Отдача сгенерированных отчетов"""
-    return send_from_directory('reports', filename)
+    """
+    Отдача отчетов из хранилища кусками, целиком в память не грузятся.
+    Сжатый при хранении отчет уходит как есть клиенту, который принимает это сжатие, остальным —
+    распакованным на лету. Поддерживаются запросы диапазонов (Range) и условные запросы по ETag:
+    ETag — хэш содержимого, поэтому браузер может хранить отчет без повторной проверки
+    """
+    report = report_store.get(filename)
+    if report is None:
+        abort(404)
+
+    mimetype = REPORT_MIMETYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+    encoded = report.encoding != 'identity' and request.accept_encodings[report.encoding] > 0
+
+    def report_response(body):
+        response = Response(body, mimetype=mimetype, direct_passthrough=True)
+        if encoded:
+            response.content_encoding = report.encoding
+            response.content_length = report.stored_size
+            response.set_etag(f'{report.digest[:32]}-{report.encoding}')
+        else:
+            response.content_length = report.size
+            response.set_etag(report.digest[:32])
+        if report.encoding != 'identity':
+            response.vary.add('Accept-Encoding')
+        response.last_modified = int(report.created)
+        response.headers['Cache-Control'] = REPORT_CACHE_CONTROL
+        # Диапазоны — только для несжатого представления: смещения в нем не зависят от сжатия
+        return response.make_conditional(request, accept_ranges=not encoded,
+                                         complete_length=None if encoded else report.size)
+
+    # Ответ 304 (или 412) отдается без тела, файл для него не открывается
+    response = report_response(())
+    if response.status_code in (304, 412):
+        return response
+    try:
+        f = open(report.path, 'rb')
+    except FileNotFoundError:
+        # Файл вытеснен по бюджету хранилища уже после report_store.get
+        abort(404)
+    if encoded or report.encoding == 'identity':
+        # Файл отдается как хранится, с возможностью перемотки: диапазон читается с нужного места
+        body = wrap_file(request.environ, f, REPORT_CHUNK_SIZE)
+    else:
+        body = ClosingIterator(report_store.iter_content(report, REPORT_CHUNK_SIZE, f), f.close)
+    return report_response(body)
 
 
 # ==================== API СТАТИСТИКИ ====================
 
 @app.route('/api/stats/weight/<int:user_id>', methods=['GET'])
+@conditional_by_user
 def get_weight_stats(user_id):
     """
     Получение статистики по весу
-    Параметры: days (количество дней, по умолчанию 30)
+    Параметры: days (количество последних записей, по умолчанию 30)
+               или from / to (диапазон дат ГГГГ-ММ-ДД, любой может отсутствовать)
     """
     try:
         days = request.args.get('days', 30, type=int)
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
 
-        stats = db.get_weight_statistics(user_id, days)
+        stats = db.get_weight_statistics(user_id, days, date_from, date_to)
 
         return jsonify({"success": True, "stats": stats})
 
@@ -385,6 +865,130 @@ def get_weight_stats(user_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/api/stats/trends/<int:user_id>', methods=['GET'])
+def get_trends(user_id):
+    """
+    Тренды веса и калорий: скользящее среднее, сглаженный вес, линейный тренд,
+    прогноз даты достижения цели, калории по неделям, перцентили калорийной плотности
+    Параметры: window (дней скользящего среднего, 7), alpha (сглаживание, 0.3),
+               trend_days (дней для линии тренда, 28), goal (целевой вес),
+               stage_id, from, to (ограничение данных), series (0 — без подневного ряда)
+    """
+    try:
+        window = request.args.get('window', analytics.DEFAULT_WINDOW, type=int)
+        alpha = request.args.get('alpha', analytics.DEFAULT_ALPHA, type=float)
+        trend_days = request.args.get('trend_days', analytics.DEFAULT_TREND_DAYS, type=int)
+        goal_weight = request.args.get('goal', type=float)
+        stage_id = request.args.get('stage_id', type=int)
+
+        if window < 1 or trend_days < 2 or not 0 < alpha <= 1:
+            return jsonify({"success": False, "error": "Недопустимые параметры окна или сглаживания"}), 400
+
+        trends = db.get_trends(
+            user_id, stage_id, request.args.get('from'), request.args.get('to'), goal_weight,
+            window=window, alpha=alpha, trend_days=trend_days,
+            include_series=request.args.get('series', '1') != '0',
+        )
+
+        return jsonify({"success": True, "trends": trends})
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/api/stats/cache', methods=['GET'])
+def get_cache_stats():
+    """
+    Счетчики кэшей продуктов и сессий (попадания, промахи, вытеснения) для подбора их размера
+    """
+    return jsonify({"success": True, "product_cache": db.product_cache.stats(),
+                    "session_cache": auth_manager.sessions.stats()})
+
+
+@app.route('/api/stats/slow-queries', methods=['GET'])
+def get_slow_queries():
+    """
+    Последние медленные SQL-запросы (порог METRICS_SLOW_QUERY_MS) этого процесса
+    """
+    return jsonify({"success": True, "threshold_ms": metrics.slow_query_seconds * 1000,
+                    "queries": metrics.slow_queries()})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики процесса в текстовом формате Prometheus: задержки маршрутов, SQL, отчеты, кэши"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+# ==================== ПАКЕТНЫЕ ЗАПРОСЫ ====================
+
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 20))
+# Пути, которые нельзя вызывать из пакета: сам пакет и потоковые ответы
+BATCH_EXCLUDED_PATHS = ('/api/batch', '/api/import/', '/api/export/')
+batch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_WORKERS', 4)),
+                                    thread_name_prefix='api-batch')
+atexit.register(batch_executor.shutdown, wait=False)
+
+
+def run_subrequest(spec, headers):
+    """Выполняет один подзапрос пакета через обычную маршрутизацию приложения"""
+    method = str(spec.get('method', 'GET')).upper()
+    path = str(spec.get('path') or '')
+    if not path.startswith('/api/') or path.startswith(BATCH_EXCLUDED_PATHS):
+        return {"status": 400, "body": {"success": False, "error": f"Путь недоступен в пакете: {path}"}}
+    try:
+        environ = EnvironBuilder(path=path, method=method, json=spec.get('body'), headers=headers).get_environ()
+        with app.request_context(environ):
+            response = app.full_dispatch_request()
+        return {"status": response.status_code, "body": response.get_json(silent=True)}
+    except Exception as e:
+        return {"status": 500, "body": {"success": False, "error": str(e)}}
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """
+    Несколько запросов к API за один HTTP-запрос (например, все данные для открытия страницы)
+    Принимает: {"requests": [{"id": "stage", "method": "GET", "path": "/api/stage/current/1"},
+                             {"id": "save", "method": "POST", "path": "/api/entry/save", "body": {...}}, ...]}
+    Возвращает: {"success": true, "responses": [{"id": "stage", "status": 200, "body": {...}}, ...]}
+    Подзапросы выполняются по порядку; идущие подряд GET независимы и выполняются параллельно.
+    Заголовок Authorization передается всем подзапросам.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        specs = data.get('requests')
+        if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+            return jsonify({"success": False, "error": "Ожидается непустой список requests"}), 400
+        if len(specs) > BATCH_MAX_REQUESTS:
+            return jsonify({"success": False, "error": f"Не больше {BATCH_MAX_REQUESTS} подзапросов в пакете"}), 400
+
+        headers = {'Authorization': request.headers['Authorization']} if 'Authorization' in request.headers else {}
+        results = [None] * len(specs)
+        pending = []
+
+        def wait_pending():
+            for index, future in pending:
+                results[index] = future.result()
+            pending.clear()
+
+        for index, spec in enumerate(specs):
+            if str(spec.get('method', 'GET')).upper() == 'GET':
+                pending.append((index, batch_executor.submit(run_subrequest, spec, headers)))
+                continue
+            # Изменяющий запрос видит результаты всех предыдущих и ждет их
+            wait_pending()
+            results[index] = run_subrequest(spec, headers)
+        wait_pending()
+
+        for spec, result in zip(specs, results):
+            result['id'] = spec.get('id')
+        return jsonify({"success": True, "responses": results})
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 # ==================== ЗАПУСК ПРИЛОЖЕНИЯ ====================
 
 if __name__ == '__main__':
@@ -393,9 +997,6 @@ if __name__ == '__main__':
     os.makedirs('static', exist_ok=True)
     os.makedirs('templates', exist_ok=True)
 
-    # Инициализация базы данных
-    db.init_database()
-
     # Запуск сервера
     print("🚀 Сервер запущен на http://localhost:5000")
     print("📝 Дневник питания готов к работе!")
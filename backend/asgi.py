@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI-режим API: то же Flask-приложение за асинхронным мостом, маршруты и ответы не меняются.
+Цикл событий только принимает и отдает байты. Тело запроса читается асинхронно, обработчик Flask
+со всей работой с SQLite выполняется в ограниченном пуле потоков (ASGI_THREADS), ответ уходит
+клиенту асинхронно из буфера. Медленный клиент занимает корутину, а не поток: поток освобождается,
+как только ответ построен (потоковый ответ — как только он целиком поместился в буфер
+ASGI_STREAM_BUFFER_KB; больше буфера поток ждет, пока клиент его разберет).
+Запуск: python server.py (несколько процессов) или любым ASGI-сервером: uvicorn asgi:application
+"""
+
+import asyncio
+import contextvars
+import os
+import sys
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Тело запроса больше этого размера читается во временный файл
+BODY_MEMORY_LIMIT = 1024 * 1024
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение до конца ответа"""
+
+
+class _ResponseBuffer:
+    """
+    Передача ответа из потока обработчика в цикл событий.
+    Поток кладет куски и ждет, только если в буфере больше limit байт;
+    цикл событий отправляет куски клиенту и освобождает место.
+    """
+
+    def __init__(self, loop, limit):
+        self.loop = loop
+        self.limit = limit
+        self.status = None
+        self.headers = None
+        self.chunks = deque()
+        self.buffered = 0
+        self.body_started = False
+        self.finished = False
+        self.error = None
+        self.cancelled = False
+        self.ready = asyncio.Event()
+        self._cond = threading.Condition()
+
+    def _wake(self):
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    # ---------- сторона потока ----------
+
+    def start_response(self, status, headers, exc_info=None):
+        with self._cond:
+            if exc_info and self.body_started:
+                # Заголовки уже могли уйти клиенту — заменить их нельзя
+                raise exc_info[1].with_traceback(exc_info[2])
+            self.status = int(status.split(' ', 1)[0])
+            self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return self.put
+
+    def put(self, chunk):
+        """False — клиент ушел, дальше ответ строить не нужно"""
+        with self._cond:
+            while self.buffered > self.limit and not self.cancelled:
+                self._cond.wait()
+            if self.cancelled:
+                return False
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            self.body_started = True
+        self._wake()
+        return True
+
+    def finish(self, error=None):
+        with self._cond:
+            self.finished, self.error = True, error
+        self._wake()
+
+    # ---------- сторона цикла событий ----------
+
+    def take(self):
+        with self._cond:
+            chunks, self.chunks = list(self.chunks), deque()
+            return chunks, self.finished, self.error
+
+    def release(self, size):
+        with self._cond:
+            self.buffered -= size
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify()
+
+
+class WsgiBridge:
+    """ASGI-приложение поверх WSGI-приложения с ограниченным пулом потоков для обработчиков"""
+
+    def __init__(self, wsgi_app, max_threads=32, stream_buffer=1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.stream_buffer = stream_buffer
+        self.max_body = getattr(wsgi_app, 'config', {}).get('MAX_CONTENT_LENGTH')
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = await self._read_body(receive)
+        if body is None:
+            await _plain_response(send, 413, 'Слишком большое тело запроса')
+            return
+        try:
+            await self._respond(self._environ(scope, body), send)
+        finally:
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        """Тело целиком во временном файле (в памяти до BODY_MEMORY_LIMIT); None — больше MAX_CONTENT_LENGTH"""
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_MEMORY_LIMIT)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                raise ClientDisconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                return None
+            if chunk:
+                body.write(chunk)
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        return body
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0] if client else '',
+            # Тело уже прочитано целиком: длина известна и для chunked-запросов
+            'CONTENT_LENGTH': str(body.seek(0, os.SEEK_END)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        body.seek(0)
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+            if name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+                continue
+            key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run_app(self, environ, buffer):
+        # Весь ответ, включая итерацию потокового тела, строится в одном потоке:
+        # соединения пула привязаны к потоку, который их взял
+        result = None
+        try:
+            result = self.wsgi_app(environ, buffer.start_response)
+            for chunk in result:
+                if chunk and not buffer.put(chunk):
+                    break
+        except BaseException as e:
+            buffer.finish(e)
+        else:
+            buffer.finish()
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+
+    async def _respond(self, environ, send):
+        buffer = _ResponseBuffer(asyncio.get_running_loop(), self.stream_buffer)
+        # Контекст копируется, чтобы потоковые ответы Flask видели свой контекст запроса
+        self.executor.submit(contextvars.copy_context().run, self._run_app, environ, buffer)
+        started = False
+        try:
+            while True:
+                await buffer.ready.wait()
+                buffer.ready.clear()
+                chunks, finished, error = buffer.take()
+                if error is not None and not started:
+                    await _plain_response(send, 500, 'Внутренняя ошибка сервера')
+                    return
+                if not started and (chunks or finished):
+                    await send({'type': 'http.response.start', 'status': buffer.status, 'headers': buffer.headers})
+                    started = True
+                for chunk in chunks:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    buffer.release(len(chunk))
+                if error is not None:
+                    # Ответ уже начат: обрываем соединение, чтобы клиент не принял неполное тело за целое
+                    raise error
+                if finished:
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    return
+        except BaseException:
+            buffer.cancel()
+            raise
+
+
+async def _plain_response(send, status, text):
+    body = text.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                            (b'content-length', str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _create_application():
+    from app import app
+    return WsgiBridge(app, max_threads=int(os.environ.get('ASGI_THREADS', 32)),
+                      stream_buffer=int(os.environ.get('ASGI_STREAM_BUFFER_KB', 1024)) * 1024)
+
+
+application = _create_application()
@@ -1,18 +1,81 @@
-
 # -*- coding: utf-8 -*-
 """
-Модуль авторизации через логин без пароля
+Модуль авторизации через логин без пароля.
+При входе выдается подписанный токен сессии; пользователь и его текущий этап кэшируются
+по токену, поэтому проверка авторизации обычно обходится без запросов к базе.
 """
 
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from cache import SessionCache
+
+# Срок действия токена сессии
+TOKEN_TTL = 30 * 24 * 3600
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
 class AuthManager:
-    def __init__(self, db):
+    def __init__(self, db, secret=None, token_ttl=TOKEN_TTL, session_cache=None):
         self.db = db
+        # Без SESSION_SECRET ключ случайный: токены живут до перезапуска и только в этом процессе
+        secret = secret or os.environ.get('SESSION_SECRET') or secrets.token_hex(32)
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.token_ttl = token_ttl
+        self.sessions = session_cache or SessionCache()
+        db.add_stage_listener(lambda user_id: self.sessions.invalidate_user(int(user_id)))
+
+    def _sign(self, payload):
+        return _b64(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue_token(self, user_id):
+        """Токен вида user_id.время_выдачи.подпись"""
+        payload = f"{int(user_id)}.{int(time.time())}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify_token(self, token):
+        """Возвращает user_id из токена или None, если подпись не сходится или срок истек"""
+        try:
+            user_id, issued_at, signature = token.split('.')
+            payload = f"{int(user_id)}.{int(issued_at)}"
+        except (AttributeError, ValueError):
+            return None
+        # compare_digest не принимает строки с не-ASCII символами, поэтому сравниваются байты
+        if not hmac.compare_digest(signature.encode('utf-8'), self._sign(payload).encode('ascii')):
+            return None
+        if time.time() - int(issued_at) > self.token_ttl:
+            return None
+        return int(user_id)
 
     def login_user(self, username):
         # Даем возможность зайти под любым новым логином
         user = self.db.login_user(username)
+        user['token'] = self.issue_token(user['id'])
         return user
 
     def get_user_by_id(self, user_id):
         user = self.db.get_user_by_id(user_id)
         return user
+
+    def get_user_by_token(self, token):
+        """Пользователь с текущим этапом по токену сессии: из кэша, а при промахе — из базы"""
+        user_id = self.verify_token(token)
+        if user_id is None:
+            return None
+        # Этап мог смениться в другом процессе сервера
+        self.db.poll_changes(user_id)
+        user = self.sessions.get(token)
+        if user is not None:
+            return user
+        generation = self.sessions.token(user_id)
+        user = self.db.get_user_by_id(user_id)
+        if user is not None:
+            self.sessions.put(token, user, generation)
+        return user
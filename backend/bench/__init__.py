@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочные замеры API и отчетов на воспроизводимом синтетическом наборе данных.
+Запуск из каталога backend: python -m bench --users 20 --years 3 --out results.json
+Сравнение с сохраненным результатом: python -m bench --baseline results.json
+"""
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Командная строка замеров: генерация набора данных, прогон сценариев, запись JSON и сравнение
+с сохраненным результатом. Код возврата 1 — есть регрессия больше порога.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Нагрузочные замеры дневника питания')
+    parser.add_argument('--users', type=int, default=10, help='Пользователей в наборе данных')
+    parser.add_argument('--years', type=float, default=2, help='Сколько лет записей у каждого пользователя')
+    parser.add_argument('--products', type=int, default=300, help='Продуктов у каждого пользователя')
+    parser.add_argument('--seed', type=int, default=42, help='Зерно генератора: одинаковое зерно — одинаковые данные')
+    parser.add_argument('--iterations', type=int, default=50, help='Повторов каждого сценария')
+    parser.add_argument('--threads', type=int, default=8, help='Потоков в смешанной нагрузке (0 — не запускать)')
+    parser.add_argument('--scenarios', help='Сценарии через запятую, по умолчанию все')
+    parser.add_argument('--memory', action='store_true',
+                        help='Замерять пик памяти каждого сценария (tracemalloc, замедляет прогон)')
+    parser.add_argument('--workdir', help='Каталог для базы и отчетов, по умолчанию временный')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='Запуск на шардированной базе с этим числом шардов (0 — одна база)')
+    parser.add_argument('--out', help='Файл для результатов (JSON), по умолчанию stdout')
+    parser.add_argument('--baseline', help='Сохраненный результат для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Допустимое ухудшение p50/p99/ops_per_s, доля (0.10 — 10%%)')
+    return parser.parse_args(argv)
+
+
+def print_comparison(rows, threshold):
+    print(f"{'раздел':10} {'сценарий':26} {'метрика':10} {'было':>10} {'стало':>10} {'изм.':>8}", file=sys.stderr)
+    for section, name, metric, old, new, change, bad in rows:
+        mark = '  РЕГРЕССИЯ' if bad else ''
+        print(f'{section:10} {name:26} {metric:10} {old:10.2f} {new:10.2f} {change:+8.1%}{mark}', file=sys.stderr)
+    print(f'Порог: {threshold:.0%}', file=sys.stderr)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Пути из командной строки — относительно каталога запуска, до перехода в workdir
+    out = os.path.abspath(args.out) if args.out else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='nutrition-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    if os.path.exists(os.path.join(workdir, 'db.sqlite3')) or os.path.exists(os.path.join(workdir, 'shards')):
+        print(f'Каталог {workdir} уже содержит базу, нужен пустой каталог', file=sys.stderr)
+        return 2
+
+    # Приложение создает базу и каталог отчетов в текущем каталоге при импорте
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+    if args.shards:
+        os.environ['DB_SHARD_DIR'] = os.path.join(workdir, 'shards')
+        os.environ['DB_SHARD_BUCKETS'] = str(args.shards)
+    import app as app_module
+    from bench import dataset, harness
+
+    names = list(harness.SCENARIOS)
+    if args.scenarios:
+        names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+        unknown = [name for name in names if name not in harness.SCENARIOS]
+        if unknown:
+            print(f"Неизвестные сценарии: {', '.join(unknown)}", file=sys.stderr)
+            return 2
+
+    start = date(2021, 1, 1)
+    print(f'Генерация данных: {args.users} польз. × {args.years} г., workdir={workdir}', file=sys.stderr)
+    started = time.perf_counter()
+    summary = dataset.generate(app_module.db, users=args.users, years=args.years, products=args.products,
+                               seed=args.seed, start=start)
+    generate_seconds = time.perf_counter() - started
+    ctx = harness.Context(app_module, summary, start, args.years)
+
+    results = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'params': {key: getattr(args, key) for key in ('users', 'years', 'products', 'seed', 'iterations',
+                                                           'threads', 'shards', 'memory')},
+        },
+        'dataset': {**{key: summary[key] for key in ('entries', 'products', 'stages')},
+                    'users': len(summary['users']), 'generate_seconds': round(generate_seconds, 3)},
+    }
+    print(f"Загружено: {summary['entries']} записей, {summary['products']} продуктов "
+          f'за {generate_seconds:.1f} с', file=sys.stderr)
+
+    print('Однопоточный прогон...', file=sys.stderr)
+    results['single'] = harness.run_single(app_module.app, ctx, names, args.iterations, args.seed, args.memory)
+    if args.threads:
+        print(f'Смешанная нагрузка в {args.threads} потоков...', file=sys.stderr)
+        results['concurrent'] = harness.run_concurrent(app_module.app, ctx, names, args.iterations,
+                                                       args.threads, args.seed)
+    results['meta']['max_rss_kb'] = harness.max_rss_kb()
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    errors = [name for name, values in results['single'].items() if values['errors']]
+    if errors:
+        print(f"Сценарии с ошибками: {', '.join(errors)}", file=sys.stderr)
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows, regressed = harness.compare(results, baseline, args.threshold)
+        print_comparison(rows, args.threshold)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетического дневника: пользователи, многолетние этапы, ежедневные записи
+с приемами пищи и большие списки продуктов с русскими названиями.
+Все случайные величины берутся из random.Random(seed): одинаковые параметры дают одинаковые данные.
+Данные пишутся через bulk.import_records — тот же путь, что и массовый импорт.
+"""
+
+import random
+from datetime import date, timedelta
+
+import bulk
+
+FOODS = ['Гречка', 'Рис', 'Овсянка', 'Перловка', 'Булгур', 'Киноа', 'Макароны', 'Картофель', 'Курица',
+         'Индейка', 'Говядина', 'Телятина', 'Свинина', 'Треска', 'Минтай', 'Лосось', 'Скумбрия', 'Творог',
+         'Кефир', 'Йогурт', 'Сыр', 'Яйцо', 'Омлет', 'Капуста', 'Брокколи', 'Огурец', 'Помидор', 'Морковь',
+         'Свекла', 'Кабачок', 'Тыква', 'Яблоко', 'Груша', 'Банан', 'Апельсин', 'Клубника', 'Черника',
+         'Хлеб', 'Хлебцы', 'Сырники', 'Блины', 'Борщ', 'Щи', 'Суп', 'Плов', 'Котлета', 'Тефтели', 'Салат']
+STYLES = ['отварной', 'запеченный', 'тушеный', 'на пару', 'жареный', 'с зеленью', 'без соли', 'с маслом',
+          'домашний', 'по-деревенски', 'обезжиренный', 'цельнозерновой', 'с сыром', 'с овощами', 'острый']
+BRANDS = ['', ' «Простоквашино»', ' «Домик в деревне»', ' «Мистраль»', ' «Увелка»', ' «Агуня»', ' «Вкусвилл»']
+STAGE_TYPES = ['Похудение', 'Стабилизация', 'Сушка', 'Обучение']
+MEAL_TIMES = ['07:30', '10:00', '13:00', '16:00', '19:00', '21:30']
+STOOL = ['норма', 'нет', 'жидкий', 'твердый']
+
+
+def product_names(rng, count):
+    """count разных названий продуктов"""
+    names = set()
+    while len(names) < count:
+        name = f'{rng.choice(FOODS)} {rng.choice(STYLES)}{rng.choice(BRANDS)}'
+        if len(names) > len(FOODS) * len(STYLES) * len(BRANDS) // 2:
+            name += f' №{len(names)}'
+        names.add(name)
+    return sorted(names)
+
+
+def user_records(rng, years, products, start):
+    """Записи NDJSON-импорта одного пользователя: продукты, этапы и дни подряд за years лет"""
+    catalog = {name: rng.randint(30, 450) for name in product_names(rng, products)}
+    for name, kcal in catalog.items():
+        yield {'type': 'product', 'product_name': name, 'calories_per_100g': kcal}
+    names = list(catalog)
+
+    end = start + timedelta(days=int(365 * years))
+    weight = rng.uniform(75, 120)
+    day, ref = start, 0
+    while day < end:
+        ref += 1
+        length = rng.randint(60, 200)
+        stage_end = min(day + timedelta(days=length), end)
+        active = stage_end >= end
+        stage_type = rng.choice(STAGE_TYPES)
+        yield {'type': 'stage', 'ref': ref, 'stage_type': stage_type, 'start_date': day.isoformat(),
+               'end_date': None if active else stage_end.isoformat(), 'initial_weight': round(weight, 1),
+               'completed': not active}
+        program_day = 0
+        while day < stage_end:
+            program_day += 1
+            meals, total_grams, total_kcal = [], 0, 0
+            for meal_time in rng.sample(MEAL_TIMES, rng.randint(3, 6)):
+                dishes = []
+                for _ in range(rng.randint(1, 4)):
+                    name = rng.choice(names)
+                    mass = rng.randint(30, 350)
+                    calories = round(catalog[name] * mass / 100)
+                    dishes.append({'name': name, 'mass': mass, 'calories': calories})
+                    total_grams += mass
+                    total_kcal += calories
+                meals.append({'time': meal_time, 'dishes': dishes})
+            meals.sort(key=lambda meal: meal['time'])
+            next_weight = weight + rng.gauss(-0.05 if stage_type != 'Стабилизация' else 0.0, 0.3)
+            params = {
+                'stage_type': stage_type, 'program_day': program_day,
+                'morning_weight': round(weight, 1), 'next_morning_weight': round(next_weight, 1),
+                'weight_lost': round(weight - next_weight, 1),
+                'waist': round(weight * 0.9 + rng.uniform(-2, 2), 1), 'hips': round(weight + rng.uniform(5, 15), 1),
+                'total_grams': total_grams, 'total_kcal': total_kcal,
+                'kcal_density': round(total_kcal / total_grams * 100, 1) if total_grams else 0,
+                'edema': rng.random() < 0.1, 'cycle_day': rng.randint(1, 28), 'stool': rng.choice(STOOL),
+            }
+            yield {'type': 'entry', 'stage_ref': ref, 'entry_date': day.isoformat(),
+                   'daily_params': params, 'meals': meals}
+            weight = max(50.0, next_weight)
+            day += timedelta(days=1)
+
+
+def generate(db, users=10, years=2, products=300, seed=42, start=date(2021, 1, 1)):
+    """
+    Создает users пользователей bench_NNN с данными за years лет и products продуктами у каждого.
+    Возвращает {'users': [id, ...], 'usernames': [...], 'entries': ..., 'products': ..., 'stages': ...}
+    """
+    rng = random.Random(seed)
+    summary = {'users': [], 'usernames': [], 'entries': 0, 'products': 0, 'stages': 0}
+    for number in range(users):
+        username = f'bench_{seed}_{number:03d}'
+        user = db.login_user(username)
+        user_id = user.get('user_id', user.get('id'))
+        records = enumerate(user_records(random.Random(rng.random()), years, products, start), start=1)
+        progress = {}
+        for progress in bulk.import_records(db, user_id, records):
+            pass
+        if progress.get('errors'):
+            raise RuntimeError(f'Ошибки при загрузке данных: {progress["error_lines"]}')
+        summary['users'].append(user_id)
+        summary['usernames'].append(username)
+        for key in ('entries', 'products', 'stages'):
+            summary[key] += progress.get(key, 0)
+    return summary
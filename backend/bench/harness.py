@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+Прогон сценариев через тестовый клиент Flask: однопоточно и в несколько потоков.
+Сценарий — функция (client, context, rng), делающая один или несколько запросов к API;
+замеряется время всего сценария. Результат — словарь, пригодный для записи в JSON
+и сравнения с сохраненным результатом (compare).
+"""
+
+import json
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+# Коды ответов, которые сценарий считает нормой (429 — лимит заданий отчетов на пользователя)
+EXPECTED_STATUSES = (200, 202, 304, 404, 429)
+JOB_TIMEOUT = 120.0
+
+
+class ScenarioError(Exception):
+    """Неожиданный ответ API"""
+
+
+def _check(response):
+    if response.status_code not in EXPECTED_STATUSES:
+        raise ScenarioError(f'{response.request.method} {response.request.path}: {response.status_code} '
+                            f'{response.get_data(as_text=True)[:200]}')
+    return response
+
+
+class Context:
+    """Общие для сценариев данные: пользователи набора, их этапы и даты"""
+
+    def __init__(self, app_module, summary, start, years):
+        self.app = app_module
+        self.users = summary['users']
+        self.usernames = summary['usernames']
+        self.start = start
+        self.days = int(365 * years)
+        self.stages = {user_id: [row['id'] for row in app_module.db.iter_rows(user_id, 'stages')]
+                       for user_id in self.users}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def user(self, rng):
+        return rng.choice(self.users)
+
+    def date(self, rng):
+        return (self.start + timedelta(days=rng.randrange(self.days))).isoformat()
+
+    def unique(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def active_stage(self, user_id):
+        return self.app.db.get_active_stage(user_id)['id']
+
+
+def _wait_job(client, response):
+    if response.status_code != 202:
+        return response
+    status_url = response.get_json()['status_url']
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        job = _check(client.get(status_url)).get_json()['job']
+        if job['status'] == 'done':
+            return _check(client.get(job['report_url']))
+        if job['status'] == 'failed':
+            raise ScenarioError(f"Задание отчета не выполнено: {job['error']}")
+        time.sleep(0.005)
+    raise ScenarioError('Задание отчета не завершилось вовремя')
+
+
+def _meals(rng):
+    return [{'time': '08:00', 'dishes': [{'name': 'Гречка отварной', 'mass': rng.randint(100, 300),
+                                          'calories': rng.randint(100, 400)}]}]
+
+
+def s_auth_login(client, ctx, rng):
+    _check(client.post('/api/auth/login', json={'username': rng.choice(ctx.usernames)}))
+
+
+def s_auth_check(client, ctx, rng):
+    _check(client.post('/api/auth/check', json={'user_id': ctx.user(rng)}))
+
+
+def s_stage_current(client, ctx, rng):
+    _check(client.get(f'/api/stage/current/{ctx.user(rng)}'))
+
+
+def s_stage_summary(client, ctx, rng):
+    _check(client.get(f'/api/stage/summary/{rng.choice(ctx.stages[ctx.user(rng)])}'))
+
+
+def s_stage_cycle(client, ctx, rng):
+    # Отдельный пользователь, чтобы не трогать активные этапы набора данных
+    user_id = _check(client.post('/api/auth/login', json={'username': f'bench_stage_{ctx.unique()}'})).get_json()['user_id']
+    stage = _check(client.post('/api/stage/create', json={'user_id': user_id, 'stage_type': 'Похудение',
+                                                          'start_date': '2025-01-01', 'initial_weight': 90}))
+    _check(client.post('/api/stage/complete', json={'user_id': user_id, 'stage_id': stage.get_json()['stage_id']}))
+
+
+def s_entry_get(client, ctx, rng):
+    _check(client.get(f'/api/entry/get?user_id={ctx.user(rng)}&date={ctx.date(rng)}'))
+
+
+def s_entry_save(client, ctx, rng):
+    user_id = ctx.user(rng)
+    _check(client.post('/api/entry/save', json={
+        'user_id': user_id, 'stage_id': ctx.active_stage(user_id), 'entry_date': ctx.date(rng),
+        'daily_params': {'morning_weight': round(rng.uniform(70, 90), 1)}, 'meals': _meals(rng)}))
+
+
+def s_entry_patch(client, ctx, rng):
+    user_id = ctx.user(rng)
+    _check(client.post('/api/entry/patch', json={
+        'user_id': user_id, 'stage_id': ctx.active_stage(user_id), 'entry_date': ctx.date(rng),
+        'daily_params': {'waist': round(rng.uniform(70, 90), 1)},
+        'meal_ops': [{'op': 'append', 'path': [], 'value': _meals(rng)[0]}]}))
+
+
+def s_entry_save_delete(client, ctx, rng):
+    user_id = ctx.user(rng)
+    entry_date = (date(2100, 1, 1) + timedelta(days=ctx.unique())).isoformat()
+    _check(client.post('/api/entry/save', json={'user_id': user_id, 'stage_id': ctx.active_stage(user_id),
+                                                'entry_date': entry_date, 'daily_params': {}, 'meals': []}))
+    _check(client.post('/api/entry/delete', json={'user_id': user_id, 'entry_date': entry_date}))
+
+
+def s_entry_history(client, ctx, rng):
+    _check(client.get(f'/api/entry/history/{ctx.user(rng)}?limit=30'))
+
+
+def s_entry_history_deep(client, ctx, rng):
+    # Листание всей истории по курсору с короткими полями
+    url = f'/api/entry/history/{ctx.user(rng)}?limit=200&fields=entry_date,weight'
+    page = _check(client.get(url)).get_json()
+    while page.get('next_cursor'):
+        page = _check(client.get(f"{url}&cursor={page['next_cursor']}")).get_json()
+
+
+def s_sync(client, ctx, rng):
+    _check(client.get(f'/api/sync/{ctx.user(rng)}?since=0&limit=500'))
+
+
+def s_products_add(client, ctx, rng):
+    _check(client.post('/api/products/add', json={'user_id': ctx.user(rng),
+                                                  'product_name': f'Продукт замера {ctx.unique()}',
+                                                  'calories_per_100g': rng.randint(20, 500)}))
+
+
+def s_products_search(client, ctx, rng):
+    query = rng.choice(['гре', 'кур', 'твор', 'салат', 'с сыром', 'запеч', 'ябл', 'рис отв'])
+    _check(client.get(f'/api/products/search/{ctx.user(rng)}?query={query}'))
+
+
+def s_products_list(client, ctx, rng):
+    _check(client.get(f'/api/products/list/{ctx.user(rng)}'))
+
+
+def s_stats_weight(client, ctx, rng):
+    _check(client.get(f'/api/stats/weight/{ctx.user(rng)}?days=90'))
+
+
+def s_stats_trends(client, ctx, rng):
+    _check(client.get(f'/api/stats/trends/{ctx.user(rng)}'))
+
+
+def s_stats_service(client, ctx, rng):
+    _check(client.get('/api/stats/cache'))
+    _check(client.get('/api/stats/slow-queries'))
+    _check(client.get('/metrics'))
+
+
+def s_batch(client, ctx, rng):
+    user_id = ctx.user(rng)
+    _check(client.post('/api/batch', json={'requests': [
+        {'id': 'auth', 'method': 'POST', 'path': '/api/auth/check', 'body': {'user_id': user_id}},
+        {'id': 'stage', 'path': f'/api/stage/current/{user_id}'},
+        {'id': 'entry', 'path': f'/api/entry/get?user_id={user_id}&date={ctx.date(rng)}'},
+        {'id': 'products', 'path': f'/api/products/list/{user_id}'},
+    ]}))
+
+
+def s_export(client, ctx, rng):
+    response = _check(client.get(f'/api/export/{ctx.user(rng)}?format=ndjson'))
+    response.get_data()
+
+
+def s_import(client, ctx, rng):
+    user_id = ctx.user(rng)
+    stage_id = ctx.active_stage(user_id)
+    body = '\n'.join(json.dumps({'type': 'entry', 'stage_id': stage_id, 'entry_date': ctx.date(rng),
+                                 'daily_params': {'morning_weight': 80}, 'meals': _meals(rng)}, ensure_ascii=False)
+                     for _ in range(100))
+    _check(client.post(f'/api/import/{user_id}', data=body.encode('utf-8'))).get_data()
+
+
+def _report(report_format):
+    def scenario(client, ctx, rng):
+        response = _check(client.post('/api/report/generate', json={
+            'user_id': ctx.user(rng), 'date': ctx.date(rng), 'format': report_format}))
+        _check(client.get(response.get_json()['report_url'])).get_data()
+    return scenario
+
+
+def s_report_job(client, ctx, rng):
+    response = _check(client.post('/api/report/jobs', json={'user_id': ctx.user(rng), 'date': ctx.date(rng),
+                                                            'format': 'html'}))
+    _wait_job(client, response).get_data()
+
+
+def _range_report(report_format):
+    def scenario(client, ctx, rng):
+        day = date.fromisoformat(ctx.date(rng))
+        response = _check(client.post('/api/report/range', json={
+            'user_id': ctx.user(rng), 'date_from': day.isoformat(),
+            'date_to': (day + timedelta(days=90)).isoformat(), 'format': report_format}))
+        _wait_job(client, response).get_data()
+    return scenario
+
+
+SCENARIOS = {
+    'auth_login': s_auth_login,
+    'auth_check': s_auth_check,
+    'stage_current': s_stage_current,
+    'stage_summary': s_stage_summary,
+    'stage_create_complete': s_stage_cycle,
+    'entry_get': s_entry_get,
+    'entry_save': s_entry_save,
+    'entry_patch': s_entry_patch,
+    'entry_save_delete': s_entry_save_delete,
+    'entry_history': s_entry_history,
+    'entry_history_all_pages': s_entry_history_deep,
+    'sync_full': s_sync,
+    'products_add': s_products_add,
+    'products_search': s_products_search,
+    'products_list': s_products_list,
+    'stats_weight': s_stats_weight,
+    'stats_trends': s_stats_trends,
+    'stats_service': s_stats_service,
+    'batch_initial_load': s_batch,
+    'export_ndjson': s_export,
+    'import_100': s_import,
+    'report_html': _report('html'),
+    'report_pdf': _report('pdf'),
+    'report_excel': _report('excel'),
+    'report_job_html': s_report_job,
+    'report_range_pdf': _range_report('pdf'),
+    'report_range_excel': _range_report('excel'),
+}
+# Тяжелые сценарии повторяются реже остальных
+HEAVY_SCENARIOS = ('entry_history_all_pages', 'sync_full', 'export_ndjson', 'import_100', 'report_pdf',
+                   'report_excel', 'report_range_pdf', 'report_range_excel')
+
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered) + 0.5) - 1))]
+
+
+def _summary(durations, errors, wall):
+    return {
+        'count': len(durations),
+        'errors': errors,
+        'ops_per_s': round(len(durations) / wall, 2) if wall else None,
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else None,
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+    }
+
+
+def max_rss_kb():
+    # ru_maxrss в Linux — килобайты, пик за всю жизнь процесса
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_single(app, ctx, names, iterations, seed, trace_memory=False):
+    """Каждый сценарий подряд в одном потоке; с trace_memory — пик выделенной Python памяти на сценарий"""
+    results = {}
+    client = app.test_client()
+    for name in names:
+        rng = random.Random(f'{seed}:{name}')
+        count = max(1, iterations // 5) if name in HEAVY_SCENARIOS else iterations
+        durations, errors = [], []
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        for _ in range(count):
+            began = time.perf_counter()
+            try:
+                SCENARIOS[name](client, ctx, rng)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            durations.append(time.perf_counter() - began)
+        wall = time.perf_counter() - started
+        results[name] = _summary(durations, len(errors), wall)
+        if trace_memory:
+            results[name]['peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+        if errors:
+            results[name]['first_error'] = errors[0]
+    return results
+
+
+def run_concurrent(app, ctx, names, iterations, threads, seed):
+    """
+    Смешанная нагрузка: threads потоков, у каждого свой клиент, сценарии выбираются случайно
+    (тяжелые в 5 раз реже). Возвращает общий поток операций и задержки по сценариям.
+    """
+    weights = [1 if name in HEAVY_SCENARIOS else 5 for name in names]
+    per_thread = max(1, iterations * len(names) // threads)
+    durations = {name: [] for name in names}
+    errors = {name: [] for name in names}
+    lock = threading.Lock()
+
+    def worker(number):
+        client = app.test_client()
+        rng = random.Random(f'{seed}:thread:{number}')
+        for _ in range(per_thread):
+            name = rng.choices(names, weights)[0]
+            began = time.perf_counter()
+            try:
+                SCENARIOS[name](client, ctx, rng)
+            except Exception as e:
+                with lock:
+                    errors[name].append(str(e))
+                continue
+            with lock:
+                durations[name].append(time.perf_counter() - began)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    wall = time.perf_counter() - started
+
+    total = sum(len(values) for values in durations.values())
+    all_durations = [value for values in durations.values() for value in values]
+    scenarios = {}
+    for name in names:
+        if durations[name] or errors[name]:
+            scenarios[name] = _summary(durations[name], len(errors[name]), wall)
+            if errors[name]:
+                scenarios[name]['first_error'] = errors[name][0]
+    return {
+        'threads': threads,
+        'seconds': round(wall, 3),
+        'ops_per_s': round(total / wall, 2) if wall else None,
+        'p50_ms': round(percentile(all_durations, 0.50) * 1000, 3) if all_durations else None,
+        'p99_ms': round(percentile(all_durations, 0.99) * 1000, 3) if all_durations else None,
+        'errors': sum(len(values) for values in errors.values()),
+        'scenarios': scenarios,
+    }
+
+
+def compare(results, baseline, threshold=0.10):
+    """
+    Сравнение с сохраненным результатом. Возвращает строки (раздел, сценарий, метрика, было, стало,
+    изменение) и признак регрессии: p50/p99 выросли или ops_per_s упал больше чем на threshold.
+    """
+    rows, regressed = [], False
+
+    def check(section, name, current, previous, metrics=(('p50_ms', True), ('p99_ms', True), ('ops_per_s', False))):
+        nonlocal regressed
+        for metric, worse_if_higher in metrics:
+            new, old = current.get(metric), previous.get(metric)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            bad = change > threshold if worse_if_higher else change < -threshold
+            regressed = regressed or bad
+            rows.append((section, name, metric, old, new, change, bad))
+
+    for name, current in results.get('single', {}).items():
+        if name in baseline.get('single', {}):
+            check('single', name, current, baseline['single'][name])
+    current, previous = results.get('concurrent'), baseline.get('concurrent')
+    if current and previous:
+        check('concurrent', 'total', current, previous)
+        # Доля сценария в смеси случайна, поэтому по сценариям сравниваются только задержки
+        for name, values in current['scenarios'].items():
+            if name in previous.get('scenarios', {}):
+                check('concurrent', name, values, previous['scenarios'][name], (('p50_ms', True), ('p99_ms', True)))
+    return rows, regressed
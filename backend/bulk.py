@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Массовый импорт и экспорт дневника в NDJSON и CSV.
+Входной поток разбирается построчно, записи копятся пачками по BATCH_SIZE и пишутся
+одной транзакцией через executemany; после каждой пачки наружу отдается прогресс.
+Экспорт — генератор строк, который читает базу порциями и ничего не копит в памяти.
+
+Формат NDJSON (он же формат экспорта) — по объекту на строку:
+    {"type": "stage", "ref": 3, "stage_type": "...", "start_date": "...", "initial_weight": 80, ...}
+    {"type": "entry", "entry_date": "2025-01-01", "stage_ref": 3, "daily_params": {...}, "meals": [...]}
+    {"type": "product", "product_name": "Гречка", "calories_per_100g": 330}
+Запись дня может вместо stage_ref указать stage_id существующего этапа; без обоих попадает
+в текущий активный этап пользователя.
+
+CSV — одна таблица с заголовком: записи дней (entry_date, stage_id, колонки параметров дня,
+meals в виде JSON) или продукты (product_name, calories_per_100g).
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+
+import changelog
+import daily_metrics
+import search
+
+BATCH_SIZE = 1000
+# Сколько ошибок разбора возвращать клиенту (остальные только считаются)
+MAX_REPORTED_ERRORS = 20
+
+# Параметры дня, которые в CSV раскладываются по отдельным колонкам
+PARAM_COLUMNS = ('stage_type', 'program_day', 'morning_weight', 'next_morning_weight', 'weight_lost',
+                 'waist', 'hips', 'total_grams', 'total_kcal', 'kcal_density', 'edema', 'cycle_day', 'stool')
+ENTRY_CSV_COLUMNS = ('entry_date', 'stage_id') + PARAM_COLUMNS + ('extra_params', 'meals')
+PRODUCT_CSV_COLUMNS = ('product_name', 'calories_per_100g')
+STAGE_FIELDS = ('stage_type', 'start_date', 'end_date', 'initial_weight', 'completed')
+
+
+class RecordError(ValueError):
+    """Ошибка в одной строке импорта"""
+
+
+def _csv_value(value):
+    if value is None or value == '':
+        return None
+    for convert in (int, float):
+        try:
+            return convert(value.replace(',', '.'))
+        except ValueError:
+            pass
+    return value
+
+
+# ---------- разбор ----------
+
+def parse_ndjson(lines):
+    """(номер строки, запись) из NDJSON; пустые строки пропускаются"""
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, RecordError(f'Некорректный JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield number, RecordError('Ожидался объект JSON')
+            continue
+        yield number, record
+
+
+def parse_csv(lines):
+    """(номер строки, запись) из CSV с заголовком; тип записей определяется по колонкам"""
+    reader = csv.DictReader(lines)
+    is_products = reader.fieldnames is not None and 'product_name' in reader.fieldnames
+    for row in reader:
+        number = reader.line_num
+        if is_products:
+            yield number, {'type': 'product', 'product_name': row.get('product_name'),
+                           'calories_per_100g': _csv_value(row.get('calories_per_100g'))}
+            continue
+        try:
+            params = json.loads(row['extra_params']) if row.get('extra_params') else {}
+            meals = json.loads(row['meals']) if row.get('meals') else []
+        except ValueError as e:
+            yield number, RecordError(f'Некорректный JSON в колонке: {e}')
+            continue
+        for column, value in row.items():
+            if column not in ('entry_date', 'stage_id', 'extra_params', 'meals') and column and value not in (None, ''):
+                params[column] = _csv_value(value)
+        yield number, {'type': 'entry', 'entry_date': row.get('entry_date'),
+                       'stage_id': _csv_value(row.get('stage_id')), 'daily_params': params, 'meals': meals}
+
+
+def _stage_id(value):
+    """stage_id записи: целое число (в том числе строкой) или None"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise RecordError('stage_id должен быть целым положительным числом')
+    return value
+
+
+def _normalize(record):
+    """Проверяет запись и приводит ее к виду для import_batch"""
+    kind = record.get('type') or ('product' if 'product_name' in record else 'entry')
+    if kind == 'entry':
+        if not record.get('entry_date'):
+            raise RecordError('Не указана дата записи (entry_date)')
+        datetime.strptime(str(record['entry_date']), '%Y-%m-%d')
+        daily_params = record.get('daily_params') or {}
+        meals = record.get('meals') or []
+        if not isinstance(daily_params, dict) or not isinstance(meals, list):
+            raise RecordError('daily_params должен быть объектом, meals — списком')
+        return kind, {'entry_date': str(record['entry_date']), 'stage_id': _stage_id(record.get('stage_id')),
+                      'stage_ref': record.get('stage_ref'), 'daily_params': daily_params, 'meals': meals}
+    if kind == 'product':
+        name = (record.get('product_name') or '').strip()
+        if not name or not isinstance(record.get('calories_per_100g'), (int, float)):
+            raise RecordError('У продукта должны быть название и число calories_per_100g')
+        return kind, {'product_name': name, 'calories_per_100g': record['calories_per_100g']}
+    if kind == 'stage':
+        if not record.get('stage_type') or not record.get('start_date') or record.get('initial_weight') is None:
+            raise RecordError('У этапа должны быть stage_type, start_date и initial_weight')
+        stage = {field: record.get(field) for field in STAGE_FIELDS}
+        stage['ref'] = record.get('ref')
+        stage['completed'] = 1 if stage['completed'] else 0
+        return kind, stage
+    raise RecordError(f'Неизвестный тип записи: {kind}')
+
+
+# ---------- запись пачки (выполняется в транзакции записи) ----------
+
+def _find_or_create_stages(conn, user_id, stages):
+    """
+    Этап с теми же типом, датой начала и весом уже есть — используем его (повторный импорт).
+    Возвращает (ссылка -> id этапа, id созданных этапов).
+    """
+    refs, created = {}, []
+    active = conn.execute('SELECT id FROM stages WHERE user_id=? AND completed=0', (user_id,)).fetchone()
+    for stage in stages:
+        row = conn.execute('''SELECT id FROM stages WHERE user_id=? AND stage_type=? AND start_date=?
+                              AND initial_weight=?''',
+                           (user_id, stage['stage_type'], stage['start_date'], stage['initial_weight'])).fetchone()
+        if row is None:
+            # Активным может быть только один этап: при уже активном импортированный считается завершенным
+            completed = stage['completed'] or (1 if active else 0)
+            row = conn.execute('''INSERT INTO stages (user_id, stage_type, start_date, end_date, initial_weight, completed)
+                                  VALUES (?, ?, ?, ?, ?, ?) RETURNING id''',
+                               (user_id, stage['stage_type'], stage['start_date'], stage['end_date'],
+                                stage['initial_weight'], completed)).fetchone()
+            created.append(row[0])
+            if not completed:
+                active = row
+        if stage['ref'] is not None:
+            refs[str(stage['ref'])] = row[0]
+    return refs, created
+
+
+def write_batch(conn, user_id, stages, entries, products, stage_refs, default_stage_id):
+    """
+    Пишет пачку записей пользователя. Возвращает (новые ссылки на этапы, id затронутых этапов,
+    ошибки строк, число добавленных продуктов). Производные показатели дней пересчитываются здесь же, итоги этапов — вызывающим.
+    """
+    new_refs, created = _find_or_create_stages(conn, user_id, stages)
+    changelog.record(conn, user_id, 'stage', created)
+    refs = dict(stage_refs, **new_refs)
+    now = datetime.now().isoformat(timespec='seconds')
+    own_stages = {row[0] for row in conn.execute('SELECT id FROM stages WHERE user_id=?', (user_id,))}
+
+    rows, errors, names = [], [], set()
+    for number, entry in entries:
+        if entry['stage_ref'] is not None:
+            stage_id = refs.get(str(entry['stage_ref']))
+        else:
+            stage_id = entry['stage_id'] or default_stage_id
+        if stage_id is None or stage_id not in own_stages:
+            errors.append((number, 'Этап записи не найден'))
+            continue
+        rows.append((user_id, stage_id, entry['entry_date'],
+                     json.dumps(entry['daily_params'], ensure_ascii=False),
+                     json.dumps(entry['meals'], ensure_ascii=False), now))
+        names |= search.dish_names(entry['meals'])
+    conn.executemany('''INSERT INTO entries (user_id, stage_id, entry_date, daily_params, meals, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(user_id, stage_id, entry_date) DO UPDATE SET
+                            daily_params=excluded.daily_params,
+                            meals=excluded.meals,
+                            updated_at=excluded.updated_at''', rows)
+    # Показатели дней пересчитываем для всех строк пачки разом; id ищутся по (этап, дата),
+    # чтобы не задеть записи тех же дат в других этапах
+    dates_by_stage = {}
+    for row in rows:
+        dates_by_stage.setdefault(row[1], set()).add(row[2])
+    entry_ids = []
+    for stage_id, stage_dates in dates_by_stage.items():
+        stage_dates = sorted(stage_dates)
+        for start in range(0, len(stage_dates), 500):
+            chunk = stage_dates[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            entry_ids += [row[0] for row in conn.execute(
+                f"SELECT id FROM entries WHERE user_id=? AND stage_id=? AND entry_date IN ({placeholders})",
+                [user_id, stage_id, *chunk])]
+    daily_metrics.refresh(conn, entry_ids)
+    changelog.record(conn, user_id, 'entry', entry_ids)
+
+    # Продукты с уже известным названием пропускаются; rowcount — сколько добавлено на самом деле
+    inserted = conn.executemany('''INSERT INTO products (user_id, product_name, calories_per_100g, name_norm)
+                                   SELECT ?, ?, ?, ? WHERE NOT EXISTS
+                                       (SELECT 1 FROM products WHERE user_id=? AND name_norm=?)''',
+                                [(user_id, p['product_name'], p['calories_per_100g'], search.fold_name(p['product_name']),
+                                  user_id, search.fold_name(p['product_name'])) for _, p in products])
+    added_products = max(inserted.rowcount, 0)
+    product_names = sorted({search.fold_name(p['product_name']) for _, p in products})
+    for start in range(0, len(product_names), 500):
+        chunk = product_names[start:start + 500]
+        changelog.record(conn, user_id, 'product', [row[0] for row in conn.execute(
+            f"SELECT id FROM products WHERE user_id=? AND name_norm IN ({','.join('?' * len(chunk))})",
+            [user_id, *chunk])])
+    if names:
+        search.touch_products(conn, user_id, names, now)
+
+    touched_stages = {row[1] for row in rows} | set(new_refs.values())
+    return new_refs, touched_stages, errors, added_products
+
+
+# ---------- импорт ----------
+
+def import_records(db, user_id, records, batch_size=BATCH_SIZE):
+    """
+    Импортирует поток (номер строки, запись) пачками; после каждой пачки отдает словарь прогресса,
+    последним — итог с done=True.
+    """
+    active = db.get_active_stage(user_id)
+    default_stage_id = active['id'] if active else None
+    progress = {'stages': 0, 'entries': 0, 'products': 0, 'errors': 0, 'batches': 0, 'error_lines': []}
+    stage_refs = {}
+    batch = {'stage': [], 'entry': [], 'product': []}
+
+    def error(number, message):
+        progress['errors'] += 1
+        if len(progress['error_lines']) < MAX_REPORTED_ERRORS:
+            progress['error_lines'].append({'line': number, 'error': message})
+
+    def flush():
+        new_refs, errors, added_products = db.import_batch(user_id, batch['stage'], batch['entry'],
+                                                           batch['product'], stage_refs, default_stage_id)
+        stage_refs.update(new_refs)
+        for number, message in errors:
+            error(number, message)
+        progress['stages'] += len(batch['stage'])
+        progress['entries'] += len(batch['entry']) - len(errors)
+        progress['products'] += added_products
+        progress['batches'] += 1
+        for items in batch.values():
+            items.clear()
+        return dict(progress, error_lines=list(progress['error_lines']))
+
+    for number, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            kind, item = _normalize(record)
+        except (ValueError, TypeError) as e:
+            error(number, str(e))
+            continue
+        if kind == 'stage':
+            item['number'] = number
+            batch['stage'].append(item)
+        else:
+            batch[kind].append((number, item))
+        if sum(len(items) for items in batch.values()) >= batch_size:
+            yield flush()
+    if any(batch.values()):
+        yield flush()
+    yield dict(progress, done=True)
+
+
+def import_stream(db, user_id, stream, data_format='ndjson', batch_size=BATCH_SIZE):
+    """Импорт из байтового потока (тела запроса или файла)"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    records = parse_csv(text) if data_format == 'csv' else parse_ndjson(text)
+    return import_records(db, user_id, records, batch_size)
+
+
+# ---------- экспорт ----------
+
+def export_ndjson(db, user_id):
+    """Строки NDJSON: сначала этапы, потом продукты, потом записи дней"""
+    for stage in db.iter_rows(user_id, 'stages'):
+        record = {'type': 'stage', 'ref': stage['id']}
+        record.update({field: stage[field] for field in STAGE_FIELDS})
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+    for product in db.iter_rows(user_id, 'products'):
+        yield json.dumps({'type': 'product', 'product_name': product['product_name'],
+                          'calories_per_100g': product['calories_per_100g']}, ensure_ascii=False) + '\n'
+    for entry in db.iter_rows(user_id, 'entries'):
+        yield json.dumps({'type': 'entry', 'entry_date': entry['entry_date'], 'stage_ref': entry['stage_id'],
+                          'daily_params': json.loads(entry['daily_params']) if entry['daily_params'] else {},
+                          'meals': json.loads(entry['meals']) if entry['meals'] else []},
+                         ensure_ascii=False) + '\n'
+
+
+def export_csv(db, user_id, kind='entries'):
+    """Строки CSV с заголовком: записи дней или продукты"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    if kind == 'products':
+        yield line(PRODUCT_CSV_COLUMNS)
+        for product in db.iter_rows(user_id, 'products'):
+            yield line([product['product_name'], product['calories_per_100g']])
+        return
+    yield line(ENTRY_CSV_COLUMNS)
+    for entry in db.iter_rows(user_id, 'entries'):
+        params = json.loads(entry['daily_params']) if entry['daily_params'] else {}
+        extra = {key: value for key, value in params.items() if key not in PARAM_COLUMNS}
+        yield line([entry['entry_date'], entry['stage_id'], *[params.get(key, '') for key in PARAM_COLUMNS],
+                    json.dumps(extra, ensure_ascii=False) if extra else '', entry['meals'] or ''])
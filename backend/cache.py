@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Кэши в памяти процесса.
+ProductCache хранит для каждого пользователя список продуктов и результаты последних поисков,
+вытесняет пользователей по LRU при превышении числа записей или бюджета памяти.
+SessionCache хранит пользователя и его текущий этап по токену сессии с ограниченным сроком жизни.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+
+class _UserEntry:
+    __slots__ = ('products', 'products_size', 'searches', 'searches_size')
+
+    def __init__(self):
+        self.products = None
+        self.products_size = 0
+        self.searches = OrderedDict()
+        self.searches_size = 0
+
+    @property
+    def size(self):
+        return self.products_size + self.searches_size
+
+
+def estimate_size(rows):
+    """Грубая оценка памяти, занятой списком строк-словарей"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+class ProductCache:
+    """
+    Потокобезопасный LRU-кэш продуктов по пользователям.
+    Чтобы медленное чтение из базы не положило в кэш устаревшие данные, перед чтением
+    берется token(user_id), а put_* принимает данные, только если токен не изменился.
+    """
+
+    def __init__(self, max_users=1000, max_bytes=64 * 1024 * 1024, max_searches_per_user=64):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.max_searches_per_user = max_searches_per_user
+        self._entries = OrderedDict()
+        self._generations = OrderedDict()
+        # Поколение пользователей, вытесненных из _generations (и тех, кого там не было)
+        self._floor = 0
+        self._counter = count(1)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # ---------- служебное ----------
+
+    def _touch(self, user_id, create=False):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries.move_to_end(user_id)
+        elif create:
+            entry = self._entries[user_id] = _UserEntry()
+        return entry
+
+    def _bump(self, user_id):
+        self._generations[user_id] = next(self._counter)
+        self._generations.move_to_end(user_id)
+        # Поколения храним с запасом относительно числа пользователей в кэше; вытесненный пользователь
+        # получает поколение не меньше своего последнего, поэтому старый токен с ним не совпадет
+        while len(self._generations) > self.max_users * 4:
+            _, generation = self._generations.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def _generation(self, user_id):
+        return self._generations.get(user_id, self._floor)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def _drop_searches(self, entry):
+        self._bytes -= entry.searches_size
+        entry.searches.clear()
+        entry.searches_size = 0
+
+    # ---------- чтение ----------
+
+    def token(self, user_id):
+        with self._lock:
+            return self._generation(user_id)
+
+    def get_products(self, user_id):
+        with self._lock:
+            entry = self._touch(user_id)
+            if entry is None or entry.products is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry.products)
+
+    def put_products(self, user_id, products, token):
+        with self._lock:
+            if self._generation(user_id) != token:
+                return
+            entry = self._touch(user_id, create=True)
+            size = estimate_size(products)
+            self._bytes += size - entry.products_size
+            entry.products, entry.products_size = list(products), size
+            self._evict()
+
+    def get_search(self, user_id, key):
+        with self._lock:
+            entry = self._touch(user_id)
+            result = entry.searches.get(key) if entry is not None else None
+            if result is None:
+                self.misses += 1
+                return None
+            entry.searches.move_to_end(key)
+            self.hits += 1
+            return list(result[0])
+
+    def put_search(self, user_id, key, products, token):
+        with self._lock:
+            if self._generation(user_id) != token:
+                return
+            entry = self._touch(user_id, create=True)
+            size = estimate_size(products)
+            old = entry.searches.pop(key, None)
+            if old is not None:
+                entry.searches_size -= old[1]
+                self._bytes -= old[1]
+            entry.searches[key] = (list(products), size)
+            entry.searches_size += size
+            self._bytes += size
+            while len(entry.searches) > self.max_searches_per_user:
+                _, (_, dropped) = entry.searches.popitem(last=False)
+                entry.searches_size -= dropped
+                self._bytes -= dropped
+            self._evict()
+
+    # ---------- инвалидация ----------
+
+    def product_added(self, user_id, product):
+        """Дописывает новый продукт в кэшированный список и сбрасывает результаты поиска"""
+        with self._lock:
+            self._bump(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if entry.products is not None:
+                size = estimate_size([product]) - sys.getsizeof([])
+                entry.products.append(product)
+                entry.products_size += size
+                self._bytes += size
+            self._drop_searches(entry)
+            self._evict()
+
+    def invalidate_searches(self, user_id):
+        with self._lock:
+            self._bump(user_id)
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._drop_searches(entry)
+                self.invalidations += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._bump(user_id)
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._bytes -= entry.size
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._bump(user_id)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._entries),
+                'bytes': self._bytes,
+                'max_users': self.max_users,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class SessionCache:
+    """
+    TTL-кэш «токен сессии -> пользователь с текущим этапом».
+    Токены одного пользователя собраны в индекс, чтобы изменение этапа сбрасывало их все сразу.
+    Как и в ProductCache, перед чтением из базы берется token(user_id), и put принимает
+    данные, только если с тех пор пользователя не инвалидировали.
+    """
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._generations = OrderedDict()
+        self._floor = 0
+        self._counter = count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _remove(self, session_token):
+        _, user = self._entries.pop(session_token)
+        tokens = self._by_user.get(user['id'])
+        if tokens is not None:
+            tokens.discard(session_token)
+            if not tokens:
+                del self._by_user[user['id']]
+
+    def _generation(self, user_id):
+        # Как в ProductCache: вытесненный из _generations пользователь не возвращается к старому поколению
+        return self._generations.get(user_id, self._floor)
+
+    def token(self, user_id):
+        with self._lock:
+            return self._generation(user_id)
+
+    def get(self, session_token):
+        with self._lock:
+            cached = self._entries.get(session_token)
+            if cached is None or cached[0] < time.monotonic():
+                if cached is not None:
+                    self._remove(session_token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_token)
+            self.hits += 1
+            return dict(cached[1])
+
+    def put(self, session_token, user, token):
+        with self._lock:
+            if self._generation(user['id']) != token:
+                return
+            if session_token in self._entries:
+                self._remove(session_token)
+            self._entries[session_token] = (time.monotonic() + self.ttl, dict(user))
+            self._by_user.setdefault(user['id'], set()).add(session_token)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        """Сбрасывает все сессии пользователя (после создания или завершения этапа)"""
+        with self._lock:
+            self._generations[user_id] = next(self._counter)
+            self._generations.move_to_end(user_id)
+            while len(self._generations) > self.max_entries * 4:
+                _, generation = self._generations.popitem(last=False)
+                self._floor = max(self._floor, generation)
+            for session_token in list(self._by_user.get(user_id, ())):
+                self._remove(session_token)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._by_user:
+                self._generations[user_id] = next(self._counter)
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'sessions': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
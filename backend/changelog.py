@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Журнал изменений для дельта-синхронизации клиента (таблица change_log).
+Каждое изменение записи дня, продукта или этапа получает номер версии из монотонного счетчика
+(AUTOINCREMENT) в той же транзакции, что и само изменение. Для каждого объекта хранится только
+последняя версия, поэтому журнал не растет от повторных сохранений одного дня.
+Клиент присылает последнюю известную ему версию и получает только то, что изменилось после нее.
+Тот же журнал дает версии данных пользователей для условных HTTP-запросов (UserVersions).
+"""
+
+import threading
+import time
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+KINDS = {'entry': 'entries', 'product': 'products', 'stage': 'stages'}
+# Особая строка журнала: данные пользователя перенесены и получили новые id,
+# клиенту с более старой версией нужна полная синхронизация
+RESET = 'reset'
+
+MIGRATION_STEPS = [
+    '''CREATE TABLE IF NOT EXISTS change_log (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        UNIQUE (user_id, kind, row_id)
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_change_log_user_version ON change_log(user_id, version)',
+    # Уже существующие данные попадают в журнал, чтобы первая синхронизация (since=0) их вернула
+    *[f"""INSERT OR IGNORE INTO change_log (user_id, kind, row_id, op)
+          SELECT user_id, '{kind}', id, 'upsert' FROM {table} ORDER BY id""" for kind, table in KINDS.items()],
+]
+
+
+def record(conn, user_id, kind, row_ids, op='upsert'):
+    """Отмечает объекты как измененные (op='upsert') или удаленные (op='delete') с новой версией"""
+    conn.executemany('INSERT OR REPLACE INTO change_log (user_id, kind, row_id, op) VALUES (?, ?, ?, ?)',
+                     [(user_id, kind, row_id, op) for row_id in row_ids])
+
+
+def record_missing(conn):
+    """Отмечает удаленными записи дней, которых больше нет (после массового удаления дублей)"""
+    conn.execute('''INSERT OR REPLACE INTO change_log (user_id, kind, row_id, op)
+                    SELECT c.user_id, c.kind, c.row_id, 'delete' FROM change_log c
+                    WHERE c.kind='entry' AND c.op='upsert'
+                      AND NOT EXISTS (SELECT 1 FROM entries e WHERE e.id=c.row_id)''')
+
+
+def last_version(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def carry_over(source, target, user_id):
+    """
+    После копирования пользователя в другую базу: счетчик версий target не меньше, чем в source,
+    все данные пользователя помечаются измененными, а строка reset заставляет клиентов
+    с версиями из source выполнить полную синхронизацию.
+    """
+    floor = last_version(source)
+    target.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT 'change_log', 0
+                      WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name='change_log')''')
+    target.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='change_log'", (floor,))
+    # Строка reset получает версию раньше данных: клиент, дочитавший данные, ее уже не увидит
+    record(target, user_id, RESET, [0], RESET)
+    for kind, table in KINDS.items():
+        target.execute(f'''INSERT OR REPLACE INTO change_log (user_id, kind, row_id, op)
+                           SELECT user_id, '{kind}', id, 'upsert' FROM {table} WHERE user_id=? ORDER BY id''',
+                       (user_id,))
+
+
+def changes_since(conn, user_id, since=0, limit=DEFAULT_LIMIT):
+    """
+    Изменения пользователя после версии since: текущие строки измененных объектов
+    и id удаленных. Если версия клиента недействительна (данные перенесены, база восстановлена
+    из копии), возвращается полный набор с reset=True.
+    """
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    current = last_version(conn)
+    reset = since > current or (since > 0 and conn.execute(
+        'SELECT 1 FROM change_log WHERE user_id=? AND kind=? AND version>?', (user_id, RESET, since)).fetchone())
+    if reset:
+        since = 0
+
+    rows = conn.execute('''SELECT version, kind, row_id, op FROM change_log
+                           WHERE user_id=? AND version>? AND kind!=? ORDER BY version LIMIT ?''',
+                        (user_id, since, RESET, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    result = {'version': rows[-1]['version'] if rows else (current if reset else since),
+              'reset': bool(reset), 'has_more': has_more,
+              'deleted': {table: [] for table in KINDS.values()}}
+    changed = {kind: [] for kind in KINDS}
+    for row in rows:
+        if row['op'] == 'delete':
+            result['deleted'][KINDS[row['kind']]].append(row['row_id'])
+        else:
+            changed[row['kind']].append(row['row_id'])
+    for kind, table in KINDS.items():
+        ids = changed[kind]
+        result[table] = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            result[table] += [dict(row) for row in conn.execute(
+                f"SELECT * FROM {table} WHERE user_id=? AND id IN ({','.join('?' * len(chunk))}) ORDER BY id",
+                [user_id, *chunk])]
+    return result
+
+
+class UserVersions:
+    """
+    Версии данных пользователей в памяти: по ним считаются ETag и Last-Modified без запросов к данным.
+    На каждом обращении проверяется PRAGMA data_version отдельного соединения — она меняется после
+    фиксации любой другой транзакции (своего писателя, другого процесса, manage.py). Только тогда из
+    журнала дочитываются версии, появившиеся после последней увиденной, и обновляются затронутые
+    пользователи. Время изменения строго растет по секундам, чтобы If-Modified-Since не пропустил
+    два изменения за одну секунду.
+    on_change(user_id, kinds) вызывается для каждого пользователя с новыми строками журнала —
+    так процесс узнает об изменениях, сделанных другими процессами.
+    """
+
+    def __init__(self, connect, on_change=None):
+        # connect() открывает соединение только для чтения к той же базе
+        self._connect = connect
+        self._on_change = on_change
+        self._conn = None
+        self._data_version = None
+        self._seen = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        if self._conn is None:
+            self._conn = self._connect()
+            self._seen = last_version(self._conn)
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        now = int(time.time())
+        rows = self._conn.execute('''SELECT user_id, kind, MAX(version) FROM change_log WHERE version>?
+                                     GROUP BY user_id, kind''', (self._seen,)).fetchall()
+        changed = {}
+        for user_id, kind, version in rows:
+            self._seen = max(self._seen, version)
+            latest, kinds = changed.get(user_id, (0, set()))
+            changed[user_id] = (max(latest, version), kinds | {kind})
+        for user_id, (version, kinds) in changed.items():
+            known = self._versions.get(user_id)
+            if known is not None:
+                self._versions[user_id] = (version, max(now, known[1] + 1))
+            if self._on_change is not None:
+                self._on_change(user_id, kinds)
+
+    def get(self, user_id):
+        """(версия данных пользователя, unix-время последнего изменения в секундах)"""
+        user_id = int(user_id)
+        with self._lock:
+            self._refresh()
+            entry = self._versions.get(user_id)
+            if entry is None:
+                # Первое обращение к пользователю: время изменения неизвестно, берем текущее
+                row = self._conn.execute('SELECT MAX(version) FROM change_log WHERE user_id=?',
+                                         (user_id,)).fetchone()
+                entry = self._versions[user_id] = (row[0] or 0, int(time.time()))
+            return entry
+
+    def poll(self):
+        """Дочитывает новые строки журнала (и вызывает on_change), если база менялась"""
+        with self._lock:
+            self._refresh()
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Материализованные показатели дня (таблица daily_metrics).
+Числовые параметры из JSON daily_params извлекаются один раз при сохранении записи
+средствами JSON1, чтобы статистика читалась диапазоном по индексу без разбора JSON в Python.
+"""
+
+# Столбец таблицы -> ключ в daily_params
+METRIC_KEYS = {
+    'weight': 'morning_weight',
+    'next_weight': 'next_morning_weight',
+    'weight_lost': 'weight_lost',
+    'waist': 'waist',
+    'hips': 'hips',
+    'total_grams': 'total_grams',
+    'total_kcal': 'total_kcal',
+    'kcal_density': 'kcal_density',
+}
+
+METRIC_COLUMNS = list(METRIC_KEYS)
+
+
+def _number(key):
+    """
+    SQL-выражение, извлекающее число из daily_params.
+    Числа в виде строк ("85,5", " 85.5 ") тоже принимаются; пустые и нечисловые значения дают NULL.
+    """
+    value = f"json_extract(e.daily_params, '$.{key}')"
+    text = f"REPLACE(TRIM({value}), ',', '.')"
+    return f'''CASE WHEN json_valid(e.daily_params) THEN
+            CASE json_type(e.daily_params, '$.{key}')
+                WHEN 'integer' THEN {value}
+                WHEN 'real' THEN {value}
+                WHEN 'text' THEN CASE WHEN {text} GLOB '*[0-9]*' AND NOT {text} GLOB '*[^0-9.+-]*'
+                                      THEN CAST({text} AS REAL) END
+            END
+        END'''
+
+
+_REFRESH_SQL = f'''INSERT OR REPLACE INTO daily_metrics (entry_id, user_id, stage_id, entry_date, {', '.join(METRIC_COLUMNS)})
+    SELECT e.id, e.user_id, e.stage_id, e.entry_date,
+           {', '.join(_number(key) for key in METRIC_KEYS.values())}
+    FROM entries e'''
+
+
+def refresh(conn, entry_ids):
+    """Пересчитывает показатели для указанных записей в текущей транзакции"""
+    entry_ids = list(entry_ids)
+    for start in range(0, len(entry_ids), 500):
+        chunk = entry_ids[start:start + 500]
+        conn.execute(f"{_REFRESH_SQL} WHERE e.id IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def refresh_all(conn):
+    conn.execute('DELETE FROM daily_metrics')
+    conn.execute(_REFRESH_SQL)
+
+
+def remove_orphans(conn):
+    """Удаляет показатели записей, которых больше нет"""
+    conn.execute('DELETE FROM daily_metrics WHERE entry_id NOT IN (SELECT id FROM entries)')
+
+
+def weight_statistics(conn, user_id, limit=None, date_from=None, date_to=None):
+    conditions, params = ['user_id=?'], [user_id]
+    if date_from:
+        conditions.append('entry_date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('entry_date <= ?')
+        params.append(date_to)
+    sql = f'''SELECT entry_date, {', '.join(METRIC_COLUMNS)} FROM daily_metrics
+              WHERE {' AND '.join(conditions)} ORDER BY entry_date DESC'''
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    stats = []
+    for row in conn.execute(sql, params).fetchall():
+        stat = {
+            'date': row['entry_date'],
+            'weight': row['weight'],
+            'next_weight': row['next_weight'],
+            'lost_weight': row['weight_lost'],
+        }
+        stat.update({column: row[column] for column in ('waist', 'hips', 'total_grams', 'total_kcal', 'kcal_density')})
+        stats.append(stat)
+    return stats
+
+
+# Шаги миграции схемы (подключаются в migrations.MIGRATIONS)
+MIGRATION_STEPS = [
+    f'''CREATE TABLE IF NOT EXISTS daily_metrics (
+        entry_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        stage_id INTEGER NOT NULL,
+        entry_date DATE NOT NULL,
+        {', '.join(f'{column} REAL' for column in METRIC_COLUMNS)}
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_daily_metrics_user_date ON daily_metrics(user_id, entry_date)',
+    'CREATE INDEX IF NOT EXISTS idx_daily_metrics_stage_date ON daily_metrics(stage_id, entry_date)',
+    refresh_all,
+]
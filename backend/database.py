@@ -1,194 +1,800 @@
-
 # -*- coding: utf-8 -*-
 """
 Модуль для взаимодействия с SQLite базой данных
 """
 
+import functools
+import os
 import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 import json
 
-class Database:
-    def __init__(self, db_path='db.sqlite3'):
+import analytics
+import bulk
+import changelog
+from cache import ProductCache
+import daily_metrics
+import entries
+import metrics
+import migrations
+import rollups
+from replica import SnapshotReplica
+import search
+from writer import GroupCommitWriter
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Курсор, замеряющий каждое выражение для metrics: время выполнения вместе с выборкой строк.
+    SQLite вычисляет строки по мере чтения, поэтому время складывается из execute и всех fetch/итераций,
+    а записывается, когда строки кончились, курсор закрыт или выполняет следующее выражение
+    (или освобожден). Время между чтениями, которое тратит вызывающий код, не учитывается.
+    set_trace_callback сообщает только текст выражения без длительности, поэтому замер здесь.
+    """
+
+    ITER_BATCH = 256
+    _sql = None
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except BaseException:
+            metrics.observe_query(sql, time.perf_counter() - started)
+            raise
+        self._sql, self._elapsed = sql, time.perf_counter() - started
+        if self.description is None:
+            # Выражение без строк результата (INSERT, UPDATE, DDL) уже выполнено целиком
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+    def _timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            metrics.observe_query(sql, self._elapsed)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        # Итерация читает пачками: замер на каждую строку удваивал бы стоимость больших выборок
+        while True:
+            rows = self.fetchmany(self.ITER_BATCH)
+            yield from rows
+            if len(rows) < self.ITER_BATCH:
+                return
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Курсор, из которого прочитали не все строки (например, одну через fetchone)
+        self._finish()
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение пула: помнит время последнего использования для проверки здоровья, замеряет SQL"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений SQLite.
+    Каждое соединение настраивается один раз при создании (WAL, synchronous=NORMAL,
+    кэш страниц, mmap, busy_timeout). Поток, уже держащий соединение, получает его же
+    повторно, поэтому вложенные вызовы методов Database работают в одной транзакции.
+    """
+
+    def __init__(self, db_path, size=8, timeout=30.0, cache_size_kb=8192,
+                 mmap_size=64 * 1024 * 1024, busy_timeout_ms=5000, health_check_interval=30.0,
+                 read_only=False, immutable=False):
         self.db_path = db_path
+        # read_only — соединения mode=ro; immutable — файл никогда не меняется на месте (снимок)
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        self.size = size
+        self.timeout = timeout
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.health_check_interval = health_check_interval
+        self._idle = []
+        self._created = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
 
-    def get_conn(self):
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    def _create(self):
+        if self.read_only:
+            mode = 'immutable=1' if self.immutable else 'mode=ro'
+            conn = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(self.db_path))}?{mode}', uri=True,
+                                   check_same_thread=False, timeout=self.busy_timeout_ms / 1000,
+                                   factory=PooledConnection)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   timeout=self.busy_timeout_ms / 1000, factory=PooledConnection)
         conn.row_factory = sqlite3.Row
+        if not self.read_only:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
         return conn
 
-    def init_database(self):
-        conn = self.get_conn()
-        c = conn.cursor()
-        # Создание таблиц
-        c.executescript('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS stages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            stage_type TEXT NOT NULL,
-            start_date DATE NOT NULL,
-            end_date DATE,
-            initial_weight REAL NOT NULL,
-            completed INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE TABLE IF NOT EXISTS entries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            stage_id INTEGER NOT NULL,
-            entry_date DATE NOT NULL,
-            daily_params TEXT,
-            meals TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (stage_id) REFERENCES stages(id)
-        );
-
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            product_name TEXT NOT NULL,
-            calories_per_100g REAL NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-        ''')
-        conn.commit()
+    def _is_healthy(self, conn):
+        # Проверяем только соединения, которые долго простаивали
+        if time.monotonic() - conn.last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _take_idle(self):
+        # Сначала пробуем вернуть потоку то соединение, которым он пользовался в прошлый раз
+        preferred = getattr(self._local, 'last', None)
+        if preferred is not None and preferred in self._idle:
+            self._idle.remove(preferred)
+            return preferred
+        return self._idle.pop()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._take_idle()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Пул соединений исчерпан')
+                self._cond.wait(remaining)
+
+        try:
+            if conn is None:
+                conn = self._create()
+            elif not self._is_healthy(conn):
+                self._discard(conn, replace=False)
+                conn = self._create()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+        self._local.last = conn
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        conn.last_used = time.monotonic()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+            # Пул закрыт, пока соединение было занято: в простаивающие оно больше не попадает
+            self._created -= 1
+            self._cond.notify()
         conn.close()
 
-    def login_user(self, username):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT id, username FROM users WHERE username=?', (username,))
-        user = c.fetchone()
-        if user:
-            # Проверяем активный этап программы
-            c.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user['id'],))
-            stage = c.fetchone()
-            current_stage = dict(stage) if stage else None
+    def _discard(self, conn, replace=True):
+        try:
             conn.close()
-            return { 'id': user['id'], 'username': user['username'], 'is_new': False, 'current_stage': current_stage }
+        except sqlite3.Error:
+            pass
+        if replace:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Выдает соединение на время блока with.
+        Внешний блок фиксирует транзакцию при успехе и откатывает при ошибке,
+        вложенные блоки того же потока используют то же соединение.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn = self.acquire()
+        local.conn, local.depth, local.after_commit = conn, 1, []
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            local.conn, local.after_commit = None, []
+            try:
+                self.release(conn)
+            except sqlite3.Error:
+                # Соединение, которое не может даже откатиться, в пул не возвращаем
+                self._discard(conn)
+            raise
+        else:
+            local.conn = None
+            self.release(conn)
+            callbacks, local.after_commit = local.after_commit, []
+            for callback in callbacks:
+                callback()
+
+    def in_connection(self):
+        """Держит ли текущий поток соединение (то есть находится внутри блока connection())"""
+        return getattr(self._local, 'conn', None) is not None
+
+    @contextmanager
+    def savepoint(self, conn, name='op'):
+        """
+        Точка сохранения внутри текущей транзакции: при ошибке откатываются изменения блока
+        и отменяются зарегистрированные в нем after_commit.
+        """
+        callbacks = len(self._local.after_commit)
+        conn.execute(f'SAVEPOINT {name}')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f'ROLLBACK TO {name}')
+            conn.execute(f'RELEASE {name}')
+            del self._local.after_commit[callbacks:]
+            raise
         else:
-            # Создаем нового пользователя
-            c.execute('INSERT INTO users (username) VALUES (?)', (username,))
-            conn.commit()
-            user_id = c.lastrowid
+            conn.execute(f'RELEASE {name}')
+
+    def after_commit(self, callback):
+        """
+        Откладывает callback до фиксации текущей транзакции этого потока
+        (при откате он не вызывается). Вне блока connection() вызывается сразу.
+        """
+        if getattr(self._local, 'conn', None) is None:
+            callback()
+        else:
+            self._local.after_commit.append(callback)
+
+    def close_all(self):
+        """Закрывает простаивающие соединения; занятые закрываются, когда их вернут в пул"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
             conn.close()
-            return { 'id': user_id, 'username': username, 'is_new': True, 'current_stage': None }
+
+
+def write_operation(method):
+    """
+    Метод записи: выполняется потоком-писателем в групповой транзакции, вызывающий ждет результат.
+    Внутри уже открытого соединения (в самом писателе или во внешнем блоке connection())
+    метод выполняется сразу, иначе поток ждал бы сам себя.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.writer is None or self.pool.in_connection():
+            return method(self, *args, **kwargs)
+        return self.writer.submit(method, self, *args, **kwargs).result()
+    return wrapper
+
+
+class Database:
+    def __init__(self, db_path='db.sqlite3', pool_size=8, product_cache=None,
+                 group_commit=True, write_batch_size=64, write_batch_delay=0.002,
+                 replica_path=None, replica_interval=60.0, shared=False, **pool_options):
+        self.db_path = db_path
+        # shared: в базу пишут и другие процессы (несколько воркеров сервера), кэши процесса
+        # сверяются с журналом изменений перед чтением
+        self.shared = shared
+        # Запись идет через единственное соединение потока-писателя, чтение — через пул mode=ro
+        self.pool = ConnectionPool(db_path, size=1 if group_commit else pool_size, **pool_options)
+        self.read_pool = ConnectionPool(db_path, size=pool_size, read_only=True, **pool_options)
+        self.writer = GroupCommitWriter(self.pool, write_batch_size, write_batch_delay) if group_commit else None
+        # Необязательный снимок базы для аналитики и отчетов за период
+        self.replica = SnapshotReplica(
+            db_path, replica_path, lambda path: ConnectionPool(path, size=pool_size, immutable=True, **pool_options),
+            interval=replica_interval) if replica_path else None
+        self.product_cache = product_cache or ProductCache()
+        # Версии данных пользователей для ETag; отдельное соединение, не из пула чтения
+        self.versions = changelog.UserVersions(self.read_pool._create,
+                                               self._changed_elsewhere if shared else None)
+        self._entry_listeners = []
+        self._stage_listeners = []
+
+    def spec(self):
+        """Параметры для открытия той же базы в другом процессе (см. sharding.open_database)"""
+        return {'db_path': self.db_path}
+
+    def databases(self):
+        """Все физические базы (у шардированной базы — шарды); здесь одна"""
+        yield self
+
+    def connection(self):
+        """Соединение для записи (и для чтения внутри транзакции записи)"""
+        return self.pool.connection()
+
+    def read_connection(self):
+        """
+        Соединение только для чтения. Поток, уже держащий соединение записи,
+        читает через него же, чтобы видеть свои незафиксированные изменения.
+        """
+        if self.pool.in_connection():
+            return self.pool.connection()
+        return self.read_pool.connection()
+
+    def snapshot_connection(self):
+        """Соединение для тяжелых чтений: снимок базы, если он настроен, иначе пул чтения"""
+        if self.replica is None or self.pool.in_connection():
+            return self.read_connection()
+        return self.replica.connection()
+
+    def add_entry_listener(self, listener):
+        """Подписка на изменение записей дня: listener(user_id, entry_date) вызывается после фиксации"""
+        self._entry_listeners.append(listener)
+
+    def _notify_entry_changed(self, user_id, entry_date):
+        for listener in self._entry_listeners:
+            self.pool.after_commit(lambda listener=listener: listener(user_id, entry_date))
+
+    def add_stage_listener(self, listener):
+        """Подписка на создание и завершение этапов: listener(user_id) вызывается после фиксации"""
+        self._stage_listeners.append(listener)
+
+    def _notify_stage_changed(self, user_id):
+        for listener in self._stage_listeners:
+            self.pool.after_commit(lambda listener=listener: listener(user_id))
+
+    def _changed_elsewhere(self, user_id, kinds):
+        # Изменения из журнала, в том числе сделанные другими процессами: сбрасываем кэши процесса
+        if 'product' in kinds or changelog.RESET in kinds:
+            self.product_cache.invalidate(user_id)
+        elif 'entry' in kinds:
+            # Поиск продуктов подмешивает названия блюд из записей
+            self.product_cache.invalidate_searches(user_id)
+        if 'stage' in kinds or changelog.RESET in kinds:
+            for listener in self._stage_listeners:
+                listener(user_id)
+
+    def poll_changes(self, user_id):
+        """Для shared-базы: учесть изменения других процессов перед чтением из кэшей процесса"""
+        if self.shared:
+            self.versions.poll()
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Ставит метод записи в очередь без ожидания: db.submit(db.save_daily_entry, ...) -> Future,
+        результат (id строки) появляется после групповой фиксации
+        """
+        func = getattr(getattr(method, '__func__', method), '__wrapped__', None)
+        if func is None:
+            raise ValueError(f'{getattr(method, "__name__", method)} не является методом записи')
+        if self.writer is None:
+            future = Future()
+            try:
+                future.set_result(func(self, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.writer.submit(func, self, *args, **kwargs)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.replica is not None:
+            self.replica.close()
+        self.versions.close()
+        self.read_pool.close_all()
+        self.pool.close_all()
+
+    def init_database(self):
+        with self.connection() as conn:
+            # Создание таблиц
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS stages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                stage_type TEXT NOT NULL,
+                start_date DATE NOT NULL,
+                end_date DATE,
+                initial_weight REAL NOT NULL,
+                completed INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                stage_id INTEGER NOT NULL,
+                entry_date DATE NOT NULL,
+                daily_params TEXT,
+                meals TEXT,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (stage_id) REFERENCES stages(id)
+            );
+
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                product_name TEXT NOT NULL,
+                calories_per_100g REAL NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+            ''')
+            # Применяем недостающие миграции (индексы и последующие изменения схемы)
+            migrations.apply_migrations(conn)
+
+    def login_user(self, username):
+        with self.read_connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, username FROM users WHERE username=?', (username,))
+            user = c.fetchone()
+            if user:
+                # Проверяем активный этап программы
+                c.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user['id'],))
+                stage = c.fetchone()
+                current_stage = dict(stage) if stage else None
+                return { 'id': user['id'], 'username': user['username'], 'is_new': False, 'current_stage': current_stage }
+        # Создаем нового пользователя (запись идет через поток-писатель)
+        return self._create_user(username)
+
+    @write_operation
+    def _create_user(self, username):
+        with self.connection() as conn:
+            row = conn.execute('INSERT INTO users (username) VALUES (?) ON CONFLICT(username) DO NOTHING RETURNING id',
+                               (username,)).fetchone()
+        if row is None:
+            # Пользователя успел создать параллельный запрос
+            return self.login_user(username)
+        return { 'id': row[0], 'username': username, 'is_new': True, 'current_stage': None }
 
     def get_user_by_id(self, user_id):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT id, username FROM users WHERE id=?', (user_id,))
-        user = c.fetchone()
-        if not user:
-            conn.close()
-            return None
-        # Проверяем активный этап
-        c.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user_id,))
-        stage = c.fetchone()
-        current_stage = dict(stage) if stage else None
-        conn.close()
-        return { 'id': user['id'], 'username': user['username'], 'current_stage': current_stage }
+        with self.read_connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, username FROM users WHERE id=?', (user_id,))
+            user = c.fetchone()
+            if not user:
+                return None
+            # Проверяем активный этап
+            c.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user_id,))
+            stage = c.fetchone()
+            current_stage = dict(stage) if stage else None
+            return { 'id': user['id'], 'username': user['username'], 'current_stage': current_stage }
 
+    @write_operation
     def create_stage(self, user_id, stage_type, start_date, initial_weight):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('''INSERT INTO stages (user_id, stage_type, start_date, initial_weight, completed) VALUES (?, ?, ?, ?, 0)''',
-                  (user_id, stage_type, start_date, initial_weight))
-        conn.commit()
-        stage_id = c.lastrowid
-        conn.close()
-        return stage_id
+        with self.connection() as conn:
+            c = conn.cursor()
+            c.execute('''INSERT INTO stages (user_id, stage_type, start_date, initial_weight, completed) VALUES (?, ?, ?, ?, 0)''',
+                      (user_id, stage_type, start_date, initial_weight))
+            changelog.record(conn, user_id, 'stage', [c.lastrowid])
+            self._notify_stage_changed(user_id)
+            return c.lastrowid
 
+    @write_operation
     def complete_stage(self, stage_id):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('UPDATE stages SET completed=1, end_date=? WHERE id=?', (datetime.now().date(), stage_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            row = conn.execute('UPDATE stages SET completed=1, end_date=? WHERE id=? RETURNING user_id',
+                               (datetime.now().date(), stage_id)).fetchone()
+            if row:
+                changelog.record(conn, row['user_id'], 'stage', [stage_id])
+                self._notify_stage_changed(row['user_id'])
 
     def get_active_stage(self, user_id):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user_id,))
-        stage = c.fetchone()
-        conn.close()
-        return dict(stage) if stage else None
+        with self.read_connection() as conn:
+            stage = conn.execute('SELECT * FROM stages WHERE user_id=? AND completed=0', (user_id,)).fetchone()
+            return dict(stage) if stage else None
+
+    def _touch_products(self, conn, user_id, names):
+        # Продукты из записи поднимаются выше в результатах поиска
+        if not names:
+            return
+        if search.touch_products(conn, user_id, names, datetime.now().isoformat(timespec='seconds')):
+            # У продуктов новый last_used: устарел и кэшированный список продуктов
+            self.pool.after_commit(lambda: self.product_cache.invalidate(int(user_id)))
+        else:
+            self.pool.after_commit(lambda: self.product_cache.invalidate_searches(int(user_id)))
 
+    def _entry_written(self, conn, entry_id):
+        # Обновляем производные данные записи в той же транзакции
+        old = rollups.metrics_for_entry(conn, entry_id)
+        daily_metrics.refresh(conn, [entry_id])
+        new = rollups.metrics_for_entry(conn, entry_id)
+        rollups.apply(conn, old, new)
+        changelog.record(conn, new['user_id'], 'entry', [entry_id])
+        self._notify_entry_changed(new['user_id'], new['entry_date'])
+
+    @write_operation
     def save_daily_entry(self, user_id, stage_id, entry_date, daily_params, meals):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('INSERT INTO entries (user_id, stage_id, entry_date, daily_params, meals) VALUES (?, ?, ?, ?, ?)',
-                  (user_id, stage_id, entry_date, json.dumps(daily_params, ensure_ascii=False), json.dumps(meals, ensure_ascii=False)))
-        conn.commit()
-        entry_id = c.lastrowid
-        conn.close()
-        return entry_id
+        """Сохраняет запись дня; повторное сохранение того же дня обновляет существующую строку"""
+        with self.connection() as conn:
+            entry_id = conn.execute('''INSERT INTO entries (user_id, stage_id, entry_date, daily_params, meals, updated_at)
+                                      VALUES (?, ?, ?, ?, ?, ?)
+                                      ON CONFLICT(user_id, stage_id, entry_date) DO UPDATE SET
+                                          daily_params=excluded.daily_params,
+                                          meals=excluded.meals,
+                                          updated_at=excluded.updated_at
+                                      RETURNING id''',
+                                   (user_id, stage_id, entry_date, json.dumps(daily_params, ensure_ascii=False),
+                                    json.dumps(meals, ensure_ascii=False), datetime.now().isoformat(timespec='seconds'))).fetchone()[0]
+            self._entry_written(conn, entry_id)
+            self._touch_products(conn, user_id, search.dish_names(meals))
+            return entry_id
+
+    @write_operation
+    def patch_daily_entry(self, user_id, stage_id, entry_date, daily_params=None, meal_ops=()):
+        """Применяет к записи дня только изменившиеся параметры и операции над блюдами в одной транзакции"""
+        with self.connection() as conn:
+            entry_id = entries.patch_entry(conn, user_id, stage_id, entry_date, daily_params, meal_ops,
+                                           datetime.now().isoformat(timespec='seconds'))
+            self._entry_written(conn, entry_id)
+            self._touch_products(conn, user_id, entries.touched_dish_names(meal_ops))
+            return entry_id
+
+    @write_operation
+    def delete_daily_entry(self, user_id, entry_date, stage_id=None):
+        """Удаляет запись дня (всех этапов или указанного) и корректирует итоги этапа; возвращает число удаленных"""
+        with self.connection() as conn:
+            sql, params = 'SELECT id FROM entries WHERE user_id=? AND entry_date=?', [user_id, entry_date]
+            if stage_id is not None:
+                sql += ' AND stage_id=?'
+                params.append(stage_id)
+            entry_ids = [row[0] for row in conn.execute(sql, params).fetchall()]
+            for entry_id in entry_ids:
+                old = rollups.metrics_for_entry(conn, entry_id)
+                conn.execute('DELETE FROM entries WHERE id=?', (entry_id,))
+                conn.execute('DELETE FROM daily_metrics WHERE entry_id=?', (entry_id,))
+                rollups.apply(conn, old, None)
+            if entry_ids:
+                changelog.record(conn, user_id, 'entry', entry_ids, 'delete')
+                self._notify_entry_changed(user_id, entry_date)
+            return len(entry_ids)
+
+    def compact_entries(self):
+        """Удаляет дубли записей, оставшиеся от старых сохранений; возвращает число удаленных строк"""
+        with self.connection() as conn:
+            removed = entries.dedupe_entries(conn)
+            if removed:
+                daily_metrics.remove_orphans(conn)
+                rollups.rebuild(conn)
+                changelog.record_missing(conn)
+            return removed
+
+    def get_stage_summary(self, stage_id):
+        """Сводка этапа за O(1): дни, сброшенный вес, средние калории, лучший и худший день"""
+        with self.read_connection() as conn:
+            return rollups.stage_summary(conn, stage_id)
+
+    def rebuild_stage_rollups(self, stage_ids=None):
+        with self.connection() as conn:
+            rollups.rebuild(conn, stage_ids)
 
     def get_entry_by_date(self, user_id, entry_date):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT * FROM entries WHERE user_id=? AND entry_date=?', (user_id, entry_date))
-        entry = c.fetchone()
-        conn.close()
-        return dict(entry) if entry else None
+        with self.read_connection() as conn:
+            entry = conn.execute('SELECT * FROM entries WHERE user_id=? AND entry_date=?', (user_id, entry_date)).fetchone()
+            return dict(entry) if entry else None
 
     def get_user_entries(self, user_id, limit=30):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT * FROM entries WHERE user_id=? ORDER BY entry_date DESC LIMIT ?', (user_id, limit))
-        entries = c.fetchall()
-        conn.close()
-        return [dict(entry) for entry in entries]
+        return self.get_entry_history(user_id, limit)['entries']
+
+    def get_entry_history(self, user_id, limit=30, cursor=None, date_from=None, date_to=None, fields=None):
+        """
+        Страница истории записей (от новых к старым): {'entries': [...], 'next_cursor': '...' или None}.
+        Следующая страница запрашивается с cursor=next_cursor; fields — нужные поля (см. entries.HISTORY_FIELDS)
+        """
+        sql, params = entries.history_query(user_id, limit, cursor, date_from, date_to, fields)
+        with self.read_connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        page = [dict(row) for row in rows[:params[-1] - 1]]
+        return {'entries': page, 'next_cursor': entries.encode_cursor(page[-1]) if len(rows) >= params[-1] else None}
+
+    @staticmethod
+    def _range_filter(user_id, date_from, date_to, stage_id, table=''):
+        prefix = f'{table}.' if table else ''
+        where, params = [f'{prefix}user_id=?'], [user_id]
+        if stage_id is not None:
+            where.append(f'{prefix}stage_id=?')
+            params.append(stage_id)
+        if date_from:
+            where.append(f'{prefix}entry_date>=?')
+            params.append(date_from)
+        if date_to:
+            where.append(f'{prefix}entry_date<=?')
+            params.append(date_to)
+        return ' AND '.join(where), params
+
+    def iter_entries(self, user_id, date_from=None, date_to=None, stage_id=None, chunk_size=200):
+        """
+        Записи за период (или за этап) по возрастанию даты. Строки читаются из курсора порциями,
+        поэтому память не зависит от длины периода; все порции берутся из одного снимка базы.
+        """
+        where, params = self._range_filter(user_id, date_from, date_to, stage_id)
+        with self.snapshot_connection() as conn:
+            cursor = conn.execute(f'SELECT * FROM entries WHERE {where} ORDER BY entry_date', params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+
+    def range_version(self, user_id, date_from=None, date_to=None, stage_id=None):
+        """
+        Версия записей за период (или за этап): (число записей, сумма id, последняя версия журнала).
+        Любое изменение записи дает ей версию больше всех прежних, удаление уменьшает число записей;
+        запрос читает только индексы, без JSON записей.
+        """
+        where, params = self._range_filter(user_id, date_from, date_to, stage_id, table='e')
+        with self.snapshot_connection() as conn:
+            row = conn.execute(f'''SELECT COUNT(*), TOTAL(e.id), MAX(c.version) FROM entries e
+                LEFT JOIN change_log c ON c.user_id = e.user_id AND c.kind = 'entry' AND c.row_id = e.id
+                WHERE {where}''', params).fetchone()
+        return row[0], int(row[1]), row[2]
 
+    @write_operation
     def add_product(self, user_id, product_name, calories_per_100g):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('INSERT INTO products (user_id, product_name, calories_per_100g) VALUES (?, ?, ?)',
-                  (user_id, product_name, calories_per_100g))
-        conn.commit()
-        product_id = c.lastrowid
-        conn.close()
-        return product_id
+        with self.connection() as conn:
+            c = conn.cursor()
+            c.execute('INSERT INTO products (user_id, product_name, calories_per_100g, name_norm) VALUES (?, ?, ?, ?)',
+                      (user_id, product_name, calories_per_100g, search.fold_name(product_name)))
+            product_id = c.lastrowid
+            changelog.record(conn, user_id, 'product', [product_id])
+            product = dict(conn.execute('SELECT * FROM products WHERE id=?', (product_id,)).fetchone())
+            # Кэш дополняется на месте, только когда запись уже зафиксирована
+            self.pool.after_commit(lambda: self.product_cache.product_added(user_id, product))
+            return product_id
+
+    @write_operation
+    def import_batch(self, user_id, stages, entries, products, stage_refs=None, default_stage_id=None):
+        """
+        Пишет пачку массового импорта (см. bulk.import_records) одной транзакцией.
+        Возвращает (ссылки на созданные этапы, ошибки строк, число добавленных продуктов).
+        """
+        with self.connection() as conn:
+            new_refs, stage_ids, errors, added_products = bulk.write_batch(conn, user_id, stages, entries, products,
+                                                           stage_refs or {}, default_stage_id)
+            if stage_ids:
+                rollups.rebuild(conn, sorted(stage_ids))
+            if products or entries:
+                self.pool.after_commit(lambda: self.product_cache.invalidate(int(user_id)))
+            if stages:
+                self._notify_stage_changed(user_id)
+            return new_refs, errors, added_products
+
+    def data_version(self, user_id):
+        """(версия данных пользователя, время изменения) из памяти — для условных HTTP-запросов"""
+        return self.versions.get(user_id)
+
+    def get_changes(self, user_id, since=0, limit=changelog.DEFAULT_LIMIT):
+        """Изменения данных пользователя после версии since (см. changelog.changes_since)"""
+        with self.read_connection() as conn:
+            return changelog.changes_since(conn, user_id, since, limit)
+
+    # Таблицы, которые можно выгрузить целиком через iter_rows
+    _EXPORT_QUERIES = {
+        'stages': 'SELECT * FROM stages WHERE user_id=? ORDER BY start_date, id',
+        'products': 'SELECT * FROM products WHERE user_id=? ORDER BY id',
+        'entries': 'SELECT * FROM entries WHERE user_id=? ORDER BY entry_date, stage_id',
+    }
+
+    def iter_rows(self, user_id, table, chunk_size=500):
+        """Все строки пользователя из таблицы порциями из одного снимка — для экспорта"""
+        sql = self._EXPORT_QUERIES[table]
+        with self.read_connection() as conn:
+            cursor = conn.execute(sql, (user_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
 
     def get_user_products(self, user_id):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT * FROM products WHERE user_id=?', (user_id,))
-        products = c.fetchall()
-        conn.close()
-        return [dict(prod) for prod in products]
+        user_id = int(user_id)
+        self.poll_changes(user_id)
+        products = self.product_cache.get_products(user_id)
+        if products is not None:
+            return products
+        token = self.product_cache.token(user_id)
+        with self.read_connection() as conn:
+            products = [dict(prod) for prod in conn.execute('SELECT * FROM products WHERE user_id=?', (user_id,)).fetchall()]
+        self.product_cache.put_products(user_id, products, token)
+        return products
 
-    def search_products(self, user_id, query):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT * FROM products WHERE user_id=? AND product_name LIKE ?', (user_id, f'%{query}%'))
-        products = c.fetchall()
-        conn.close()
-        return [dict(prod) for prod in products]
-
-    def get_weight_statistics(self, user_id, days=30):
-        conn = self.get_conn()
-        c = conn.cursor()
-        c.execute('SELECT entry_date, daily_params FROM entries WHERE user_id=? ORDER BY entry_date DESC LIMIT ?', (user_id, days))
-        rows = c.fetchall()
-        stats = []
-        for row in rows:
-            try:
-                params = json.loads(row['daily_params'])
-            except:
-                params = {}
-            stat = {
-                'date': row['entry_date'],
-                'weight': params.get('morning_weight'),
-                'next_weight': params.get('next_morning_weight'),
-                'lost_weight': params.get('weight_lost'),
-            }
-            stats.append(stat)
-        conn.close()
-        return stats
+    def search_products(self, user_id, query, limit=search.DEFAULT_LIMIT):
+        user_id = int(user_id)
+        key = (search.fold_name(query), search.clamp_limit(limit))
+        self.poll_changes(user_id)
+        products = self.product_cache.get_search(user_id, key)
+        if products is not None:
+            return products
+        token = self.product_cache.token(user_id)
+        with self.read_connection() as conn:
+            products = search.search_products(conn, user_id, query, limit)
+        self.product_cache.put_search(user_id, key, products, token)
+        return products
+
+    def get_weight_statistics(self, user_id, days=30, date_from=None, date_to=None):
+        """
+        Показатели веса и питания по дням, от новых к старым.
+        Без диапазона дат возвращает последние days записей, с диапазоном — все записи в нем.
+        """
+        with self.read_connection() as conn:
+            limit = None if (date_from or date_to) else days
+            return daily_metrics.weight_statistics(conn, user_id, limit, date_from, date_to)
+
+    def get_trends(self, user_id, stage_id=None, date_from=None, date_to=None, goal_weight=None, **options):
+        """Тренды веса и калорий пользователя (см. analytics.compute)"""
+        with self.snapshot_connection() as conn:
+            return analytics.user_trends(conn, user_id, stage_id, date_from, date_to, goal_weight, **options)
+
+    def iter_batch_trends(self, user_ids=None, **options):
+        """Тренды многих пользователей пачками для ночных расчетов"""
+        with self.snapshot_connection() as conn:
+            yield from analytics.batch_trends(conn, user_ids, **options)
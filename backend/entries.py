@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Частичное изменение и обслуживание ежедневных записей.
+Изменения применяются функциями JSON1 внутри SQLite, поэтому правка одного блюда
+не требует пересылать и перезаписывать весь JSON дня из Python.
+"""
+
+import json
+
+import daily_metrics
+import search
+
+# Операции над JSON приемов пищи: set — заменить значение по пути,
+# append — добавить элемент в массив по пути, remove — удалить значение по пути
+MEAL_OPERATIONS = ('set', 'append', 'remove')
+
+
+def json_path(path):
+    """Преобразует путь вида [0, "dishes", 2, "mass"] в путь JSON1: $[0]."dishes"[2]."mass" """
+    if not isinstance(path, (list, tuple)):
+        raise ValueError('Путь должен быть списком индексов и ключей')
+    result = '$'
+    for part in path:
+        if isinstance(part, bool):
+            raise ValueError(f'Недопустимый элемент пути: {part!r}')
+        if isinstance(part, int):
+            if part < 0:
+                raise ValueError(f'Индекс не может быть отрицательным: {part}')
+            result += f'[{part}]'
+        elif isinstance(part, str) and part:
+            result += '."' + part.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        else:
+            raise ValueError(f'Недопустимый элемент пути: {part!r}')
+    return result
+
+
+def build_meals_update(meal_ops):
+    """Собирает вложенное выражение JSON1 для списка операций и его параметры"""
+    expression, params = "COALESCE(meals, '[]')", []
+    for op in meal_ops:
+        if not isinstance(op, dict) or op.get('op') not in MEAL_OPERATIONS:
+            raise ValueError(f"Неизвестная операция, ожидается одна из: {', '.join(MEAL_OPERATIONS)}")
+        path = json_path(op.get('path', []))
+        if op['op'] == 'remove':
+            if path == '$':
+                raise ValueError('Нельзя удалить корень приемов пищи')
+            expression = f'json_remove({expression}, ?)'
+            params.append(path)
+        elif op['op'] == 'set':
+            expression = f'json_set({expression}, ?, json(?))'
+            params += [path, json.dumps(op.get('value'), ensure_ascii=False)]
+        else:
+            expression = f'json_insert({expression}, ?, json(?))'
+            params += [path + '[#]', json.dumps(op.get('value'), ensure_ascii=False)]
+    return expression, params
+
+
+def touched_dish_names(meal_ops):
+    """Названия блюд, которые появились в записи в результате операций"""
+    names = set()
+    for op in meal_ops:
+        value = op.get('value')
+        if isinstance(value, dict):
+            names |= search.dish_names([value])
+        elif isinstance(value, list):
+            names |= search.dish_names(value)
+        elif isinstance(value, str) and op.get('path') and op['path'][-1] in ('name', 'food'):
+            name = search.fold_name(value)
+            if name:
+                names.add(name)
+    return names
+
+
+def patch_entry(conn, user_id, stage_id, entry_date, daily_params=None, meal_ops=(), updated_at=None):
+    """
+    Применяет изменения к записи дня в текущей транзакции, создавая пустую запись при необходимости.
+    daily_params применяется как JSON Merge Patch (значение null удаляет ключ).
+    Возвращает id записи.
+    """
+    meals_expression, meals_params = build_meals_update(meal_ops)
+    update_sql = f'''UPDATE entries
+                      SET daily_params = json_patch(COALESCE(daily_params, '{{}}'), ?),
+                          meals = {meals_expression},
+                          updated_at = ?
+                      WHERE user_id=? AND stage_id=? AND entry_date=?
+                      RETURNING id'''
+    update_params = (json.dumps(daily_params or {}, ensure_ascii=False), *meals_params, updated_at,
+                     user_id, stage_id, entry_date)
+    row = conn.execute(update_sql, update_params).fetchone()
+    if row is None:
+        # Записи за этот день еще нет — создаем пустую и применяем изменения к ней
+        conn.execute('''INSERT INTO entries (user_id, stage_id, entry_date, daily_params, meals, updated_at)
+                        VALUES (?, ?, ?, '{}', '[]', ?)
+                        ON CONFLICT(user_id, stage_id, entry_date) DO NOTHING''',
+                     (user_id, stage_id, entry_date, updated_at))
+        row = conn.execute(update_sql, update_params).fetchone()
+    return row[0]
+
+
+# Поля истории: столбцы записи и материализованные показатели дня (без разбора JSON)
+ENTRY_FIELDS = ('id', 'user_id', 'stage_id', 'entry_date', 'daily_params', 'meals', 'updated_at')
+HISTORY_FIELDS = ENTRY_FIELDS + tuple(daily_metrics.METRIC_COLUMNS)
+MAX_HISTORY_LIMIT = 200
+
+
+def encode_cursor(row):
+    """Курсор страницы истории — дата и id последней выданной записи"""
+    return f"{row['entry_date']}_{row['id']}"
+
+
+def decode_cursor(cursor):
+    entry_date, _, entry_id = str(cursor).rpartition('_')
+    if not entry_date or not entry_id.isdigit():
+        raise ValueError('Некорректный курсор')
+    return entry_date, int(entry_id)
+
+
+def history_query(user_id, limit=30, cursor=None, date_from=None, date_to=None, fields=None):
+    """
+    Запрос страницы истории от новых записей к старым. Продолжение после курсора —
+    по ключу (entry_date, id) через индекс (user_id, entry_date), поэтому страница стоит одинаково
+    на любой глубине. fields — подмножество HISTORY_FIELDS (id и entry_date добавляются всегда).
+    limit меньше 1 или не число — ValueError, больше MAX_HISTORY_LIMIT — урезается.
+    Возвращает (sql, params); запрос выбирает на одну строку больше limit — признак следующей страницы.
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('limit должен быть целым числом') from None
+    if limit < 1:
+        raise ValueError('limit должен быть не меньше 1')
+    fields = list(fields or ENTRY_FIELDS)
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    for field in ('entry_date', 'id'):
+        if field not in fields:
+            fields.insert(0, field)
+    columns = ', '.join(f'e.{field}' if field in ENTRY_FIELDS else f'm.{field}' for field in fields)
+    join = ' LEFT JOIN daily_metrics m ON m.entry_id = e.id' if any(f not in ENTRY_FIELDS for f in fields) else ''
+
+    where, params = ['e.user_id = ?'], [user_id]
+    if date_from:
+        where.append('e.entry_date >= ?')
+        params.append(date_from)
+    if date_to:
+        where.append('e.entry_date <= ?')
+        params.append(date_to)
+    if cursor:
+        where.append('(e.entry_date, e.id) < (?, ?)')
+        params.extend(decode_cursor(cursor))
+    # Слишком большая страница урезается до MAX_HISTORY_LIMIT, клиент продолжит по next_cursor
+    params.append(min(limit, MAX_HISTORY_LIMIT) + 1)
+    sql = (f"SELECT {columns} FROM entries e{join} WHERE {' AND '.join(where)} "
+           f"ORDER BY e.entry_date DESC, e.id DESC LIMIT ?")
+    return sql, params
+
+
+def dedupe_entries(conn):
+    """
+    Оставляет для каждой пары (пользователь, этап, дата) только последнюю сохраненную запись.
+    Возвращает число удаленных строк.
+    """
+    cursor = conn.execute('''DELETE FROM entries WHERE id NOT IN (
+                                 SELECT MAX(id) FROM entries GROUP BY user_id, stage_id, entry_date)''')
+    return cursor.rowcount
+
+
+# Шаги миграции схемы (подключаются в migrations.MIGRATIONS)
+MIGRATION_STEPS = [
+    dedupe_entries,
+    'CREATE UNIQUE INDEX IF NOT EXISTS ux_entries_user_stage_date ON entries(user_id, stage_id, entry_date)',
+]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Служебные команды для обслуживания базы данных
+Пример: python manage.py migrate
+"""
+
+import argparse
+import json
+import sys
+
+import migrations
+import nutrition_ref
+from sharding import ShardedDatabase, open_database
+
+
+def cmd_migrate(db, args):
+    # Шарды применяют миграции уже при открытии, для них здесь выводится версия схемы
+    for database in db.databases():
+        with database.connection() as conn:
+            applied = migrations.apply_migrations(conn)
+            print(f"{database.db_path}: применено миграций: {len(applied)}, "
+                  f"версия схемы: {migrations.current_version(conn)}")
+
+
+def cmd_check_indexes(db, args):
+    db.init_database()
+    failed = False
+    for database in db.databases():
+        with database.connection() as conn:
+            problems = migrations.check_hot_queries(conn)
+        print(database.db_path)
+        for name in migrations.HOT_QUERIES:
+            print(f"{'ОШИБКА' if name in problems else 'OK':7} {name}")
+        for name, plan in problems.items():
+            print(f"\n{name}:\n  " + "\n  ".join(plan))
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+def cmd_compact(db, args):
+    db.init_database()
+    removed = db.compact_entries()
+    print(f"Удалено дублирующихся записей: {removed}")
+    if args.vacuum:
+        for database in db.databases():
+            with database.connection() as conn:
+                conn.execute('VACUUM')
+        print("Файл базы данных сжат (VACUUM)")
+
+
+def compact_arguments(parser):
+    parser.add_argument('--vacuum', action='store_true', help='Сжать файл базы после удаления дублей')
+
+
+def cmd_trends(db, args):
+    db.init_database()
+    out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    count = 0
+    try:
+        # Одна строка JSON на пользователя, чтобы не держать весь результат в памяти
+        for user_id, trends in db.iter_batch_trends(window=args.window, alpha=args.alpha, trend_days=args.trend_days):
+            out.write(json.dumps({'user_id': user_id, 'trends': trends}, ensure_ascii=False) + '\n')
+            count += 1
+    finally:
+        if args.out:
+            out.close()
+    print(f"Рассчитаны тренды для пользователей: {count}", file=sys.stderr)
+
+
+def trends_arguments(parser):
+    parser.add_argument('--out', help='Файл для результатов (NDJSON), по умолчанию stdout')
+    parser.add_argument('--window', type=int, default=7, help='Окно скользящего среднего, дней')
+    parser.add_argument('--alpha', type=float, default=0.3, help='Коэффициент экспоненциального сглаживания')
+    parser.add_argument('--trend-days', type=int, default=28, help='Сколько последних дней учитывать в тренде')
+
+
+def cmd_rebalance(db, args):
+    if not isinstance(db, ShardedDatabase):
+        print("Перенос пользователей доступен только для шардированной базы (--shard-dir)", file=sys.stderr)
+        return 2
+    db.init_database()
+    moves = db.rebalance(dry_run=args.dry_run)
+    for user_id, source, target in moves:
+        print(f"Пользователь {user_id}: шард {source} -> {target}")
+    print(f"{'Нужно перенести' if args.dry_run else 'Перенесено'} пользователей: {len(moves)}")
+
+
+def rebalance_arguments(parser):
+    parser.add_argument('--dry-run', action='store_true', help='Только показать, кого нужно перенести')
+
+
+def cmd_import_shards(db, args):
+    if not isinstance(db, ShardedDatabase):
+        print("Укажите каталог шардов: --shard-dir", file=sys.stderr)
+        return 2
+    db.init_database()
+    imported = db.import_database(args.source)
+    print(f"Перенесено пользователей из {args.source}: {imported}")
+
+
+def import_shards_arguments(parser):
+    parser.add_argument('source', help='Файл обычной (нешардированной) базы')
+
+
+def cmd_build_reference(db, args):
+    rows, skipped = nutrition_ref.read_csv(args.csv, delimiter=args.delimiter)
+    count = nutrition_ref.build(rows, args.out)
+    print(f"Справочник {args.out}: позиций {count}, пропущено строк {skipped}, "
+          f"повторов названия {len(rows) - count}")
+    print("Воркеры сервера увидят новый справочник после перезапуска")
+
+
+def build_reference_arguments(parser):
+    parser.add_argument('csv', help='CSV с колонками name, calories_per_100g и необязательными protein, fat, carbs')
+    parser.add_argument('--out', default='nutrition_ref.bin', help='Файл справочника (как NUTRITION_REF_PATH)')
+    parser.add_argument('--delimiter', default=',', help='Разделитель колонок CSV')
+
+
+COMMANDS = {
+    'migrate': (cmd_migrate, 'Применить недостающие миграции схемы', None),
+    'check-indexes': (cmd_check_indexes, 'Проверить планы частых запросов (EXPLAIN QUERY PLAN)', None),
+    'compact': (cmd_compact, 'Удалить дубли ежедневных записей', compact_arguments),
+    'trends': (cmd_trends, 'Пакетный расчет трендов всех пользователей (для ночных заданий)', trends_arguments),
+    'rebalance': (cmd_rebalance, 'Разложить пользователей по шардам согласно --shard-buckets', rebalance_arguments),
+    'import-shards': (cmd_import_shards, 'Перенести пользователей из обычной базы в шарды', import_shards_arguments),
+    'build-reference': (cmd_build_reference, 'Собрать общий справочник продуктов из CSV', build_reference_arguments),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Обслуживание дневника питания')
+    parser.add_argument('--db', default='db.sqlite3', help='Путь к файлу базы данных')
+    parser.add_argument('--shard-dir', help='Каталог шардированной базы (вместо --db)')
+    parser.add_argument('--shard-buckets', type=int, default=16,
+                        help='Число шардов-корзин; 0 — отдельный шард на каждого пользователя')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, (func, help_text, arguments) in COMMANDS.items():
+        command_parser = sub.add_parser(name, help=help_text)
+        if arguments:
+            arguments(command_parser)
+    args = parser.parse_args(argv)
+
+    db = open_database(args.db, shard_dir=args.shard_dir, shard_buckets=args.shard_buckets or None)
+    try:
+        return COMMANDS[args.command][0](db, args) or 0
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики приложения в формате Prometheus: задержки маршрутов, время SQL-запросов, рендер отчетов.
+Гистограммы с фиксированными корзинами: наблюдение — поиск корзины и пара сложений под
+блокировкой, поэтому сбор можно держать включенным постоянно. Перцентили (p50/p95/p99)
+оцениваются по корзинам линейной интерполяцией.
+Медленные SQL-запросы пишутся в журнал (логгер nutrition.sql) и хранятся в последних SLOW_QUERY_KEEP.
+"""
+
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+# Корзины в секундах
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+REPORT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+SLOW_QUERY_KEEP = 100
+
+logger = logging.getLogger('nutrition.sql')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Последняя ячейка — значения больше последней границы (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Оценка перцентиля: корзина, в которую попадает ранг, и интерполяция внутри нее"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Family:
+    """Метрика с набором меток: гистограмма или счетчик на каждое сочетание значений меток"""
+
+    def __init__(self, name, help_text, kind, label_names, buckets=None):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            child = self._children.get(label_values)
+            if child is None:
+                child = self._children[label_values] = Histogram(self.buckets)
+            child.observe(value)
+
+    def inc(self, *label_values, value=1):
+        with self._lock:
+            self._children[label_values] = self._children.get(label_values, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            if self.kind == 'counter':
+                return dict(self._children)
+            return {labels: (list(h.counts), h.count, h.sum, {q: h.quantile(q) for q in QUANTILES})
+                    for labels, h in self._children.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, data in sorted(self.snapshot().items()):
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{_labels(self.label_names, labels)} {data}')
+                continue
+            counts, count, total, _ = data
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        if self.kind == 'histogram':
+            # Оценки перцентилей — для просмотра без Prometheus
+            name = f'{self.name}_quantile'
+            lines += [f'# HELP {name} Оценка перцентиля {self.name} по корзинам', f'# TYPE {name} gauge']
+            for labels, (_, _, _, quantiles) in sorted(self.snapshot().items()):
+                for q, value in quantiles.items():
+                    if value is not None:
+                        lines.append(f'{name}{_labels(self.label_names, labels, [("quantile", q)])} {value:.6f}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = []
+        self._stats = []
+
+    def histogram(self, name, help_text, label_names=(), buckets=REQUEST_BUCKETS):
+        family = Family(name, help_text, 'histogram', label_names, buckets)
+        self._families.append(family)
+        return family
+
+    def counter(self, name, help_text, label_names=()):
+        family = Family(name, help_text, 'counter', label_names)
+        self._families.append(family)
+        return family
+
+    def stats_gauges(self, prefix, help_text, stats):
+        """Числовые поля словаря stats() (статистика кэша, писателя) становятся gauge {prefix}_{поле}"""
+        self._stats.append((prefix, help_text, stats))
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for family in self._families:
+            lines += family.render()
+        for prefix, help_text, stats in self._stats:
+            try:
+                values = stats()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines += [f'# HELP {prefix}_{key} {help_text}', f'# TYPE {prefix}_{key} gauge',
+                              f'{prefix}_{key} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests = registry.histogram('http_request_duration_seconds', 'Время обработки запроса',
+                              ('route', 'method'))
+request_errors = registry.counter('http_request_errors_total', 'Ответы с кодом 5xx', ('route', 'method'))
+queries = registry.histogram('sql_query_duration_seconds', 'Время выполнения SQL-выражения вместе с выборкой строк',
+                             ('statement',), SQL_BUCKETS)
+slow_query_count = registry.counter('sql_slow_queries_total', 'Медленные SQL-выражения', ('statement',))
+reports = registry.histogram('report_render_seconds', 'Время рендера отчета', ('kind', 'format'), REPORT_BUCKETS)
+report_jobs = registry.histogram('report_job_seconds', 'Время задания отчета от постановки до результата',
+                                 ('kind', 'format', 'status'), REPORT_BUCKETS)
+
+slow_query_seconds = 0.1
+_slow_queries = deque(maxlen=SLOW_QUERY_KEEP)
+
+_STATEMENT = re.compile(r'^\s*(UPDATE)\s+(\w+)|^\s*(\w+).*?\b(?:FROM|INTO|TABLE|INDEX)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?["\[]?(\w+)',
+                        re.IGNORECASE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=2048)
+def statement_label(sql):
+    """Короткая метка выражения с ограниченным числом значений: 'SELECT entries', 'PRAGMA'"""
+    match = _STATEMENT.match(sql)
+    if match:
+        verb, table = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+        return f'{verb.upper()} {table}'
+    word = sql.split(None, 1)
+    return word[0].upper() if word else ''
+
+
+def observe_query(sql, seconds):
+    label = statement_label(sql)
+    queries.observe(label, value=seconds)
+    if seconds >= slow_query_seconds:
+        slow_query_count.inc(label)
+        _slow_queries.append({'sql': ' '.join(sql.split())[:500], 'ms': round(seconds * 1000, 2),
+                              'at': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        logger.warning('Медленный запрос %.1f мс: %s', seconds * 1000, ' '.join(sql.split())[:500])
+
+
+def slow_queries():
+    """Последние медленные запросы, новые первыми"""
+    return list(reversed(_slow_queries))
+
+
+def observe_request(route, method, status, seconds):
+    requests.observe(route, method, value=seconds)
+    if status >= 500:
+        request_errors.inc(route, method)
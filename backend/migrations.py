@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Версионные миграции схемы базы данных.
+Каждая миграция применяется один раз в своей транзакции, номер записывается в schema_version.
+Шаг миграции — SQL-выражение или функция, принимающая соединение.
+"""
+
+from datetime import datetime
+
+import changelog
+import daily_metrics
+import entries
+import rollups
+import search
+
+
+def add_column(table, column, declaration):
+    """Шаг миграции: добавляет столбец, если его еще нет"""
+    def step(conn):
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+    return step
+
+
+MIGRATIONS = [
+    (1, 'Индексы для частых запросов дневника', [
+        'CREATE INDEX IF NOT EXISTS idx_entries_user_date ON entries(user_id, entry_date)',
+        'CREATE INDEX IF NOT EXISTS idx_stages_user_completed ON stages(user_id, completed)',
+        'CREATE INDEX IF NOT EXISTS idx_products_user_name ON products(user_id, product_name)',
+    ]),
+    (2, 'Нормализованные названия и полнотекстовый поиск продуктов', [
+        add_column('products', 'name_norm', 'TEXT'),
+        add_column('products', 'last_used', 'TEXT'),
+        *search.MIGRATION_STEPS,
+    ]),
+    (3, 'Одна запись на день: удаление дублей и уникальный индекс', [
+        add_column('entries', 'updated_at', 'TEXT'),
+        *entries.MIGRATION_STEPS,
+    ]),
+    (4, 'Материализованные показатели дня', daily_metrics.MIGRATION_STEPS),
+    (5, 'Инкрементальные итоги этапов', rollups.MIGRATION_STEPS),
+    (6, 'Журнал изменений для синхронизации', changelog.MIGRATION_STEPS),
+    (7, 'Триграммный индекс продуктов с ключом по пользователю', search.TRIGRAM_MIGRATION_STEPS),
+]
+
+# Запросы, которые обязаны использовать индекс (проверяется командой manage.py check-indexes и тестами)
+HOT_QUERIES = {
+    'get_entry_by_date': ('SELECT * FROM entries WHERE user_id=? AND entry_date=?', (1, '2025-01-01')),
+    'get_user_entries': entries.history_query(1, 30),
+    'get_entry_history': entries.history_query(1, 30, '2025-01-01_100', fields=['weight']),
+    'get_active_stage': ('SELECT * FROM stages WHERE user_id=? AND completed=0', (1,)),
+    'get_weight_statistics': ('SELECT * FROM daily_metrics WHERE user_id=? AND entry_date >= ? AND entry_date <= ? '
+                              'ORDER BY entry_date DESC', (1, '2025-01-01', '2025-12-31')),
+    'get_user_products': ('SELECT * FROM products WHERE user_id=?', (1,)),
+    'get_changes': ('SELECT version, kind, row_id, op FROM change_log WHERE user_id=? AND version>? '
+                    'ORDER BY version LIMIT ?', (1, 0, 500)),
+    # Поиск продуктов: ранжируются не больше search.CANDIDATES кандидатов каждого вида,
+    # поэтому проверяются запросы отбора кандидатов и выдача для пустой строки
+    'search_products_recent': search.recent_query(1),
+    'search_products_prefix': search.candidate_queries(1, 'кур')['prefix'],
+    'search_products_substring': search.candidate_queries(1, 'грудка')['substring'],
+}
+
+
+def current_version(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn, migrations=MIGRATIONS):
+    """Применяет недостающие миграции по порядку, возвращает список применённых номеров"""
+    applied = []
+    if conn.in_transaction:
+        conn.commit()
+    current_version(conn)
+    for version, name, steps in sorted(migrations, key=lambda m: m[0]):
+        # BEGIN IMMEDIATE не дает двум процессам одновременно применить одну миграцию
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                         (version, name, datetime.now().isoformat(timespec='seconds')))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    if applied:
+        # Обновляем статистику планировщика после изменения индексов
+        conn.execute('ANALYZE')
+        conn.commit()
+    return applied
+
+
+def explain(conn, sql, params=()):
+    """Возвращает строки EXPLAIN QUERY PLAN для запроса"""
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+
+def check_hot_queries(conn, queries=HOT_QUERIES):
+    """Возвращает {имя: план} для запросов, которые сканируют таблицу без индекса"""
+    problems = {}
+    for name, (sql, params) in queries.items():
+        plan = explain(conn, sql, params)
+        if any(step.startswith('SCAN') and 'USING' not in step for step in plan) \
+                or any('USE TEMP B-TREE' in step for step in plan):
+            problems[name] = plan
+    return problems
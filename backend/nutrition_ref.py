@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Общий справочник продуктов: сотни тысяч позиций с калорийностью и БЖУ на 100 г, только для чтения.
+Справочник собирается из CSV командой python manage.py build-reference и хранится одним бинарным
+файлом, который открывается через mmap. Страницы файла берутся из страничного кэша ОС и общие
+для всех воркеров сервера; при открытии читается только заголовок, поэтому загрузки нет.
+
+Формат файла (little-endian):
+    заголовок   HEADER: сигнатура, версия, число записей, число слов, смещение пула строк
+    записи      RECORD × count, отсортированы по нормализованному названию (search.fold_name)
+    слова       WORD × words — начало каждого слова после первого, отсортированы по остатку названия
+    пул строк   для каждой записи: нормализованное название, затем исходное (UTF-8)
+
+Поиск — двоичный поиск прямо по отображенному файлу: по записям для префикса названия
+('кур' -> 'Курица грудка') и по словам для префикса любого слова ('груд' -> 'Курица грудка').
+Порядок байтов UTF-8 совпадает с порядком строк Python, поэтому сравниваются байты.
+"""
+
+import csv
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+from search import DEFAULT_LIMIT, clamp_limit, fold_name
+
+MAGIC = b'NUTRREF\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIIQ')
+# Смещение названия в пуле, длины нормализованного и исходного названия, ккал, белки, жиры, углеводы
+RECORD = struct.Struct('<IHHffff')
+# Номер записи и смещение начала слова в нормализованном названии
+WORD = struct.Struct('<IH')
+
+MAX_NAME_BYTES = 0xFFFF
+MAX_POOL_BYTES = 0xFFFFFFFF
+
+# Необязательные колонки CSV; отсутствующее значение хранится как NaN
+MACRO_COLUMNS = ('protein', 'fat', 'carbs')
+
+RANK_EXACT, RANK_PREFIX, RANK_WORD = 0, 1, 2
+
+
+class ReferenceFormatError(ValueError):
+    """Файл не является справочником этой версии"""
+
+
+def _number(value):
+    if value is None or str(value).strip() == '':
+        return math.nan
+    return float(str(value).strip().replace(',', '.'))
+
+
+def read_csv(path, delimiter=','):
+    """
+    Строки справочника из CSV с заголовком: name, calories_per_100g и необязательные protein, fat, carbs.
+    Возвращает (записи, пропущено) — пропускаются строки без названия или с неверными числами.
+    """
+    rows, skipped = [], 0
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f, delimiter=delimiter)
+        missing = {'name', 'calories_per_100g'} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"В CSV нет колонок: {', '.join(sorted(missing))}")
+        for row in reader:
+            name = ' '.join((row.get('name') or '').split())
+            try:
+                calories = _number(row.get('calories_per_100g'))
+                macros = [_number(row.get(column)) for column in MACRO_COLUMNS]
+            except ValueError:
+                skipped += 1
+                continue
+            if not name or math.isnan(calories) or calories < 0:
+                skipped += 1
+                continue
+            rows.append((name, calories, *macros))
+    return rows, skipped
+
+
+def build(rows, out_path):
+    """
+    Компилирует справочник из строк (название, ккал, белки, жиры, углеводы) в файл out_path.
+    Повторы названия (после нормализации) отбрасываются, остается первое. Файл пишется рядом
+    и подменяется атомарно: уже открытые отображения продолжают читать прежнюю версию.
+    Возвращает число записей в справочнике.
+    """
+    items = {}
+    for name, calories, protein, fat, carbs in rows:
+        norm = fold_name(name).encode('utf-8')
+        raw = name.encode('utf-8')
+        if not norm or len(norm) > MAX_NAME_BYTES or len(raw) > MAX_NAME_BYTES or norm in items:
+            continue
+        items[norm] = (raw, calories, protein, fat, carbs)
+    norms = sorted(items)
+
+    records, words, pool = [], [], bytearray()
+    for index, norm in enumerate(norms):
+        raw, calories, protein, fat, carbs = items[norm]
+        records.append(RECORD.pack(len(pool), len(norm), len(raw), calories, protein, fat, carbs))
+        pool += norm
+        pool += raw
+        start = norm.find(b' ')
+        while start != -1:
+            words.append((norm[start + 1:], index, start + 1))
+            start = norm.find(b' ', start + 1)
+    if len(pool) > MAX_POOL_BYTES:
+        raise ValueError('Справочник слишком большой для формата: пул строк больше 4 ГБ')
+    words.sort()
+
+    pool_offset = HEADER.size + len(records) * RECORD.size + len(words) * WORD.size
+    directory = os.path.dirname(os.path.abspath(out_path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.nutrition-ref-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), len(words), pool_offset))
+            f.write(b''.join(records))
+            f.write(b''.join(WORD.pack(index, offset) for _, index, offset in words))
+            f.write(pool)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(records)
+
+
+class NutritionReference:
+    """Справочник, отображенный в память; потокобезопасен, так как только читает"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < HEADER.size:
+                raise ReferenceFormatError(f'{path}: файл слишком короткий')
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.words, self._pool = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ReferenceFormatError(f'{path}: не справочник продуктов версии {VERSION}')
+        self._words_offset = HEADER.size + self.count * RECORD.size
+        if self._words_offset + self.words * WORD.size != self._pool or self._pool > self.size:
+            self._mm.close()
+            raise ReferenceFormatError(f'{path}: поврежденный заголовок')
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Двоичный поиск читает страницы вразброс, упреждающее чтение только мешает
+            self._mm.madvise(mmap.MADV_RANDOM)
+
+    def close(self):
+        self._mm.close()
+
+    def __len__(self):
+        return self.count
+
+    def stats(self):
+        return {'items': self.count, 'words': self.words, 'bytes': self.size}
+
+    # ---------- чтение записей ----------
+
+    def _record(self, index):
+        return RECORD.unpack_from(self._mm, HEADER.size + index * RECORD.size)
+
+    def _norm(self, index, skip=0):
+        offset, norm_len = self._record(index)[:2]
+        start = self._pool + offset
+        return self._mm[start + skip:start + norm_len]
+
+    def _word(self, position):
+        index, skip = WORD.unpack_from(self._mm, self._words_offset + position * WORD.size)
+        return index, self._norm(index, skip)
+
+    def _item(self, index, rank):
+        offset, norm_len, name_len, calories, protein, fat, carbs = self._record(index)
+        start = self._pool + offset + norm_len
+        return {
+            'id': None,
+            'user_id': None,
+            'product_name': self._mm[start:start + name_len].decode('utf-8'),
+            'calories_per_100g': round(calories, 2),
+            'protein': None if math.isnan(protein) else round(protein, 2),
+            'fat': None if math.isnan(fat) else round(fat, 2),
+            'carbs': None if math.isnan(carbs) else round(carbs, 2),
+            'last_used': None,
+            'match_rank': rank,
+            'source': 'reference',
+        }
+
+    @staticmethod
+    def _lower_bound(key, count, value):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if key(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # ---------- поиск ----------
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """
+        Позиции справочника по префиксу названия, затем по префиксу любого слова названия.
+        Внутри каждой группы — по алфавиту; точное совпадение идет первым.
+        """
+        prefix = fold_name(query).encode('utf-8')
+        limit = clamp_limit(limit)
+        if not prefix:
+            return []
+
+        found, seen = [], set()
+        index = self._lower_bound(self._norm, self.count, prefix)
+        while index < self.count and len(found) < limit:
+            norm = self._norm(index)
+            if not norm.startswith(prefix):
+                break
+            found.append(self._item(index, RANK_EXACT if norm == prefix else RANK_PREFIX))
+            seen.add(index)
+            index += 1
+
+        position = self._lower_bound(lambda p: self._word(p)[1], self.words, prefix)
+        while position < self.words and len(found) < limit:
+            index, rest = self._word(position)
+            if not rest.startswith(prefix):
+                break
+            # В одном названии могут быть два слова с этим префиксом
+            if index not in seen:
+                found.append(self._item(index, RANK_WORD))
+                seen.add(index)
+            position += 1
+        return found
+
+
+def open_reference(path):
+    """Справочник по пути или None, если файла нет (справочник не собран)"""
+    if not path or not os.path.exists(path):
+        return None
+    return NutritionReference(path)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая запись многостраничного PDF без сторонних библиотек.
+Каждая страница записывается в файл сразу после заполнения; в памяти остаются только
+смещения объектов и номера страниц. Для кириллицы встраивается TrueType-шрифт
+(путь из REPORT_PDF_FONT или DejaVu Sans из системы), без него используется Helvetica
+с транслитерацией. Из шрифта встраиваются только глифы, которые есть в документе (подмножество),
+номера глифов при этом сохраняются.
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 в пунктах
+MARGIN = 40
+
+FONT_CANDIDATES = (
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/Library/Fonts/Arial Unicode.ttf',
+    'C:\\Windows\\Fonts\\arial.ttf',
+)
+
+# Таблицы шрифта, нужные для CIDFontType2 с CIDToGIDMap /Identity; cmap, имена и таблицы
+# типографики в подмножество не попадают
+SUBSET_TABLES = ('head', 'hhea', 'maxp', 'hmtx', 'loca', 'glyf', 'cvt ', 'fpgm', 'prep')
+
+# Флаги составного глифа
+_ARG_1_AND_2_ARE_WORDS = 0x0001
+_WE_HAVE_A_SCALE = 0x0008
+_MORE_COMPONENTS = 0x0020
+_WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+_WE_HAVE_A_TWO_BY_TWO = 0x0080
+
+_TRANSLIT = dict(zip(
+    'абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ',
+    ['a', 'b', 'v', 'g', 'd', 'e', 'e', 'zh', 'z', 'i', 'y', 'k', 'l', 'm', 'n', 'o', 'p', 'r', 's', 't',
+     'u', 'f', 'kh', 'ts', 'ch', 'sh', 'shch', '', 'y', '', 'e', 'yu', 'ya',
+     'A', 'B', 'V', 'G', 'D', 'E', 'E', 'Zh', 'Z', 'I', 'Y', 'K', 'L', 'M', 'N', 'O', 'P', 'R', 'S', 'T',
+     'U', 'F', 'Kh', 'Ts', 'Ch', 'Sh', 'Shch', '', 'Y', '', 'E', 'Yu', 'Ya']))
+
+
+def find_font():
+    path = os.environ.get('REPORT_PDF_FONT')
+    if path and os.path.exists(path):
+        return path
+    return next((p for p in FONT_CANDIDATES if os.path.exists(p)), None)
+
+
+class TrueTypeFont:
+    """Минимальный разбор TrueType: таблица cmap (Unicode -> glyph id), ширины глифов и метрики"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.size = len(data)
+        num_tables = struct.unpack_from('>H', data, 4)[0]
+        tables = {}
+        for i in range(num_tables):
+            tag, _, offset, length = struct.unpack_from('>4sIII', data, 12 + 16 * i)
+            tables[tag.decode('latin-1')] = (offset, length)
+
+        head = tables['head'][0]
+        self.units_per_em = struct.unpack_from('>H', data, head + 18)[0]
+        self.bbox = struct.unpack_from('>hhhh', data, head + 36)
+        self.index_to_loc_format = struct.unpack_from('>h', data, head + 50)[0]
+        hhea = tables['hhea'][0]
+        self.ascent, self.descent = struct.unpack_from('>hh', data, hhea + 4)
+        number_of_hmetrics = struct.unpack_from('>H', data, hhea + 34)[0]
+        num_glyphs = self.num_glyphs = struct.unpack_from('>H', data, tables['maxp'][0] + 4)[0]
+        self.tables = tables
+
+        hmtx = tables['hmtx'][0]
+        advances = [struct.unpack_from('>H', data, hmtx + 4 * i)[0] for i in range(number_of_hmetrics)]
+        advances += [advances[-1]] * (num_glyphs - number_of_hmetrics)
+        self.advances = advances
+        self.cmap = self._read_cmap(data, tables['cmap'][0])
+        if self.cmap is None:
+            raise ValueError(f'В шрифте {os.path.basename(path)} нет Unicode-таблицы cmap')
+
+    @staticmethod
+    def _read_cmap(data, cmap):
+        """Unicode -> glyph id из первой подходящей подтаблицы cmap; None, если такой нет"""
+        count = struct.unpack_from('>H', data, cmap + 2)[0]
+        subtables = {}
+        for i in range(count):
+            platform, encoding, offset = struct.unpack_from('>HHI', data, cmap + 4 + 8 * i)
+            subtables[(platform, encoding)] = cmap + offset
+        mapping = {}
+        for key in ((3, 10), (0, 4), (3, 1), (0, 3)):
+            if key not in subtables:
+                continue
+            offset = subtables[key]
+            fmt = struct.unpack_from('>H', data, offset)[0]
+            if fmt == 12:
+                groups = struct.unpack_from('>I', data, offset + 12)[0]
+                for g in range(groups):
+                    start, end, glyph = struct.unpack_from('>III', data, offset + 16 + 12 * g)
+                    for code in range(start, end + 1):
+                        mapping[code] = glyph + code - start
+                return mapping
+            if fmt == 4:
+                seg_count = struct.unpack_from('>H', data, offset + 6)[0] // 2
+                ends = offset + 14
+                starts = ends + 2 * seg_count + 2
+                deltas = starts + 2 * seg_count
+                range_offsets = deltas + 2 * seg_count
+                for s in range(seg_count):
+                    end = struct.unpack_from('>H', data, ends + 2 * s)[0]
+                    start = struct.unpack_from('>H', data, starts + 2 * s)[0]
+                    delta = struct.unpack_from('>h', data, deltas + 2 * s)[0]
+                    range_offset = struct.unpack_from('>H', data, range_offsets + 2 * s)[0]
+                    for code in range(start, end + 1):
+                        if code == 0xFFFF:
+                            continue
+                        if range_offset == 0:
+                            glyph = (code + delta) & 0xFFFF
+                        else:
+                            address = range_offsets + 2 * s + range_offset + 2 * (code - start)
+                            glyph = struct.unpack_from('>H', data, address)[0]
+                            if glyph:
+                                glyph = (glyph + delta) & 0xFFFF
+                        if glyph:
+                            mapping[code] = glyph
+                return mapping
+        return None
+
+    def width(self, glyph):
+        """Ширина глифа в тысячных долях кегля"""
+        return self.advances[glyph] * 1000 // self.units_per_em
+
+    def subset(self, glyphs):
+        """
+        Файл шрифта только с глифами glyphs (и глифами, из которых они составлены).
+        Остальные глифы становятся пустыми, номера не меняются, поэтому ширины и коды в тексте остаются прежними.
+        Шрифт без таблиц glyf/loca (например, с контурами CFF) возвращается целиком.
+        """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if 'glyf' not in self.tables or 'loca' not in self.tables:
+            return data
+        glyf = self.tables['glyf'][0]
+        count = self.num_glyphs + 1
+        if self.index_to_loc_format == 0:
+            offsets = [2 * v for v in struct.unpack_from(f'>{count}H', data, self.tables['loca'][0])]
+        else:
+            offsets = list(struct.unpack_from(f'>{count}I', data, self.tables['loca'][0]))
+
+        keep, pending = set(), [0, *glyphs]
+        while pending:
+            glyph = pending.pop()
+            if glyph in keep or glyph >= self.num_glyphs:
+                continue
+            keep.add(glyph)
+            start, end = glyf + offsets[glyph], glyf + offsets[glyph + 1]
+            if end - start >= 10 and struct.unpack_from('>h', data, start)[0] < 0:
+                pending += _components(data, start + 10)
+
+        glyph_data, loca = bytearray(), []
+        for glyph in range(self.num_glyphs):
+            loca.append(len(glyph_data))
+            if glyph in keep:
+                glyph_data += data[glyf + offsets[glyph]:glyf + offsets[glyph + 1]]
+                glyph_data += b'\0' * (-len(glyph_data) % 4)
+        loca.append(len(glyph_data))
+
+        tables = {tag: data[offset:offset + length] for tag, (offset, length) in self.tables.items()
+                  if tag in SUBSET_TABLES}
+        head = bytearray(tables['head'])
+        head[8:12] = bytes(4)  # checkSumAdjustment пересчитывается для нового файла
+        struct.pack_into('>h', head, 50, 1)  # loca в длинном формате
+        tables.update(head=bytes(head), glyf=bytes(glyph_data), loca=struct.pack(f'>{count}I', *loca))
+        return _sfnt(tables)
+
+
+class PdfStreamWriter:
+    def __init__(self, path, title='', font_size=9, leading=12, font_path=None):
+        self._file = open(path, 'wb')
+        self._offsets = {}
+        self._next_id = 1
+        self._pages = []
+        self.font_size = font_size
+        self.leading = leading
+        self.title = title
+
+        self._catalog_id = self._reserve()
+        self._pages_id = self._reserve()
+        self._font_id = self._reserve()
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._write_object(self._catalog_id, f'<< /Type /Catalog /Pages {self._pages_id} 0 R >>'.encode())
+
+        font_path = font_path or find_font()
+        self.font = TrueTypeFont(font_path) if font_path else None
+        self._used_glyphs = {}
+
+        self._lines = []
+        self._y = PAGE_HEIGHT - MARGIN
+
+    # ---------- низкоуровневая запись ----------
+
+    def _reserve(self):
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write(self, data):
+        self._file.write(data)
+
+    def _write_object(self, object_id, body):
+        self._offsets[object_id] = self._file.tell()
+        self._write(f'{object_id} 0 obj\n'.encode() + body + b'\nendobj\n')
+
+    def _write_stream(self, object_id, data, extra=''):
+        compressed = zlib.compress(data, 6)
+        self._write_object(object_id, f'<< /Length {len(compressed)} /Filter /FlateDecode {extra}>>\nstream\n'.encode()
+                           + compressed + b'\nendstream')
+
+    def _write_font_file(self, object_id):
+        # Подмножество шрифта известно только после всех страниц, поэтому шрифт пишется при закрытии
+        data = self.font.subset(self._used_glyphs)
+        self._write_stream(object_id, data, f'/Length1 {len(data)} ')
+
+    # ---------- текст ----------
+
+    def _encode(self, text):
+        if self.font is None:
+            text = ''.join(_TRANSLIT.get(ch, ch) for ch in text)
+            data = text.encode('cp1252', 'replace')
+            return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+        glyphs = []
+        for ch in text:
+            glyph = self.font.cmap.get(ord(ch), 0)
+            self._used_glyphs.setdefault(glyph, ch)
+            glyphs.append(glyph)
+        return b'<' + ''.join(f'{g:04X}' for g in glyphs).encode() + b'>'
+
+    def text_width(self, text, size=None):
+        size = size or self.font_size
+        if self.font is None:
+            return len(text) * 0.5 * size
+        return sum(self.font.width(self.font.cmap.get(ord(ch), 0)) for ch in text) * size / 1000
+
+    def fit(self, text, width, size=None):
+        """Обрезает текст до ширины колонки"""
+        text = '' if text is None else str(text)
+        if self.text_width(text, size) <= width:
+            return text
+        while text and self.text_width(text + '…', size) > width:
+            text = text[:-1]
+        return text + '…'
+
+    def line(self, cells, size=None):
+        """
+        Добавляет строку; cells — список (x от левого поля, текст, ширина колонки или None).
+        При заполнении страницы она сразу записывается в файл.
+        """
+        size = size or self.font_size
+        leading = self.leading * size / self.font_size
+        if self._y - leading < MARGIN:
+            self.flush_page()
+        self._y -= leading
+        for x, text, width in cells:
+            text = self.fit(text, width, size) if width else str(text)
+            if text:
+                self._lines.append((MARGIN + x, self._y, size, self._encode(text)))
+
+    def gap(self, points):
+        self._y -= points
+
+    def flush_page(self):
+        if not self._lines and self._pages:
+            return
+        content = [b'BT']
+        for x, y, size, encoded in self._lines:
+            content.append(f'/F1 {size:g} Tf 1 0 0 1 {x:.2f} {y:.2f} Tm '.encode() + encoded + b' Tj')
+        content.append(b'ET')
+        content_id, page_id = self._reserve(), self._reserve()
+        self._write_stream(content_id, b'\n'.join(content))
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent {self._pages_id} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 {self._font_id} 0 R >> >> /Contents {content_id} 0 R >>').encode())
+        self._pages.append(page_id)
+        self._lines = []
+        self._y = PAGE_HEIGHT - MARGIN
+
+    # ---------- завершение ----------
+
+    def _write_fonts(self):
+        if self.font is None:
+            self._write_object(self._font_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+                                              b'/Encoding /WinAnsiEncoding >>')
+            return
+        font_file_id, descriptor_id = self._reserve(), self._reserve()
+        cid_font_id, to_unicode_id = self._reserve(), self._reserve()
+        self._write_font_file(font_file_id)
+        glyphs = sorted(self._used_glyphs)
+        # Имя подмножества по стандарту PDF: шесть заглавных букв и «+»
+        tag = ''.join(chr(ord('A') + b % 26) for b in hashlib.sha1(repr(glyphs).encode()).digest()[:6])
+        name = f'{tag}+ReportFont'
+        scale = 1000 / self.font.units_per_em
+        bbox = ' '.join(str(int(v * scale)) for v in self.font.bbox)
+        self._write_object(descriptor_id, (
+            f'<< /Type /FontDescriptor /FontName /{name} /Flags 32 /FontBBox [{bbox}] /ItalicAngle 0 '
+            f'/Ascent {int(self.font.ascent * scale)} /Descent {int(self.font.descent * scale)} '
+            f'/CapHeight {int(self.font.ascent * scale)} /StemV 80 /FontFile2 {font_file_id} 0 R >>').encode())
+        widths = ' '.join(f'{g} [{self.font.width(g)}]' for g in glyphs)
+        self._write_object(cid_font_id, (
+            f'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{name} '
+            f'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> '
+            f'/FontDescriptor {descriptor_id} 0 R /DW 1000 /W [{widths}] /CIDToGIDMap /Identity >>').encode())
+        # ToUnicode нужен, чтобы текст из PDF можно было копировать и искать
+        mappings = '\n'.join(f'<{g:04X}> <{"".join(f"{u:04X}" for u in _utf16(ch))}>'
+                             for g, ch in self._used_glyphs.items())
+        cmap = ('/CIDInit /ProcSet findresource begin 12 dict begin begincmap '
+                '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def '
+                '/CMapName /Adobe-Identity-UCS def /CMapType 2 def '
+                '1 begincodespacerange <0000> <FFFF> endcodespacerange\n'
+                f'{len(self._used_glyphs)} beginbfchar\n{mappings}\nendbfchar\n'
+                'endcmap CMapName currentdict /CMap defineresource pop end end')
+        self._write_stream(to_unicode_id, cmap.encode())
+        self._write_object(self._font_id, (
+            f'<< /Type /Font /Subtype /Type0 /BaseFont /{name} /Encoding /Identity-H '
+            f'/DescendantFonts [{cid_font_id} 0 R] /ToUnicode {to_unicode_id} 0 R >>').encode())
+
+    def close(self):
+        if self._lines or not self._pages:
+            self.flush_page()
+        self._write_fonts()
+        kids = ' '.join(f'{page} 0 R' for page in self._pages)
+        self._write_object(self._pages_id, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>'.encode())
+        info_id = self._reserve()
+        title = self.title.encode('utf-16-be').hex().upper()
+        self._write_object(info_id, f'<< /Title <FEFF{title}> /Producer (nutrition-diary) >>'.encode())
+
+        xref_offset = self._file.tell()
+        self._write(f'xref\n0 {self._next_id}\n0000000000 65535 f \n'.encode())
+        for object_id in range(1, self._next_id):
+            self._write(f'{self._offsets[object_id]:010d} 00000 n \n'.encode())
+        self._write(f'trailer\n<< /Size {self._next_id} /Root {self._catalog_id} 0 R /Info {info_id} 0 R >>\n'
+                    f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+def _utf16(ch):
+    data = ch.encode('utf-16-be')
+    return [int.from_bytes(data[i:i + 2], 'big') for i in range(0, len(data), 2)]
+
+
+def _components(data, offset):
+    """Номера глифов, из которых составлен составной глиф (описание начинается с offset)"""
+    components = []
+    while True:
+        flags, glyph = struct.unpack_from('>HH', data, offset)
+        components.append(glyph)
+        offset += 4 + (4 if flags & _ARG_1_AND_2_ARE_WORDS else 2)
+        if flags & _WE_HAVE_A_SCALE:
+            offset += 2
+        elif flags & _WE_HAVE_AN_X_AND_Y_SCALE:
+            offset += 4
+        elif flags & _WE_HAVE_A_TWO_BY_TWO:
+            offset += 8
+        if not flags & _MORE_COMPONENTS:
+            return components
+
+
+def _checksum(data):
+    data = data + bytes(-len(data) % 4)
+    return sum(struct.unpack(f'>{len(data) // 4}I', data)) & 0xFFFFFFFF
+
+
+def _sfnt(tables):
+    """Собирает файл TrueType из таблиц {тег: байты}"""
+    tags = sorted(tables)
+    entry_selector = len(tags).bit_length() - 1
+    search_range = 16 << entry_selector
+    header = struct.pack('>IHHHH', 0x00010000, len(tags), search_range, entry_selector,
+                         16 * len(tags) - search_range)
+    directory, body = [], []
+    offset = len(header) + 16 * len(tags)
+    head_offset = None
+    for tag in tags:
+        table = tables[tag]
+        if tag == 'head':
+            head_offset = offset
+        directory.append(struct.pack('>4sIII', tag.encode('latin-1'), _checksum(table), offset, len(table)))
+        padded = table + bytes(-len(table) % 4)
+        body.append(padded)
+        offset += len(padded)
+    font = bytearray(header + b''.join(directory) + b''.join(body))
+    struct.pack_into('>I', font, head_offset + 8, (0xB1B0AFBA - _checksum(bytes(font))) & 0xFFFFFFFF)
+    return bytes(font)
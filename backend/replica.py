@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Снимок базы для тяжелых чтений (аналитика, отчеты за период).
+Копия создается через online backup API SQLite во временный файл и атомарно подменяет
+предыдущую, поэтому читатели снимка никогда не видят его наполовину записанным.
+Файл снимка после подмены не меняется, и соединения к нему открываются с immutable=1:
+без блокировок и без чтения WAL основной базы.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+class SnapshotReplica:
+    def __init__(self, source_path, replica_path, make_pool, interval=60.0):
+        self.source_path = source_path
+        self.replica_path = replica_path
+        # make_pool(path) создает пул соединений только для чтения к файлу снимка
+        self.make_pool = make_pool
+        self.interval = interval
+        self.refreshed_at = None
+        self.last_error = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """Снимает свежую копию базы и переключает на нее новых читателей"""
+        with self._refresh_lock:
+            tmp_path = f"{self.replica_path}.{os.getpid()}.tmp"
+            source = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(self.source_path))}?mode=ro', uri=True)
+            target = sqlite3.connect(tmp_path)
+            try:
+                # Копируем за один шаг, в одной транзакции чтения: при копировании порциями каждая
+                # запись в основную базу между шагами начинала бы копию заново. В режиме WAL
+                # открытое чтение писателей не блокирует
+                source.backup(target, pages=-1)
+                # Снимок должен открываться без файлов WAL
+                target.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                target.close()
+                source.close()
+            os.replace(tmp_path, self.replica_path)
+            pool = self.make_pool(self.replica_path)
+            with self._lock:
+                old, self._pool = self._pool, pool
+                self.refreshed_at = time.time()
+            # Простаивающие соединения старого пула закрываются сразу, занятые — когда их вернут
+            if old is not None:
+                old.close_all()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                # Читатели продолжают работать с предыдущим снимком
+                self.last_error = str(e)
+
+    def start(self):
+        """Запускает фоновое обновление снимка раз в interval секунд"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='db-replica', daemon=True)
+        self._thread.start()
+
+    def connection(self):
+        """Соединение со снимком; при первом обращении снимок создается и запускается его обновление"""
+        if self._thread is None:
+            self.start()
+        if self._pool is None:
+            with self._refresh_lock:
+                if self._pool is None:
+                    self.refresh()
+        with self._lock:
+            pool = self._pool
+        return pool.connection()
+
+    def lag(self):
+        """Возраст снимка в секундах"""
+        return None if self.refreshed_at is None else time.time() - self.refreshed_at
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close_all()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронная очередь заданий на генерацию отчетов.
+Запрос сразу получает id задания, отчет строится в ограниченном пуле воркеров:
+HTML — в потоках процесса, тяжелые форматы (PDF, Excel) — в отдельных процессах.
+Есть лимит одновременных заданий на пользователя, повтор при временных ошибках и очистка старых результатов.
+"""
+
+import multiprocessing
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+# Форматы, рендер которых нагружает процессор и поэтому выносится в отдельные процессы
+PROCESS_FORMATS = ('pdf', 'excel')
+
+QUEUED, RUNNING, RETRYING, DONE, FAILED = 'queued', 'running', 'retrying', 'done', 'failed'
+ACTIVE_STATUSES = (QUEUED, RUNNING, RETRYING)
+# Ошибки, после которых повтор может пройти (упавший процесс-воркер, занятая база);
+# остальные (нет записей, неверный формат или дата) повторятся так же, задание сразу завершается
+TRANSIENT_ERRORS = (BrokenProcessPool, sqlite3.OperationalError)
+
+
+class JobLimitError(Exception):
+    """У пользователя уже слишком много незавершенных заданий"""
+
+
+def run_report(generator, kind, params):
+    """Выполняет задание указанного вида генератором отчетов, возвращает имя файла"""
+    if kind == 'daily':
+        return generator.generate_report(params['user_id'], params['date'], params.get('format', 'html'))
+    if kind == 'range':
+        return generator.generate_range_report(params['user_id'], params.get('date_from'), params.get('date_to'),
+                                               params.get('stage_id'), params.get('format', 'html'))
+    raise ValueError(f'Неизвестный вид отчета: {kind}')
+
+
+_process_generator = None
+
+
+def _run_in_process(db_spec, store_spec, kind, params):
+    # Генератор и пул соединений создаются один раз на процесс-воркер
+    global _process_generator
+    if _process_generator is None:
+        from sharding import open_database
+        from reports import ReportGenerator
+        from report_store import ReportStore
+        # Хранилище уже сверено с каталогом веб-процессом
+        store = ReportStore(**store_spec, reconcile=False)
+        _process_generator = ReportGenerator(open_database(**db_spec, pool_size=1), store.root, store=store)
+    return run_report(_process_generator, kind, params)
+
+
+class ReportJobQueue:
+    def __init__(self, generator, max_workers=4, max_processes=2, per_user_limit=3,
+                 max_retries=2, retry_delay=1.0, result_ttl=3600, job_prefix=''):
+        self.generator = generator
+        # Префикс id заданий: по нему сервер с несколькими воркерами находит процесс задания
+        self.job_prefix = job_prefix
+        self.per_user_limit = per_user_limit
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.result_ttl = result_ttl
+        self.max_processes = max_processes
+        self._threads = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report')
+        self._processes = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+    def _process_pool(self):
+        # spawn: не наследуем потоки и открытые соединения веб-процесса
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        return self._processes
+
+    def submit(self, user_id, kind, params):
+        """
+        Ставит задание в очередь и возвращает его описание; бросает JobLimitError при превышении лимита
+        и ValueError, если user_id не целое число
+        """
+        try:
+            # Лимит считается по числу: 1 и "1" из JSON — один пользователь
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise ValueError('user_id должен быть целым числом') from None
+        params = dict(params, user_id=user_id)
+        self.cleanup()
+        with self._lock:
+            active = sum(1 for job in self._jobs.values()
+                         if job['user_id'] == user_id and job['status'] in ACTIVE_STATUSES)
+            if active >= self.per_user_limit:
+                raise JobLimitError(f'Не больше {self.per_user_limit} отчетов одновременно')
+            job = {
+                'job_id': self.job_prefix + uuid.uuid4().hex,
+                'user_id': user_id,
+                'kind': kind,
+                'params': params,
+                'status': QUEUED,
+                'attempts': 0,
+                'error': None,
+                'filename': None,
+                'created_at': time.time(),
+                'finished_at': None,
+            }
+            self._jobs[job['job_id']] = job
+        self._dispatch(job)
+        return self._public(job)
+
+    def _dispatch(self, job):
+        try:
+            if job['params'].get('format') in PROCESS_FORMATS:
+                future = self._submit_to_processes(job)
+            else:
+                future = self._threads.submit(self._run_in_thread, job)
+        except Exception as e:
+            # Пул остановлен или сломан: оформляем это как неудачную попытку
+            future = Future()
+            future.set_exception(e)
+            with self._lock:
+                job['attempts'] += 1
+        future.add_done_callback(lambda f: self._finished(job, f))
+
+    def _submit_process(self, kind, params):
+        args = (_run_in_process, self.generator.db.spec(), self.generator.store.spec(), kind, params)
+        try:
+            return self._process_pool().submit(*args)
+        except BrokenProcessPool:
+            # Воркер упал (например, из-за нехватки памяти) — пересоздаем пул
+            self._processes = None
+            return self._process_pool().submit(*args)
+
+    def render(self, kind, params):
+        """
+        Отчет без очереди заданий, с ожиданием результата; возвращает имя файла.
+        Тяжелые форматы и здесь строятся в процессах: рендер не занимает GIL процесса,
+        который обслуживает запросы.
+        """
+        if params.get('format') in PROCESS_FORMATS:
+            return self._submit_process(kind, params).result()
+        return run_report(self.generator, kind, params)
+
+    def _submit_to_processes(self, job):
+        future = self._submit_process(job['kind'], job['params'])
+        with self._lock:
+            job['status'] = RUNNING
+            job['attempts'] += 1
+        return future
+
+    def _run_in_thread(self, job):
+        with self._lock:
+            job['status'] = RUNNING
+            job['attempts'] += 1
+        return run_report(self.generator, job['kind'], job['params'])
+
+    def _finished(self, job, future):
+        error = future.exception()
+        with self._lock:
+            if error is None:
+                job['status'], job['filename'], job['error'] = DONE, future.result(), None
+                job['finished_at'] = time.time()
+                self._observe(job)
+                return
+            job['error'] = str(error)
+            if not isinstance(error, TRANSIENT_ERRORS) or job['attempts'] > self.max_retries:
+                job['status'], job['finished_at'] = FAILED, time.time()
+                self._observe(job)
+                return
+            job['status'] = RETRYING
+        # Повтор с нарастающей задержкой
+        timer = threading.Timer(self.retry_delay * job['attempts'], self._dispatch, (job,))
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _observe(job):
+        # Процессы-воркеры свои метрики не передают, поэтому время задания замеряется здесь
+        metrics.report_jobs.observe(job['kind'], job['params'].get('format', 'html'), job['status'],
+                                    value=job['finished_at'] - job['created_at'])
+
+    def status(self, job_id):
+        self.cleanup()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def _public(self, job):
+        result = {key: job[key] for key in ('job_id', 'user_id', 'kind', 'status', 'attempts', 'error')}
+        result['report_url'] = f"/reports/{job['filename']}" if job['filename'] else None
+        return result
+
+    def cleanup(self, force=False):
+        """
+        Удаляет записи о завершенных заданиях старше result_ttl. Сами отчеты остаются в хранилище:
+        то же имя файла могли выдать синхронная генерация и очереди других процессов,
+        а место освобождает вытеснение по размеру (ReportStore, max_bytes)
+        """
+        now = time.monotonic()
+        if not force and now - self._last_cleanup < min(60, self.result_ttl):
+            return
+        self._last_cleanup = now
+        deadline = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < deadline]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Хранилище отчетов с адресацией по содержимому.
+Содержимое хранится один раз под своим sha256 (objects/ab/abcd...), имена отчетов
+(report_1_2025-11-01_<хэш данных>.pdf) ссылаются на него через индекс в SQLite (store.sqlite3):
+поиск по имени — запрос по первичному ключу, каталог при этом не просматривается.
+Содержимое может храниться сжатым (gzip или zstd при установленном zstandard), если это
+экономит хотя бы MIN_SAVING. Общий размер ограничен max_bytes: при превышении удаляется
+содержимое, к которому дольше всего не обращались (LRU), вместе с именами, которые на него ссылаются.
+Индекс общий для всех процессов (воркеры сервера, процессы отчетов). При открытии он один раз
+сверяется с каталогом, а отчеты старого формата (файлы в корне каталога) переносятся в хранилище.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+# Сжатая копия хранится, только если она меньше исходной хотя бы на эту долю
+MIN_SAVING = 0.1
+# Время последнего обращения обновляется не чаще раза в ACCESS_RESOLUTION секунд
+ACCESS_RESOLUTION = 60
+# Недописанные временные файлы старше этого считаются брошенными
+STALE_TMP_SECONDS = 3600
+READ_CHUNK_SIZE = 64 * 1024
+
+_EXTENSIONS = {'identity': '', 'gzip': '.gz', 'zstd': '.zst'}
+_LEGACY_NAME = re.compile(r'^(report|range)_.+\.(html|pdf|xlsx)$')
+
+StoredReport = namedtuple('StoredReport', 'name digest size stored_size encoding path created')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    encoding TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_blobs_accessed ON blobs(accessed);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_names_digest ON names(digest);
+'''
+
+
+def _hash_file(path):
+    digest, size = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _compress(source, target, encoding):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        if encoding == 'zstd':
+            with zstandard.ZstdCompressor(level=6).stream_writer(dst, closefd=False) as writer:
+                while True:
+                    chunk = src.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+            return
+        # wbits=31 — формат gzip, который браузер распакует сам по Content-Encoding: gzip
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        while True:
+            chunk = src.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+
+
+class ReportStore:
+    def __init__(self, root='reports', max_bytes=1024 * 1024 * 1024, compression='gzip', reconcile=True):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Неизвестное сжатие отчетов: {compression}, ожидается одно из: {', '.join(COMPRESSIONS)}")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('Для сжатия zstd нужен пакет zstandard')
+        self.root = root
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, 'store.sqlite3'), check_same_thread=False,
+                                     timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if reconcile:
+            self.reconcile()
+
+    def spec(self):
+        """Параметры для открытия того же хранилища в процессе-воркере отчетов"""
+        return {'root': self.root, 'max_bytes': self.max_bytes, 'compression': self.compression}
+
+    def _blob_path(self, digest, encoding):
+        return os.path.join(self.objects_dir, digest[:2], digest + _EXTENSIONS[encoding])
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE: изменения индекса из разных процессов идут по очереди
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    # ---------- запись ----------
+
+    def temp_path(self, name):
+        """Путь для рендера отчета перед put(): в том же разделе, что и хранилище"""
+        return os.path.join(self.tmp_dir, f'{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    def put(self, name, path):
+        """Переносит готовый файл path в хранилище под именем name (файла path после этого нет); возвращает хэш содержимого"""
+        digest, size = _hash_file(path)
+        with self._lock:
+            known = self._conn.execute('SELECT 1 FROM blobs WHERE digest=?', (digest,)).fetchone()
+        compressed = None
+        if known is None and self.compression != 'none' and size:
+            compressed = f'{path}.{self.compression}'
+            _compress(path, compressed, self.compression)
+            if os.path.getsize(compressed) > size * (1 - MIN_SAVING):
+                os.remove(compressed)
+                compressed = None
+
+        encoding, source = (self.compression, compressed) if compressed else ('identity', path)
+        stored_size = os.path.getsize(source)
+        now = time.time()
+        victims = []
+        try:
+            with self._transaction() as conn:
+                if conn.execute('SELECT 1 FROM blobs WHERE digest=?', (digest,)).fetchone() is None:
+                    blob_path = self._blob_path(digest, encoding)
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(source, blob_path)
+                    conn.execute('INSERT INTO blobs (digest, size, stored_size, encoding, created, accessed) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', (digest, size, stored_size, encoding, now, now))
+                else:
+                    conn.execute('UPDATE blobs SET accessed=? WHERE digest=?', (now, digest))
+                replaced = conn.execute('SELECT digest FROM names WHERE name=?', (name,)).fetchone()
+                conn.execute('INSERT OR REPLACE INTO names (name, digest, created) VALUES (?, ?, ?)',
+                             (name, digest, now))
+                if replaced is not None and replaced[0] != digest:
+                    victims += self._drop_unreferenced(conn, [replaced[0]])
+                victims += self._evict(conn, keep=digest)
+        finally:
+            for leftover in (path, compressed):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+        self._unlink(victims)
+        return digest
+
+    def _drop_unreferenced(self, conn, digests):
+        """Удаляет из индекса содержимое без имен; возвращает пути файлов для удаления после фиксации"""
+        paths = []
+        for digest in set(digests):
+            if conn.execute('SELECT 1 FROM names WHERE digest=? LIMIT 1', (digest,)).fetchone():
+                continue
+            row = conn.execute('DELETE FROM blobs WHERE digest=? RETURNING encoding', (digest,)).fetchone()
+            if row is not None:
+                paths.append(self._blob_path(digest, row[0]))
+        return paths
+
+    def _evict(self, conn, keep=None):
+        total = conn.execute('SELECT COALESCE(SUM(stored_size), 0) FROM blobs').fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        paths = []
+        for digest, stored_size, encoding in conn.execute(
+                'SELECT digest, stored_size, encoding FROM blobs ORDER BY accessed').fetchall():
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            conn.execute('DELETE FROM names WHERE digest=?', (digest,))
+            conn.execute('DELETE FROM blobs WHERE digest=?', (digest,))
+            paths.append(self._blob_path(digest, encoding))
+            total -= stored_size
+            self.evictions += 1
+        return paths
+
+    @staticmethod
+    def _unlink(paths):
+        # Файлы удаляются после фиксации: процесс, который уже открыл файл, дочитает его
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def remove(self, name):
+        with self._transaction() as conn:
+            row = conn.execute('DELETE FROM names WHERE name=? RETURNING digest', (name,)).fetchone()
+            victims = self._drop_unreferenced(conn, [row[0]]) if row else []
+        self._unlink(victims)
+
+    def remove_prefix(self, prefix):
+        """Удаляет все отчеты, имя которых начинается с prefix"""
+        with self._transaction() as conn:
+            digests = [row[0] for row in conn.execute(
+                'DELETE FROM names WHERE name>=? AND name<? RETURNING digest', (prefix, prefix + '\U0010ffff'))]
+            victims = self._drop_unreferenced(conn, digests)
+        self._unlink(victims)
+
+    # ---------- чтение ----------
+
+    def get(self, name):
+        """Описание отчета по имени или None; отмечает обращение для LRU"""
+        with self._lock:
+            row = self._conn.execute(
+                '''SELECT b.digest, b.size, b.stored_size, b.encoding, n.created, b.accessed
+                   FROM names n JOIN blobs b ON b.digest=n.digest WHERE n.name=?''', (name,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            digest, size, stored_size, encoding, created, accessed = row
+            now = time.time()
+            if now - accessed > ACCESS_RESOLUTION:
+                self._conn.execute('UPDATE blobs SET accessed=? WHERE digest=?', (now, digest))
+            self.hits += 1
+        path = self._blob_path(digest, encoding)
+        if not os.path.exists(path):
+            # Файл удалили в обход индекса
+            self.remove(name)
+            return None
+        return StoredReport(name, digest, size, stored_size, encoding, path, created)
+
+    @staticmethod
+    def iter_stored(report, chunk_size=READ_CHUNK_SIZE, file=None):
+        """Содержимое как хранится (сжатое — сжатым); file — уже открытый файл отчета"""
+        with file or open(report.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    def iter_content(report, chunk_size=READ_CHUNK_SIZE, file=None):
+        """Исходное содержимое, сжатое распаковывается на лету; file — уже открытый файл отчета"""
+        if report.encoding == 'identity':
+            yield from ReportStore.iter_stored(report, chunk_size, file)
+            return
+        if report.encoding == 'zstd':
+            with file or open(report.path, 'rb') as f:
+                yield from zstandard.ZstdDecompressor().read_to_iter(f, read_size=chunk_size, write_size=chunk_size)
+            return
+        decompressor = zlib.decompressobj(31)
+        for chunk in ReportStore.iter_stored(report, chunk_size, file):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+    # ---------- обслуживание ----------
+
+    def reconcile(self):
+        """
+        Сверка индекса с каталогом при старте: строки без файлов и файлы без строк удаляются,
+        брошенные временные файлы чистятся, отчеты старого формата переносятся в хранилище
+        """
+        now = time.time()
+        for entry in os.scandir(self.tmp_dir):
+            if entry.is_file() and now - entry.stat().st_mtime > STALE_TMP_SECONDS:
+                self._unlink([entry.path])
+
+        with self._transaction() as conn:
+            known = {}
+            for digest, encoding in conn.execute('SELECT digest, encoding FROM blobs').fetchall():
+                path = self._blob_path(digest, encoding)
+                if os.path.exists(path):
+                    known[path] = digest
+                else:
+                    conn.execute('DELETE FROM names WHERE digest=?', (digest,))
+                    conn.execute('DELETE FROM blobs WHERE digest=?', (digest,))
+            orphans = []
+            for shard in os.scandir(self.objects_dir):
+                if shard.is_dir():
+                    orphans += [entry.path for entry in os.scandir(shard.path) if entry.path not in known]
+            conn.execute('DELETE FROM names WHERE digest NOT IN (SELECT digest FROM blobs)')
+            victims = self._evict(conn)
+        self._unlink(orphans + victims)
+
+        for entry in os.scandir(self.root):
+            if entry.is_file() and _LEGACY_NAME.match(entry.name):
+                try:
+                    self.put(entry.name, entry.path)
+                except OSError:
+                    # Файл одновременно переносит другой процесс
+                    pass
+
+    def stats(self):
+        with self._lock:
+            blobs, stored, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(stored_size), 0), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            names = self._conn.execute('SELECT COUNT(*) FROM names').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'names': names,
+                'blobs': blobs,
+                'bytes': stored,
+                'content_bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,49 +1,193 @@
-
 # -*- coding: utf-8 -*-
 """
 Модуль генерации отчетов (HTML, PDF, Excel)
 """
 import os
 import json
-from datetime import datetime
-from jinja2 import Template
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+
+import metrics
+from report_store import ReportStore
+from pdf_writer import PdfStreamWriter
+from xlsx_writer import XlsxStreamWriter
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+TEMPLATE_NAMES = ('daily_report.html', 'range_report.html')
+
+# Формат отчета -> расширение файла
+FORMAT_EXTENSIONS = {'html': 'html', 'pdf': 'pdf', 'excel': 'xlsx'}
+
+# Колонки листа «Дни» и строки дня в PDF: ключ данных дня -> заголовок
+DAY_COLUMNS = [
+    ('date', 'Дата'), ('stage', 'Этап'), ('day', 'День'), ('weight', 'Вес утром'),
+    ('next_weight', 'След. вес'), ('lost_weight', 'Сброшено'), ('waist', 'Талия'), ('hips', 'Бедра'),
+    ('total_grams', 'Граммы'), ('total_kcal', 'Ккал'), ('kcal_density', 'Плотность'),
+    ('edema', 'Отеки'), ('cycle', 'День цикла'), ('stool', 'Стул'),
+]
+MEAL_COLUMNS = ['Дата', 'Время', 'Что съедено', 'Масса', 'Ккал']
+
+
+def iter_dishes(meals):
+    """
+    Блюда дня как (время, название, масса, ккал).
+    Понимает оба формата: приемы пищи со списком dishes и плоский список {time, food, mass, kcal}.
+    """
+    for meal in meals or []:
+        if not isinstance(meal, dict):
+            continue
+        dishes = meal.get('dishes') if isinstance(meal.get('dishes'), list) else [meal]
+        for dish in dishes:
+            if not isinstance(dish, dict):
+                continue
+            name = dish.get('name') or dish.get('food') or ''
+            mass = dish.get('mass')
+            kcal = dish.get('kcal', dish.get('calories'))
+            # Пустые строки-заготовки из формы не выводим
+            if not name and not mass and not kcal:
+                continue
+            yield dish.get('time') or meal.get('time') or '', name, mass, kcal
+
+
+def _number(value):
+    """Числа из JSON формы часто приходят строками; в Excel их лучше писать числами"""
+    if isinstance(value, str):
+        try:
+            return float(value.replace(',', '.')) if value.strip() else value
+        except ValueError:
+            return value
+    return value
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
 
 class ReportGenerator:
-    def __init__(self, db, reports_dir='reports'):
+    def __init__(self, db, reports_dir='reports', templates_dir=TEMPLATES_DIR, store=None):
         self.db = db
         self.reports_dir = reports_dir
+        # Готовые отчеты хранятся по содержимому, с бюджетом размера (см. report_store)
+        self.store = store or ReportStore(reports_dir)
+        # Шаблоны компилируются один раз, байткод переживает перезапуск процесса
+        cache_dir = os.path.join(reports_dir, '.template_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.env = Environment(
+            loader=FileSystemLoader(templates_dir),
+            bytecode_cache=FileSystemBytecodeCache(cache_dir),
+            autoescape=select_autoescape(['html']),
+            auto_reload=False,
+        )
+        self.template = self.env.get_template('daily_report.html')
+        self.range_template = self.env.get_template('range_report.html')
+        version = hashlib.sha256()
+        for name in TEMPLATE_NAMES:
+            source, _, _ = self.env.loader.get_source(self.env, name)
+            version.update(source.encode('utf-8'))
+        self.template_version = version.hexdigest()[:12]
+        # Одновременные одинаковые запросы ждут одного рендера
+        self._inflight = {}
+        self._lock = threading.Lock()
+        db.add_entry_listener(self.invalidate)
+
+    def content_hash(self, entry, report_format):
+        """Хэш содержимого записи: одинаковый день в одном формате рендерится только один раз"""
+        digest = hashlib.sha256()
+        for part in (self.template_version, report_format, entry['entry_date'],
+                     entry['daily_params'] or '', entry['meals'] or ''):
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()[:16]
+
+    def report_filename(self, user_id, report_date, report_format, content_hash):
+        return f"report_{user_id}_{report_date}_{content_hash}.{self._extension(report_format)}"
+
+    @staticmethod
+    def _extension(report_format):
+        if report_format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Неизвестный формат отчета: {report_format}")
+        return FORMAT_EXTENSIONS[report_format]
 
     def generate_report(self, user_id, report_date, report_format='html'):
         # Получаем данные из базы
         entry = self.db.get_entry_by_date(user_id, report_date)
         if not entry:
             raise Exception("Нет записи на эту дату")
+        filename = self.report_filename(user_id, report_date, report_format,
+                                        self.content_hash(entry, report_format))
+        title = f"Ежедневный отчет за {report_date}"
+        return self._single_flight(filename, lambda path: self._render(entry, report_date, report_format, path, title),
+                                  'daily', report_format)
+
+    def generate_range_report(self, user_id, date_from=None, date_to=None, stage_id=None, report_format='html'):
+        """
+        Отчет за период или за весь этап. Записи читаются из базы порциями и сразу пишутся в файл,
+        поэтому память не растет с числом дней. Имя файла содержит хэш версии записей периода
+        (Database.range_version, без чтения самих записей): пока данные не менялись,
+        повторный запрос отдает готовый файл.
+        """
+        extension = self._extension(report_format)
+        count, id_total, version = self.db.range_version(user_id, date_from, date_to, stage_id)
+        if not count:
+            raise Exception("Нет записей за этот период")
+        digest = hashlib.sha256()
+        for part in (self.template_version, report_format, user_id, date_from, date_to, stage_id,
+                     count, id_total, version):
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+
+        label = '_'.join(part for part in (f"stage{stage_id}" if stage_id is not None else None,
+                                           date_from, date_to) if part) or 'all'
+        filename = f"range_{user_id}_{label}_{digest.hexdigest()[:16]}.{extension}"
+        title = f"Отчет за этап {stage_id}" if stage_id is not None and not (date_from or date_to) \
+            else f"Отчет за период {date_from or '…'} — {date_to or '…'}"
+
+        def render(path):
+            entries = self.db.iter_entries(user_id, date_from, date_to, stage_id)
+            self._write(report_format, path, entries, title)
+        return self._single_flight(filename, render, 'range', report_format)
+
+    def _single_flight(self, filename, render, kind, report_format):
+        if self.store.get(filename) is not None:
+            return filename
+
+        with self._lock:
+            future = self._inflight.get(filename)
+            leader = future is None
+            if leader:
+                future = self._inflight[filename] = Future()
+        if not leader:
+            return future.result()
+
+        # Пишем во временный файл и переносим в хранилище, чтобы никто не увидел недописанный отчет
+        tmp_path = self.store.temp_path(filename)
+        try:
+            started = time.perf_counter()
+            render(tmp_path)
+            metrics.reports.observe(kind, report_format, value=time.perf_counter() - started)
+            self.store.put(filename, tmp_path)
+            future.set_result(filename)
+        except BaseException as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(filename, None)
+        return filename
+
+    def day_data(self, entry):
+        """Данные дня для шаблонов и табличных форматов"""
         daily_params = json.loads(entry['daily_params']) if entry['daily_params'] else {}
         meals = json.loads(entry['meals']) if entry['meals'] else []
-        # Формируем HTML с помощью шаблона (пример)
-        html_template = '''
-        <html><head><meta charset="utf-8"></head><body style="font-family:Arial,sans-serif;max-width:850px;padding:24px;background:#fff;">
-        <h2 style="text-align:center">Ежедневный отчет за {{date}}</h2>
-        <table style="width:100%;border-collapse:collapse;margin-bottom:20px;">
-        <tr><td><b>Этап:</b> {{stage}}</td><td><b>День:</b> {{day}}</td><td><b>Дата:</b> {{date}}</td></tr>
-        <tr><td><b>Вес утром:</b> {{weight}}</td><td><b>След. вес:</b> {{next_weight}}</td><td><b>Сброшено:</b> {{lost_weight}}</td></tr>
-        <tr><td colspan='3'><b>Талии:</b> {{waist}}, <b>Бедра:</b> {{hips}}</td></tr>
-        <tr><td colspan='3'><b>Калорий/Плотность:</b> {{total_grams}} г / {{total_kcal}} ккал / {{kcal_density}} </td></tr>
-        </table>
-        <h3>Приемы пищи</h3>
-        <table border='1' style="width:100%;border-collapse:collapse">
-        <tr><th>Время</th><th>Что съедено</th><th>Масса</th><th>Ккал</th></tr>
-        {% for meal in meals %}
-          <tr><td>{{meal.get('time','')}}</td><td>{{meal.get('food','')}}</td><td>{{meal.get('mass','')}}</td><td>{{meal.get('kcal','')}}</td></tr>
-        {% endfor %}
-        </table>
-        <p style="margin-top:48px"><b>Отеки:</b> {{edema}}<br><b>День цикла:</b> {{cycle}}<br><b>Стул:</b> {{stool}}</p>
-        </body></html>
-        '''
-        template_data = {
+        return {
             'stage': daily_params.get('stage_type',''),
             'day': daily_params.get('program_day',''),
-            'date': report_date,
+            'date': entry['entry_date'],
             'weight': daily_params.get('morning_weight',''),
             'next_weight': daily_params.get('next_morning_weight',''),
             'lost_weight': daily_params.get('weight_lost',''),
@@ -57,9 +201,80 @@ class ReportGenerator:
             'stool': daily_params.get('stool',''),
             'meals': meals
         }
-        html = Template(html_template).render(**template_data)
-        filename = f"report_{user_id}_{report_date}.{report_format}"
-        filepath = os.path.join(self.reports_dir, filename)
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(html)
-        return filename
+
+    def render_html(self, entry, report_date):
+        template_data = self.day_data(entry)
+        template_data['date'] = report_date
+        return self.template.render(**template_data)
+
+    def _render(self, entry, report_date, report_format, path, title):
+        if report_format == 'html':
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.render_html(entry, report_date))
+        else:
+            self._write(report_format, path, [entry], title)
+
+    def _write(self, report_format, path, entries, title):
+        if report_format == 'excel':
+            self._write_excel(path, entries)
+        elif report_format == 'pdf':
+            self._write_pdf(path, entries, title)
+        else:
+            self._write_html(path, entries, title)
+
+    def _write_html(self, path, entries, title):
+        # generate() отдает шаблон кусками по мере чтения записей
+        days = (dict(data, dishes=iter_dishes(data['meals'])) for data in map(self.day_data, entries))
+        with open(path, "w", encoding="utf-8") as f:
+            for chunk in self.range_template.generate(title=title, columns=DAY_COLUMNS, days=days):
+                f.write(chunk)
+
+    def _write_excel(self, path, entries):
+        # Лист с приемами пищи пишется вторым, поэтому блюда временно копятся в файле, а не в памяти
+        meals_path = f"{path}.meals"
+        try:
+            with XlsxStreamWriter(path) as book, open(meals_path, "w+", encoding="utf-8") as meals_file:
+                book.start_sheet('Дни', column_widths=[12, 10, 6] + [11] * (len(DAY_COLUMNS) - 3))
+                book.write_row([header for _, header in DAY_COLUMNS], style=1)
+                for entry in entries:
+                    data = self.day_data(entry)
+                    book.write_row([_number(data[key]) if key not in ('date', 'stage') else data[key]
+                                    for key, _ in DAY_COLUMNS])
+                    for dish in iter_dishes(data['meals']):
+                        meals_file.write(json.dumps([data['date'], *dish], ensure_ascii=False) + "\n")
+
+                book.start_sheet('Приемы пищи', column_widths=[12, 8, 40, 8, 8])
+                book.write_row(MEAL_COLUMNS, style=1)
+                meals_file.seek(0)
+                for line in meals_file:
+                    day, meal_time, name, mass, kcal = json.loads(line)
+                    book.write_row([day, meal_time, name, _number(mass), _number(kcal)])
+        finally:
+            if os.path.exists(meals_path):
+                os.remove(meals_path)
+
+    def _write_pdf(self, path, entries, title):
+        with PdfStreamWriter(path, title=title) as pdf:
+            pdf.line([(0, title, None)], size=14)
+            pdf.gap(6)
+            for entry in entries:
+                data = self.day_data(entry)
+                pdf.gap(6)
+                pdf.line([(0, f"{data['date']}  {_text(data['stage'])}, день {_text(data['day'])}", None)], size=11)
+                pdf.line([(0, f"Вес утром: {_text(data['weight'])}", 170),
+                          (170, f"След. вес: {_text(data['next_weight'])}", 170),
+                          (340, f"Сброшено: {_text(data['lost_weight'])}", 175)])
+                pdf.line([(0, f"Талия: {_text(data['waist'])}, бедра: {_text(data['hips'])}", 170),
+                          (170, f"{_text(data['total_grams'])} г / {_text(data['total_kcal'])} ккал / "
+                                f"{_text(data['kcal_density'])}", 345)])
+                for meal_time, name, mass, kcal in iter_dishes(data['meals']):
+                    pdf.line([(10, _text(meal_time), 45), (60, _text(name), 320),
+                              (390, _text(mass), 60), (455, _text(kcal), 60)])
+                extra = [f"{label}: {_text(data[key])}" for key, label in
+                         (('edema', 'Отеки'), ('cycle', 'День цикла'), ('stool', 'Стул')) if data[key] not in ('', None)]
+                if extra:
+                    pdf.line([(0, ', '.join(extra), 515)])
+
+    def invalidate(self, user_id, report_date):
+        """Удаляет сохраненные отчеты за день после изменения записи"""
+        self.store.remove_prefix(f"report_{user_id}_{report_date}_")
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальные итоги этапов программы (таблица stage_rollups).
+При каждом сохранении или удалении дня итоги этапа корректируются разностью между старыми
+и новыми показателями дня, поэтому сводка этапа читается одной строкой, сколько бы дней в нем ни было.
+Лучший и худший день (по сброшенному весу) и последний вес пересчитываются индексным запросом
+только если изменился именно тот день, который их задавал.
+"""
+
+_METRICS_SQL = 'SELECT entry_id, stage_id, user_id, entry_date, weight, weight_lost, total_kcal FROM daily_metrics'
+
+
+def metrics_for_entry(conn, entry_id):
+    return conn.execute(f'{_METRICS_SQL} WHERE entry_id=?', (entry_id,)).fetchone()
+
+
+def _value(row, column):
+    return None if row is None else row[column]
+
+
+def _latest_weight(conn, stage_id):
+    return conn.execute('''SELECT entry_date, weight FROM daily_metrics
+                           WHERE stage_id=? AND weight IS NOT NULL
+                           ORDER BY entry_date DESC LIMIT 1''', (stage_id,)).fetchone()
+
+
+def _extreme_day(conn, stage_id, direction):
+    return conn.execute(f'''SELECT entry_date, weight_lost FROM daily_metrics
+                            WHERE stage_id=? AND weight_lost IS NOT NULL
+                            ORDER BY weight_lost {direction}, entry_date LIMIT 1''', (stage_id,)).fetchone()
+
+
+def _track(conn, stage_id, current, old, new, column, better, direction):
+    """
+    Обновляет пару (дата, значение) экстремума: если изменился день, задававший экстремум,
+    и он стал хуже, значение берется из индекса, иначе сравнивается с новым днем.
+    """
+    current_date, current_value = current
+    old_value, new_value = _value(old, column), _value(new, column)
+    if old_value is not None and old['entry_date'] == current_date:
+        if new_value is not None and not better(current_value, new_value):
+            return new['entry_date'], new_value
+        row = _extreme_day(conn, stage_id, direction)
+        return (row[0], row[1]) if row else (None, None)
+    if new_value is not None and (current_value is None or not better(current_value, new_value)):
+        return new['entry_date'], new_value
+    return current_date, current_value
+
+
+def apply(conn, old, new):
+    """
+    Корректирует итоги этапа по изменению одного дня.
+    old — показатели дня до изменения (None для нового дня), new — после (None при удалении).
+    Вызывается после того, как daily_metrics уже приведена к новому состоянию.
+    """
+    row = new if new is not None else old
+    if row is None:
+        return
+    stage_id = row['stage_id']
+    conn.execute('INSERT OR IGNORE INTO stage_rollups (stage_id, user_id) VALUES (?, ?)', (stage_id, row['user_id']))
+    rollup = conn.execute('SELECT * FROM stage_rollups WHERE stage_id=?', (stage_id,)).fetchone()
+
+    days_logged = rollup['days_logged'] + (new is not None) - (old is not None)
+    kcal_days = rollup['kcal_days'] + (_value(new, 'total_kcal') is not None) - (_value(old, 'total_kcal') is not None)
+    kcal_sum = rollup['kcal_sum'] + (_value(new, 'total_kcal') or 0) - (_value(old, 'total_kcal') or 0)
+
+    # Для последнего веса «лучше» — более поздняя дата, поэтому сравниваем даты, а не значения
+    last_date, last_weight = rollup['last_weight_date'], rollup['last_weight']
+    if _value(old, 'weight') is not None and old['entry_date'] == last_date and _value(new, 'weight') is None:
+        latest = _latest_weight(conn, stage_id)
+        last_date, last_weight = (latest[0], latest[1]) if latest else (None, None)
+    elif _value(new, 'weight') is not None and (last_date is None or new['entry_date'] >= last_date):
+        last_date, last_weight = new['entry_date'], new['weight']
+
+    best = _track(conn, stage_id, (rollup['best_date'], rollup['best_weight_lost']), old, new,
+                  'weight_lost', lambda current, value: current > value, 'DESC')
+    worst = _track(conn, stage_id, (rollup['worst_date'], rollup['worst_weight_lost']), old, new,
+                   'weight_lost', lambda current, value: current < value, 'ASC')
+
+    conn.execute('''UPDATE stage_rollups SET days_logged=?, kcal_days=?, kcal_sum=?,
+                        last_weight_date=?, last_weight=?, best_date=?, best_weight_lost=?,
+                        worst_date=?, worst_weight_lost=?
+                    WHERE stage_id=?''',
+                 (days_logged, kcal_days, kcal_sum, last_date, last_weight, *best, *worst, stage_id))
+
+
+def rebuild(conn, stage_ids=None):
+    """Полный пересчет итогов (после массовых изменений или для сверки)"""
+    where, params = '', []
+    if stage_ids is not None:
+        stage_ids = list(stage_ids)
+        if not stage_ids:
+            return
+        where = f"WHERE stage_id IN ({','.join('?' * len(stage_ids))})"
+        params = stage_ids
+    conn.execute(f'DELETE FROM stage_rollups {where}', params)
+    conn.execute(f'''INSERT INTO stage_rollups (stage_id, user_id, days_logged, kcal_days, kcal_sum)
+                     SELECT stage_id, MIN(user_id), COUNT(*), COUNT(total_kcal), COALESCE(SUM(total_kcal), 0)
+                     FROM daily_metrics {where} GROUP BY stage_id''', params)
+    for (stage_id,) in conn.execute(f'SELECT stage_id FROM stage_rollups {where}', params).fetchall():
+        latest = _latest_weight(conn, stage_id)
+        best = _extreme_day(conn, stage_id, 'DESC')
+        worst = _extreme_day(conn, stage_id, 'ASC')
+        conn.execute('''UPDATE stage_rollups SET last_weight_date=?, last_weight=?, best_date=?, best_weight_lost=?,
+                            worst_date=?, worst_weight_lost=? WHERE stage_id=?''',
+                     (*(latest or (None, None)), *(best or (None, None)), *(worst or (None, None)), stage_id))
+
+
+def stage_summary(conn, stage_id):
+    """Сводка этапа из таблицы итогов: одна строка независимо от длины этапа"""
+    row = conn.execute('''SELECT s.*, r.days_logged, r.kcal_days, r.kcal_sum, r.last_weight_date, r.last_weight,
+                                 r.best_date, r.best_weight_lost, r.worst_date, r.worst_weight_lost
+                          FROM stages s LEFT JOIN stage_rollups r ON r.stage_id = s.id
+                          WHERE s.id=?''', (stage_id,)).fetchone()
+    if row is None:
+        return None
+    last_weight = row['last_weight']
+    return {
+        'stage_id': row['id'],
+        'user_id': row['user_id'],
+        'stage_type': row['stage_type'],
+        'start_date': row['start_date'],
+        'end_date': row['end_date'],
+        'completed': row['completed'],
+        'initial_weight': row['initial_weight'],
+        'days_logged': row['days_logged'] or 0,
+        'current_weight': last_weight,
+        'current_weight_date': row['last_weight_date'],
+        'total_weight_lost': round(row['initial_weight'] - last_weight, 3) if last_weight is not None else None,
+        'avg_kcal': round(row['kcal_sum'] / row['kcal_days'], 1) if row['kcal_days'] else None,
+        'best_day': {'date': row['best_date'], 'weight_lost': row['best_weight_lost']} if row['best_date'] else None,
+        'worst_day': {'date': row['worst_date'], 'weight_lost': row['worst_weight_lost']} if row['worst_date'] else None,
+    }
+
+
+# Шаги миграции схемы (подключаются в migrations.MIGRATIONS)
+MIGRATION_STEPS = [
+    '''CREATE TABLE IF NOT EXISTS stage_rollups (
+        stage_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        days_logged INTEGER NOT NULL DEFAULT 0,
+        kcal_days INTEGER NOT NULL DEFAULT 0,
+        kcal_sum REAL NOT NULL DEFAULT 0,
+        last_weight_date DATE,
+        last_weight REAL,
+        best_date DATE,
+        best_weight_lost REAL,
+        worst_date DATE,
+        worst_weight_lost REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_daily_metrics_stage_lost ON daily_metrics(stage_id, weight_lost)',
+    rebuild,
+]
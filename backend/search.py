@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Поиск продуктов для автодополнения в редакторе приемов пищи.
+Названия хранятся в нормализованном виде (name_norm): регистр сложен с учетом кириллицы, ё заменена на е.
+Кандидаты набираются префиксом по индексу (user_id, name_norm), а для запросов от 3 символов
+еще и подстрокой через триграммный индекс product_trigrams. Ключ индекса начинается с user_id, поэтому
+поиск подстроки читает только триграммы продуктов самого пользователя, а не совпадения у всех пользователей.
+Результаты ранжируются: точное совпадение, префикс, подстрока, затем недавно использованные продукты.
+"""
+
+import re
+
+import changelog
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# По триграммам нельзя искать строки короче трех символов
+TRIGRAM_MIN_LENGTH = 3
+# Триграммы индексируются с первых TRIGRAM_MAX_POSITIONS позиций названия
+TRIGRAM_MAX_POSITIONS = 1000
+
+# Сколько кандидатов каждого вида (префикс, подстрока) ранжируется, чтобы время ответа
+# не зависело от числа совпадений у пользователей с десятками тысяч продуктов
+CANDIDATES = 1000
+
+_SPACES = re.compile(r'\s+')
+
+_RANKED_COLUMNS = '''p.id, p.user_id, p.product_name, p.calories_per_100g, p.last_used,
+    CASE WHEN p.name_norm = :q THEN 0
+         WHEN substr(p.name_norm, 1, :n) = :q THEN 1
+         ELSE 2 END AS match_rank'''
+
+# NULL в SQLite меньше любого значения, поэтому неиспользованные продукты оказываются в конце
+_RANK_ORDER = 'ORDER BY match_rank, p.last_used DESC, p.name_norm LIMIT :limit'
+
+
+def fold_name(name):
+    """Нормализует название продукта для поиска: 'Курица  Грудка Ё' -> 'курица грудка е'"""
+    if not name:
+        return ''
+    return _SPACES.sub(' ', name.casefold().replace('ё', 'е')).strip()
+
+
+def dish_names(meals):
+    """Собирает нормализованные названия блюд из JSON приемов пищи"""
+    names = set()
+    for meal in meals or []:
+        if not isinstance(meal, dict):
+            continue
+        dishes = meal.get('dishes') if isinstance(meal.get('dishes'), list) else [meal]
+        for dish in dishes:
+            if isinstance(dish, dict):
+                name = fold_name(str(dish.get('name') or dish.get('food') or ''))
+                if name:
+                    names.add(name)
+    return names
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def candidate_queries(user_id, query):
+    """
+    Запросы отбора кандидатов для непустого запроса: {вид: (sql, параметры)}.
+    Используются поиском и проверкой планов (migrations.HOT_QUERIES).
+    """
+    q = fold_name(query)
+    # Кандидаты по префиксу берутся из индекса (user_id, name_norm); точное совпадение
+    # всегда первое в диапазоне, поэтому в ограниченный набор кандидатов оно попадает
+    queries = {'prefix': ('''SELECT id FROM products WHERE user_id = :uid AND name_norm >= :q
+        AND name_norm < :upper ORDER BY name_norm LIMIT :candidates''',
+                          {'uid': user_id, 'q': q, 'upper': q + '\U0010ffff', 'candidates': CANDIDATES})}
+    if len(q) >= TRIGRAM_MIN_LENGTH:
+        # Продукты пользователя с первой и последней триграммой запроса — два поиска по первичному
+        # ключу (user_id, trigram, product_id); сама подстрока проверяется по названию
+        queries['substring'] = ('''SELECT p.id FROM product_trigrams t1
+            JOIN product_trigrams t2 ON t2.user_id = t1.user_id AND t2.trigram = :last
+                AND t2.product_id = t1.product_id
+            JOIN products p ON p.id = t1.product_id
+            WHERE t1.user_id = :uid AND t1.trigram = :first AND instr(p.name_norm, :q) > 0
+            LIMIT :candidates''',
+                                {'uid': user_id, 'q': q, 'first': q[:3], 'last': q[-3:], 'candidates': CANDIDATES})
+    return queries
+
+
+def recent_query(user_id, limit=DEFAULT_LIMIT):
+    """Запрос для пустой строки поиска: недавно использованные продукты, порядок берется прямо из индекса"""
+    sql = f'''SELECT {_RANKED_COLUMNS} FROM products p WHERE p.user_id = :uid
+        ORDER BY p.last_used DESC, p.id DESC LIMIT :limit'''
+    return sql, {'uid': user_id, 'q': '', 'n': 0, 'limit': clamp_limit(limit)}
+
+
+def search_products(conn, user_id, query, limit=DEFAULT_LIMIT):
+    q = fold_name(query)
+    if not q:
+        sql, params = recent_query(user_id, limit)
+        return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    params = {'uid': user_id, 'q': q, 'n': len(q), 'limit': clamp_limit(limit)}
+
+    candidates = []
+    for sql, query_params in candidate_queries(user_id, query).values():
+        candidates.append(f'SELECT id FROM ({sql})')
+        params.update(query_params)
+    sql = f"SELECT {_RANKED_COLUMNS} FROM products p WHERE p.id IN ({' UNION '.join(candidates)}) {_RANK_ORDER}"
+    rows = conn.execute(sql, params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def merge_reference(products, reference, limit=DEFAULT_LIMIT):
+    """
+    Объединяет продукты пользователя с позициями общего справочника (nutrition_ref).
+    Позиция справочника с тем же названием, что у продукта пользователя, отбрасывается:
+    своя калорийность важнее. Порядок — по match_rank, при равенстве свои продукты первыми.
+    """
+    own = {fold_name(product['product_name']) for product in products}
+    merged = [{**product, 'source': 'user'} for product in products]
+    merged += [item for item in reference if fold_name(item['product_name']) not in own]
+    # sorted устойчива: внутри каждой группы сохраняется порядок ранжирования источника
+    merged.sort(key=lambda item: (item['match_rank'], item['source'] != 'user'))
+    return merged[:clamp_limit(limit)]
+
+
+def touch_products(conn, user_id, names, used_at):
+    """
+    Отмечает продукты, встреченные в сохраненной записи, как недавно использованные.
+    Строки продуктов меняются, поэтому они попадают в журнал изменений (версия данных и ETag списка);
+    возвращает id затронутых продуктов.
+    """
+    names = list(names)
+    touched = []
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        touched += [row[0] for row in conn.execute(
+            f'UPDATE products SET last_used=? WHERE user_id=? AND name_norm IN ({placeholders}) '
+            'AND last_used IS NOT ? RETURNING id', (used_at, user_id, *chunk, used_at)).fetchall()]
+    changelog.record(conn, user_id, 'product', touched)
+    return touched
+
+
+def _backfill_names(conn):
+    rows = conn.execute('SELECT id, product_name FROM products WHERE name_norm IS NULL').fetchall()
+    conn.executemany('UPDATE products SET name_norm=? WHERE id=?',
+                     [(fold_name(row[1]), row[0]) for row in rows])
+
+
+def _create_fts(conn):
+    # Шаг миграции 2; с миграции 7 вместо FTS5 используются триграммы product_trigrams
+    try:
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+            USING fts5(name_norm, content='products', content_rowid='id', tokenize='trigram')''')
+    except Exception:
+        # SQLite собран без FTS5 (или без trigram)
+        return
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name_norm) VALUES (new.id, new.name_norm);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name_norm) VALUES ('delete', old.id, old.name_norm);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name_norm ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name_norm) VALUES ('delete', old.id, old.name_norm);
+        INSERT INTO products_fts(rowid, name_norm) VALUES (new.id, new.name_norm);
+    END''')
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+# Шаги миграции схемы для поиска (подключаются в migrations.MIGRATIONS)
+MIGRATION_STEPS = [
+    _backfill_names,
+    'CREATE INDEX IF NOT EXISTS idx_products_user_norm ON products(user_id, name_norm)',
+    'CREATE INDEX IF NOT EXISTS idx_products_user_last_used ON products(user_id, last_used)',
+    _create_fts,
+]
+
+
+# Позиции триграмм берутся из таблицы trigram_positions: в триггерах нельзя использовать WITH RECURSIVE
+_NEW_TRIGRAMS = '''INSERT OR IGNORE INTO product_trigrams (user_id, trigram, product_id)
+        SELECT new.user_id, substr(new.name_norm, i, 3), new.id FROM trigram_positions
+        WHERE i <= length(new.name_norm) - 2'''
+_OLD_TRIGRAMS = '''DELETE FROM product_trigrams WHERE user_id = old.user_id AND product_id = old.id
+        AND trigram IN (SELECT substr(old.name_norm, i, 3) FROM trigram_positions
+                        WHERE i <= length(old.name_norm) - 2)'''
+
+
+def _create_trigrams(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS trigram_positions (i INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT OR IGNORE INTO trigram_positions (i) VALUES (?)',
+                     [(i,) for i in range(1, TRIGRAM_MAX_POSITIONS + 1)])
+    conn.execute('''CREATE TABLE IF NOT EXISTS product_trigrams (
+        user_id INTEGER NOT NULL,
+        trigram TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, trigram, product_id)
+    ) WITHOUT ROWID''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS product_trigrams_ai AFTER INSERT ON products BEGIN
+        {_NEW_TRIGRAMS};
+    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS product_trigrams_ad AFTER DELETE ON products BEGIN
+        {_OLD_TRIGRAMS};
+    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS product_trigrams_au AFTER UPDATE OF user_id, name_norm ON products
+    BEGIN
+        {_OLD_TRIGRAMS};
+        {_NEW_TRIGRAMS};
+    END''')
+    conn.execute('''INSERT OR IGNORE INTO product_trigrams (user_id, trigram, product_id)
+        SELECT p.user_id, substr(p.name_norm, t.i, 3), p.id FROM products p
+        JOIN trigram_positions t ON t.i <= length(p.name_norm) - 2''')
+
+
+def _drop_fts(conn):
+    for trigger in ('products_fts_ai', 'products_fts_ad', 'products_fts_au'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS products_fts')
+
+
+# Общий для всех пользователей индекс FTS5 заменяется триграммами с ключом по пользователю:
+# MATCH перебирал совпадения у всех пользователей и только потом отбрасывал чужие продукты
+TRIGRAM_MIGRATION_STEPS = [
+    _create_trigrams,
+    _drop_fts,
+]
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Боевой запуск API: HTTP/1.1-сервер на asyncio для ASGI-приложения (asgi.py) и несколько
+процессов-воркеров на одном порту.
+Главный процесс открывает сокет и запускает воркеры через fork, перезапускает упавшие,
+по SIGTERM/SIGINT останавливает их, дав закончить текущие запросы.
+Задания отчетов живут в памяти своего воркера, поэтому запрос статуса чужого задания
+пересылается воркеру-владельцу через его unix-сокет (id задания начинается с номера воркера).
+Пример: python server.py --workers 4 --port 8000
+"""
+
+import argparse
+import asyncio
+import http
+import os
+import re
+import secrets
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+MAX_HEADER_BYTES = 64 * 1024
+BODY_CHUNK_SIZE = 64 * 1024
+HEADER_TIMEOUT = 30.0
+KEEPALIVE_TIMEOUT = 15.0
+SHUTDOWN_TIMEOUT = 30.0
+# Перезапуск воркера, упавшего сразу после старта, не чаще раза в секунду
+RESPAWN_DELAY = 1.0
+
+_JOB_PATH = re.compile(r'^/api/report/jobs/(w\d+)-')
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _status_line(status):
+    try:
+        phrase = http.HTTPStatus(status).phrase
+    except ValueError:
+        phrase = ''
+    return f'HTTP/1.1 {status} {phrase}'.encode('latin-1')
+
+
+class HttpConnection:
+    """Одно клиентское соединение: разбор запросов (с keep-alive) и вызов ASGI-приложения"""
+
+    def __init__(self, app, reader, writer, worker_id=None, peer_dir=None):
+        self.app = app
+        self.reader = reader
+        self.writer = writer
+        self.worker_id = worker_id
+        self.peer_dir = peer_dir
+        self.server = writer.get_extra_info('sockname')
+        peer = writer.get_extra_info('peername')
+        self.client = tuple(peer[:2]) if isinstance(peer, tuple) else None
+
+    async def serve(self):
+        timeout = HEADER_TIMEOUT
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+                except asyncio.LimitOverrunError:
+                    await self._error(431)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                try:
+                    method, target, version, headers = self._parse_head(head)
+                except BadRequest:
+                    await self._error(400)
+                    return
+                owner = self._job_owner(method, target)
+                if owner is not None:
+                    await self._forward(owner, head)
+                    return
+                if not await self._handle(method, target, version, headers):
+                    return
+                timeout = KEEPALIVE_TIMEOUT
+        finally:
+            self.writer.close()
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head[:-4].decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise BadRequest()
+        if version not in ('HTTP/1.0', 'HTTP/1.1') or not target.startswith('/'):
+            raise BadRequest()
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise BadRequest()
+            headers.append((name.lower().encode('latin-1'), value.strip().encode('latin-1')))
+        return method, target, version, headers
+
+    def _job_owner(self, method, target):
+        """Воркер-владелец задания отчета, если это не текущий воркер"""
+        if self.peer_dir is None or method != 'GET':
+            return None
+        match = _JOB_PATH.match(target)
+        if match is None or match.group(1) == f'w{self.worker_id}':
+            return None
+        path = os.path.join(self.peer_dir, f'{match.group(1)}.sock')
+        return path if os.path.exists(path) else None
+
+    async def _forward(self, path, head):
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+        except OSError:
+            await self._error(502)
+            return
+        try:
+            # Ответ владельца пересылается как есть, после него соединение закрывается
+            writer.write(re.sub(rb'(?im)^connection:.*\r\n', b'', head[:-2]) + b'Connection: close\r\n\r\n')
+            await writer.drain()
+            while True:
+                chunk = await reader.read(BODY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.writer.write(chunk)
+                await self.writer.drain()
+        finally:
+            writer.close()
+
+    async def _error(self, status):
+        self.writer.write(_status_line(status) + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _handle(self, method, target, version, headers):
+        """Обрабатывает один запрос; False — соединение нужно закрыть"""
+        values = {}
+        for name, value in headers:
+            values[name] = values[name] + b',' + value if name in values else value
+        connection = values.get(b'connection', b'').lower()
+        keep_alive = (b'close' not in connection) if version == 'HTTP/1.1' else (b'keep-alive' in connection)
+        chunked = b'chunked' in values.get(b'transfer-encoding', b'').lower()
+        try:
+            remaining = 0 if chunked else int(values.get(b'content-length', 0))
+        except ValueError:
+            await self._error(400)
+            return False
+        expect_continue = values.get(b'expect', b'').lower() == b'100-continue'
+
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': version[5:],
+            'method': method,
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'server': self.server if isinstance(self.server, tuple) else None,
+            'client': self.client,
+        }
+        state = {'body_done': False, 'started': False, 'framing': None}
+        finished = asyncio.Event()
+
+        async def read_chunked():
+            size_line = await self.reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Заголовки-трейлеры не нужны, дочитываем до пустой строки
+                while await self.reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return b'', False
+            data = await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+            return data, True
+
+        async def receive():
+            nonlocal remaining, expect_continue
+            if state['body_done']:
+                # Тело уже отдано: приложение ждет отключения клиента, а мы — конца ответа
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+            if expect_continue:
+                expect_continue = False
+                self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            try:
+                if chunked:
+                    data, more = await read_chunked()
+                else:
+                    data = await self.reader.readexactly(min(remaining, BODY_CHUNK_SIZE)) if remaining else b''
+                    remaining -= len(data)
+                    more = remaining > 0
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                state['body_done'] = True
+                return {'type': 'http.disconnect'}
+            state['body_done'] = not more
+            return {'type': 'http.request', 'body': data, 'more_body': more}
+
+        async def send(message):
+            nonlocal keep_alive
+            if self.writer.is_closing():
+                raise ConnectionResetError('Клиент закрыл соединение')
+            if message['type'] == 'http.response.start':
+                state['started'] = True
+                state['status'], state['headers'] = message['status'], list(message.get('headers', []))
+                return
+            body, more = message.get('body', b''), message.get('more_body', False)
+            out = b''
+            if state['framing'] is None:
+                names = {name.lower() for name, _ in state['headers']}
+                if b'content-length' in names or state['status'] in (204, 304) or method == 'HEAD':
+                    state['framing'] = 'length'
+                elif not more:
+                    state['framing'] = 'length'
+                    state['headers'].append((b'content-length', str(len(body)).encode('ascii')))
+                elif version == 'HTTP/1.1':
+                    state['framing'] = 'chunked'
+                    state['headers'].append((b'transfer-encoding', b'chunked'))
+                else:
+                    state['framing'] = 'close'
+                    keep_alive = False
+                if not state['body_done']:
+                    # Непрочитанное тело запроса не даст разобрать следующий запрос
+                    keep_alive = False
+                lines = [_status_line(state['status'])]
+                lines += [name + b': ' + value for name, value in state['headers']]
+                if not keep_alive:
+                    lines.append(b'Connection: close')
+                out = b'\r\n'.join(lines) + b'\r\n\r\n'
+            if method != 'HEAD' and body:
+                out += b'%x\r\n%b\r\n' % (len(body), body) if state['framing'] == 'chunked' else body
+            if not more:
+                if state['framing'] == 'chunked' and method != 'HEAD':
+                    out += b'0\r\n\r\n'
+                finished.set()
+            if out:
+                self.writer.write(out)
+                await self.writer.drain()
+
+        try:
+            await self.app(scope, receive, send)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return False
+        except Exception as e:
+            if type(e).__name__ != 'ClientDisconnected':
+                print(f'Ошибка обработки {method} {path}: {e!r}', file=sys.stderr)
+            if not state['started']:
+                await self._error(500)
+            return False
+        if not finished.is_set():
+            return False
+        return keep_alive and state['framing'] != 'close'
+
+
+async def _lifespan(app, phase):
+    """Сообщает приложению о запуске или остановке (ASGI lifespan)"""
+    messages = asyncio.Queue()
+    done = asyncio.Event()
+    await messages.put({'type': f'lifespan.{phase}'})
+
+    async def send(message):
+        done.set()
+
+    task = asyncio.ensure_future(app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, messages.get, send))
+    await done.wait()
+    if phase == 'startup':
+        # Задача приложения ждет lifespan.shutdown, сохраняем ее вместе с очередью
+        return task, messages
+    await task
+
+
+async def serve(app, sock, worker_id=None, peer_dir=None):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    connections = set()
+
+    def handler(forward):
+        async def handle(reader, writer):
+            task = asyncio.current_task()
+            connections.add(task)
+            try:
+                await HttpConnection(app, reader, writer, worker_id, peer_dir if forward else None).serve()
+            finally:
+                connections.discard(task)
+        return handle
+
+    lifespan_task, lifespan_messages = await _lifespan(app, 'startup')
+    servers = [await asyncio.start_server(handler(True), sock=sock, limit=MAX_HEADER_BYTES)]
+    if peer_dir is not None:
+        # Сокет для запросов от других воркеров (статус заданий); их запросы дальше не пересылаются
+        servers.append(await asyncio.start_unix_server(handler(False), path=os.path.join(peer_dir, f'w{worker_id}.sock'),
+                                                       limit=MAX_HEADER_BYTES))
+    await stop.wait()
+
+    for server in servers:
+        server.close()
+    if connections:
+        await asyncio.wait(list(connections), timeout=SHUTDOWN_TIMEOUT)
+    await lifespan_messages.put({'type': 'lifespan.shutdown'})
+    await lifespan_task
+
+
+def run_worker(sock, worker_id=None, peer_dir=None):
+    # Приложение импортируется уже в воркере: соединения с базой и потоки у каждого процесса свои
+    if worker_id is not None:
+        os.environ['SERVER_WORKER_ID'] = str(worker_id)
+    from asgi import application
+    asyncio.run(serve(application, sock, worker_id, peer_dir))
+    return 0
+
+
+def _spawn(sock, worker_id, peer_dir):
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = run_worker(sock, worker_id, peer_dir)
+        finally:
+            # Выход без atexit и буферов родителя, но после закрытия базы самим приложением
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    return pid
+
+
+def supervise(sock, workers):
+    peer_dir = tempfile.mkdtemp(prefix='nutrition-workers-')
+    children = {_spawn(sock, worker_id, peer_dir): (worker_id, time.monotonic()) for worker_id in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id, started = children.pop(pid, (None, None))
+            if worker_id is None or stopping:
+                continue
+            print(f'Воркер {worker_id} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, '
+                  f'перезапуск', file=sys.stderr)
+            time.sleep(max(0.0, RESPAWN_DELAY - (time.monotonic() - started)))
+            children[_spawn(sock, worker_id, peer_dir)] = (worker_id, time.monotonic())
+    finally:
+        shutil.rmtree(peer_dir, ignore_errors=True)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сервер API дневника питания (ASGI, несколько процессов)')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1)),
+                        help='Число процессов-воркеров')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('ASGI_THREADS', 32)),
+                        help='Потоков для обработчиков в каждом воркере')
+    args = parser.parse_args(argv)
+
+    workers = args.workers if hasattr(os, 'fork') else 1
+    os.environ['SERVER_WORKERS'] = str(workers)
+    os.environ['ASGI_THREADS'] = str(args.threads)
+    # Токены сессий должны проверяться в любом воркере: ключ подписи общий
+    os.environ.setdefault('SESSION_SECRET', secrets.token_hex(32))
+    os.makedirs('reports', exist_ok=True)
+
+    sock = socket.create_server((args.host, args.port), backlog=2048)
+    sock.setblocking(False)
+    print(f'Сервер запущен на http://{args.host}:{args.port}, воркеров: {workers}, потоков: {args.threads}',
+          flush=True)
+    if workers == 1:
+        return run_worker(sock)
+    return supervise(sock, workers)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+Шардирование базы по пользователям.
+Справочник пользователей (id, логин, номер шарда) лежит в небольшой общей базе catalog.sqlite3,
+все остальные данные пользователя — этапы, записи, продукты и производные таблицы — в файле
+его шарда. Шард — это обычная Database со своим пулом и своим потоком-писателем, поэтому
+запись в разные шарды не конкурирует за одну блокировку.
+
+Шарды открываются лениво и закрываются по LRU, когда открытых больше max_open_shards
+или шард простаивает дольше idle_timeout. Ключи строк (этапов, записей, продуктов)
+выдаются каждым шардом из своего диапазона SHARD_ID_SPAN, поэтому по одному stage_id
+понятно, в каком шарде лежит этап.
+
+Файлы шардов создаются только записью известного каталогу пользователя (и переносом пользователей).
+Чтение для пользователя без шарда, в том числе неизвестного, идет в пустой шард empty.sqlite3,
+в который никогда не пишут: ответы те же, что у обычной Database для пользователя без данных.
+"""
+
+import glob
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import changelog
+import daily_metrics
+import rollups
+from cache import ProductCache
+from database import ConnectionPool, Database
+
+# Диапазон ключей одного шарда: шард n выдает id из (n * SHARD_ID_SPAN, (n + 1) * SHARD_ID_SPAN]
+SHARD_ID_SPAN = 10 ** 9
+# Таблицы с AUTOINCREMENT, ключи которых должны быть уникальны между шардами
+SHARDED_TABLES = ('stages', 'entries', 'products')
+
+_SHARD_FILE = re.compile(r'shard_(\d+)\.sqlite3$')
+
+
+class UnknownUserError(LookupError):
+    """Пользователя нет в каталоге: записывать его данные некуда"""
+
+
+def open_database(db_path='db.sqlite3', shard_dir=None, shard_buckets=16, **options):
+    """Обычная база или шардированная (если указан shard_dir)"""
+    if shard_dir:
+        options.pop('replica_path', None)
+        return ShardedDatabase(shard_dir, buckets=shard_buckets, **options)
+    return Database(db_path, **options)
+
+
+def shard_of_id(row_id):
+    """Номер шарда по ключу этапа, записи или продукта"""
+    return (int(row_id) - 1) // SHARD_ID_SPAN
+
+
+def _copy_user(source, target, user_id):
+    """
+    Копирует данные пользователя из соединения source в target с новыми ключами target.
+    Производные таблицы (daily_metrics, stage_rollups) в target пересчитываются, журнал изменений
+    пользователя в target начинается заново (клиенты получат полную синхронизацию).
+    """
+    stage_ids = {}
+    for row in source.execute('SELECT * FROM stages WHERE user_id=? ORDER BY id', (user_id,)).fetchall():
+        columns = [key for key in row.keys() if key != 'id']
+        stage_ids[row['id']] = target.execute(
+            f"INSERT INTO stages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) RETURNING id",
+            [row[key] for key in columns]).fetchone()[0]
+
+    entry_ids = []
+    cursor = source.execute('SELECT * FROM entries WHERE user_id=? ORDER BY id', (user_id,))
+    for row in iter(lambda: cursor.fetchmany(500), []):
+        for entry in row:
+            columns = [key for key in entry.keys() if key != 'id']
+            values = [stage_ids.get(entry['stage_id'], entry['stage_id']) if key == 'stage_id' else entry[key]
+                      for key in columns]
+            entry_ids.append(target.execute(
+                f"INSERT INTO entries ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) RETURNING id",
+                values).fetchone()[0])
+
+    products = 0
+    cursor = source.execute('SELECT * FROM products WHERE user_id=? ORDER BY id', (user_id,))
+    for row in iter(lambda: cursor.fetchmany(500), []):
+        columns = [key for key in row[0].keys() if key != 'id']
+        target.executemany(f"INSERT INTO products ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                           [[product[key] for key in columns] for product in row])
+        products += len(row)
+
+    daily_metrics.refresh(target, entry_ids)
+    rollups.rebuild(target, list(stage_ids.values()))
+    changelog.carry_over(source, target, user_id)
+    return {'stages': len(stage_ids), 'entries': len(entry_ids), 'products': products}
+
+
+def _delete_user(conn, user_id):
+    """Удаляет из шарда все данные пользователя"""
+    conn.execute('DELETE FROM daily_metrics WHERE user_id=?', (user_id,))
+    conn.execute('DELETE FROM stage_rollups WHERE user_id=?', (user_id,))
+    conn.execute('DELETE FROM change_log WHERE user_id=?', (user_id,))
+    for table in ('entries', 'products', 'stages'):
+        conn.execute(f'DELETE FROM {table} WHERE user_id=?', (user_id,))
+
+
+class _OpenShard:
+    __slots__ = ('db', 'leases', 'last_used')
+
+    def __init__(self, db):
+        self.db = db
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+
+class ShardedDatabase:
+    """
+    Тот же интерфейс, что у Database, с маршрутизацией вызовов по user_id (или по stage_id).
+    buckets — число шардов-корзин (user_id % buckets); None — отдельный файл на каждого пользователя.
+    """
+
+    def __init__(self, shard_dir='shards', buckets=16, max_open_shards=32, idle_timeout=300.0,
+                 pool_size=8, product_cache=None, **db_options):
+        self.shard_dir = shard_dir
+        self.buckets = buckets
+        self.max_open_shards = max_open_shards
+        self.idle_timeout = idle_timeout
+        self.pool_size = pool_size
+        self.db_options = db_options
+        os.makedirs(shard_dir, exist_ok=True)
+        self.db_path = os.path.join(shard_dir, 'catalog.sqlite3')
+        self.catalog = ConnectionPool(self.db_path, size=pool_size)
+        self.product_cache = product_cache or ProductCache()
+        self._shards = OrderedDict()
+        self._user_shards = {}
+        self._lock = threading.Lock()
+        self._empty_db = None
+        self._entry_listeners = []
+        self._stage_listeners = []
+
+    def spec(self):
+        """Параметры для открытия той же базы в другом процессе (см. open_database)"""
+        return {'shard_dir': self.shard_dir, 'shard_buckets': self.buckets}
+
+    # ---------- шарды ----------
+
+    def shard_path(self, shard):
+        return os.path.join(self.shard_dir, f'shard_{shard:05d}.sqlite3')
+
+    def shard_for_new_user(self, user_id):
+        return user_id if self.buckets is None else user_id % self.buckets
+
+    def existing_shards(self):
+        """Номера шардов, для которых есть файл"""
+        shards = []
+        for path in glob.glob(os.path.join(glob.escape(self.shard_dir), 'shard_*.sqlite3')):
+            match = _SHARD_FILE.search(path)
+            if match:
+                shards.append(int(match.group(1)))
+        return sorted(shards)
+
+    def has_shard(self, shard):
+        """Есть ли шард (открыт или есть его файл); недопустимые номера — нет"""
+        if shard < 0 or shard >= 2 ** 63 // SHARD_ID_SPAN:
+            return False
+        with self._lock:
+            return shard in self._shards or os.path.exists(self.shard_path(shard))
+
+    def _open(self, shard):
+        if shard < 0 or shard >= 2 ** 63 // SHARD_ID_SPAN:
+            raise ValueError(f'Недопустимый номер шарда: {shard}')
+        db = Database(self.shard_path(shard), pool_size=self.pool_size, product_cache=self.product_cache,
+                      **self.db_options)
+        db.init_database()
+        with db.connection() as conn:
+            # Ключи шарда начинаются с его диапазона (строки sqlite_sequence создаются один раз)
+            for table in SHARDED_TABLES:
+                conn.execute('''INSERT INTO sqlite_sequence (name, seq)
+                                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)''',
+                             (table, shard * SHARD_ID_SPAN, table))
+        for listener in self._entry_listeners:
+            db.add_entry_listener(listener)
+        for listener in self._stage_listeners:
+            db.add_stage_listener(listener)
+        return db
+
+    def _evict(self):
+        # Вызывается под self._lock; закрывает давно не используемые шарды без активных аренд
+        now = time.monotonic()
+        closing = []
+        for shard, entry in list(self._shards.items()):
+            if entry.leases:
+                continue
+            if len(self._shards) - len(closing) > self.max_open_shards or now - entry.last_used > self.idle_timeout:
+                closing.append(shard)
+        for shard in closing:
+            closing_entry = self._shards.pop(shard)
+            closing_entry.db.close()
+
+    @contextmanager
+    def shard(self, shard, create=True):
+        """
+        Аренда шарда: пока блок выполняется, шард не будет закрыт.
+        create=False — только существующий шард, для несуществующего LookupError.
+        """
+        with self._lock:
+            entry = self._shards.get(shard)
+            if entry is None:
+                if not create and not os.path.exists(self.shard_path(shard)):
+                    raise LookupError(f'Шард {shard} не найден')
+                # Открытие под общей блокировкой: шард не откроется дважды
+                entry = self._shards[shard] = _OpenShard(self._open(shard))
+            self._shards.move_to_end(shard)
+            entry.leases += 1
+        try:
+            yield entry.db
+        finally:
+            with self._lock:
+                entry.leases -= 1
+                entry.last_used = time.monotonic()
+                self._evict()
+
+    def open_shards(self):
+        with self._lock:
+            return list(self._shards)
+
+    def _empty(self):
+        # Пустой шард для чтения данных пользователей без шарда; открывается один раз
+        with self._lock:
+            if self._empty_db is None:
+                db = Database(os.path.join(self.shard_dir, 'empty.sqlite3'), pool_size=self.pool_size,
+                              **{**self.db_options, 'group_commit': False})
+                db.init_database()
+                self._empty_db = db
+            return self._empty_db
+
+    # ---------- каталог пользователей ----------
+
+    def init_database(self):
+        with self.catalog.connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                username TEXT UNIQUE NOT NULL,
+                                shard INTEGER NOT NULL
+                            )''')
+        # Схема шардов обновляется при их открытии (Database.init_database)
+
+    def user_shard(self, user_id):
+        """Шард пользователя по каталогу; для неизвестного пользователя UnknownUserError"""
+        user_id = int(user_id)
+        shard = self._user_shards.get(user_id)
+        if shard is None:
+            with self.catalog.connection() as conn:
+                row = conn.execute('SELECT shard FROM users WHERE id=?', (user_id,)).fetchone()
+            if row is None:
+                raise UnknownUserError(f'Пользователь {user_id} не найден')
+            shard = self._user_shards[user_id] = row[0]
+        return shard
+
+    def _user_shard_db(self, user_id):
+        """Шард для записи данных пользователя (создается при первой записи)"""
+        return self.shard(self.user_shard(user_id))
+
+    @contextmanager
+    def _read_shard_db(self, user_id):
+        """Шард для чтения: без шарда (или без пользователя в каталоге) — пустой шард"""
+        try:
+            shard = self.user_shard(user_id)
+        except UnknownUserError:
+            shard = None
+        if shard is None or not self.has_shard(shard):
+            yield self._empty()
+            return
+        with self.shard(shard) as db:
+            yield db
+
+    def login_user(self, username):
+        with self.catalog.connection() as conn:
+            user = conn.execute('SELECT id, username, shard FROM users WHERE username=?', (username,)).fetchone()
+            is_new = user is None
+            if is_new:
+                row = conn.execute('INSERT INTO users (username, shard) VALUES (?, -1) '
+                                   'ON CONFLICT(username) DO NOTHING RETURNING id', (username,)).fetchone()
+                if row is None:
+                    # Пользователя успел создать параллельный запрос
+                    return self.login_user(username)
+                shard = self.shard_for_new_user(row[0])
+                conn.execute('UPDATE users SET shard=? WHERE id=?', (shard, row[0]))
+                user = {'id': row[0], 'username': username, 'shard': shard}
+        self._user_shards[user['id']] = user['shard']
+        if is_new:
+            return {'id': user['id'], 'username': username, 'is_new': True, 'current_stage': None}
+        with self._read_shard_db(user['id']) as db:
+            return {'id': user['id'], 'username': user['username'], 'is_new': False,
+                    'current_stage': db.get_active_stage(user['id'])}
+
+    def get_user_by_id(self, user_id):
+        with self.catalog.connection() as conn:
+            user = conn.execute('SELECT id, username, shard FROM users WHERE id=?', (user_id,)).fetchone()
+        if user is None:
+            return None
+        self._user_shards[user['id']] = user['shard']
+        with self._read_shard_db(user['id']) as db:
+            return {'id': user['id'], 'username': user['username'], 'current_stage': db.get_active_stage(user['id'])}
+
+    # ---------- маршрутизация ----------
+
+    def add_entry_listener(self, listener):
+        self._entry_listeners.append(listener)
+        with self._lock:
+            for entry in self._shards.values():
+                entry.db.add_entry_listener(listener)
+
+    def add_stage_listener(self, listener):
+        self._stage_listeners.append(listener)
+        with self._lock:
+            for entry in self._shards.values():
+                entry.db.add_stage_listener(listener)
+
+    def _by_user(name, write=False):
+        def method(self, user_id, *args, **kwargs):
+            with (self._user_shard_db if write else self._read_shard_db)(user_id) as db:
+                return getattr(db, name)(user_id, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(Database, name).__doc__
+        return method
+
+    def _by_stage(name):
+        def method(self, stage_id, *args, **kwargs):
+            shard = self._stage_shard(stage_id)
+            if shard is None:
+                # Этапа нет ни в одном шарде: как у Database для несуществующего этапа
+                return None
+            with self.shard(shard, create=False) as db:
+                return getattr(db, name)(stage_id, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(Database, name).__doc__
+        return method
+
+    create_stage = _by_user('create_stage', write=True)
+    get_active_stage = _by_user('get_active_stage')
+    save_daily_entry = _by_user('save_daily_entry', write=True)
+    patch_daily_entry = _by_user('patch_daily_entry', write=True)
+    delete_daily_entry = _by_user('delete_daily_entry', write=True)
+    get_entry_by_date = _by_user('get_entry_by_date')
+    range_version = _by_user('range_version')
+    get_user_entries = _by_user('get_user_entries')
+    get_entry_history = _by_user('get_entry_history')
+    add_product = _by_user('add_product', write=True)
+    get_user_products = _by_user('get_user_products')
+    search_products = _by_user('search_products')
+    get_weight_statistics = _by_user('get_weight_statistics')
+    get_trends = _by_user('get_trends')
+    import_batch = _by_user('import_batch', write=True)
+    get_changes = _by_user('get_changes')
+    data_version = _by_user('data_version')
+    poll_changes = _by_user('poll_changes')
+    complete_stage = _by_stage('complete_stage')
+    get_stage_summary = _by_stage('get_stage_summary')
+    del _by_user, _by_stage
+
+    def _stage_shard(self, stage_id):
+        """Существующий шард этапа по его ключу или None — шард по чужому id не создается"""
+        try:
+            shard = shard_of_id(stage_id)
+        except (TypeError, ValueError):
+            return None
+        return shard if self.has_shard(shard) else None
+
+    def iter_entries(self, user_id, *args, **kwargs):
+        with self._read_shard_db(user_id) as db:
+            yield from db.iter_entries(user_id, *args, **kwargs)
+
+    def iter_rows(self, user_id, *args, **kwargs):
+        with self._read_shard_db(user_id) as db:
+            yield from db.iter_rows(user_id, *args, **kwargs)
+
+    def submit(self, method, *args, **kwargs):
+        """Как Database.submit: db.submit(db.save_daily_entry, user_id, ...) -> Future"""
+        name = method.__name__
+        if name == 'complete_stage':
+            shard = self._stage_shard(args[0])
+            if shard is None:
+                future = Future()
+                future.set_result(None)
+                return future
+            with self.shard(shard, create=False) as db:
+                return db.submit(db.complete_stage, *args, **kwargs)
+        with self._user_shard_db(args[0]) as db:
+            return db.submit(getattr(db, name), *args, **kwargs)
+
+    def rebuild_stage_rollups(self, stage_ids=None):
+        if stage_ids is None:
+            for db in self.databases():
+                db.rebuild_stage_rollups()
+            return
+        by_shard = {}
+        for stage_id in stage_ids:
+            shard = self._stage_shard(stage_id)
+            if shard is not None:
+                by_shard.setdefault(shard, []).append(stage_id)
+        for shard, ids in by_shard.items():
+            with self.shard(shard, create=False) as db:
+                db.rebuild_stage_rollups(ids)
+
+    def compact_entries(self):
+        return sum(db.compact_entries() for db in self.databases())
+
+    def iter_batch_trends(self, user_ids=None, **options):
+        if user_ids is None:
+            for db in self.databases():
+                yield from db.iter_batch_trends(None, **options)
+            return
+        by_shard = {}
+        for user_id in user_ids:
+            try:
+                shard = self.user_shard(user_id)
+            except UnknownUserError:
+                continue
+            if self.has_shard(shard):
+                by_shard.setdefault(shard, []).append(user_id)
+        for shard, ids in sorted(by_shard.items()):
+            with self.shard(shard, create=False) as db:
+                yield from db.iter_batch_trends(ids, **options)
+
+    def databases(self):
+        """Все шарды по очереди (каждый арендуется на время обработки)"""
+        for shard in self.existing_shards():
+            with self.shard(shard) as db:
+                yield db
+
+    # ---------- перенос пользователей ----------
+
+    def move_user(self, user_id, target_shard):
+        """
+        Переносит пользователя в другой шард: копия с новыми ключами, переключение каталога,
+        удаление из старого шарда. Ключи этапов, записей и продуктов пользователя меняются,
+        поэтому переносить нужно при остановленном приложении.
+        """
+        source_shard = self.user_shard(user_id)
+        if source_shard == target_shard:
+            return None
+        with self.shard(source_shard) as source, self.shard(target_shard) as target:
+            with target.connection() as target_conn, source.read_connection() as source_conn:
+                # Остатки прерванного переноса удаляем, чтобы повтор не создал дублей
+                _delete_user(target_conn, user_id)
+                counts = _copy_user(source_conn, target_conn, user_id)
+            with self.catalog.connection() as conn:
+                conn.execute('UPDATE users SET shard=? WHERE id=?', (target_shard, user_id))
+            self._user_shards[int(user_id)] = target_shard
+            with source.connection() as source_conn:
+                _delete_user(source_conn, user_id)
+        # У этапов новые ключи: сбрасываем кэши, где они могли остаться
+        self.product_cache.invalidate(int(user_id))
+        for listener in self._stage_listeners:
+            listener(int(user_id))
+        return counts
+
+    def rebalance(self, dry_run=False):
+        """
+        Переносит пользователей, чей шард не совпадает с текущей схемой (число корзин или
+        шард на пользователя). Возвращает список (user_id, откуда, куда).
+        """
+        with self.catalog.connection() as conn:
+            users = conn.execute('SELECT id, shard FROM users ORDER BY id').fetchall()
+        moves = [(row['id'], row['shard'], self.shard_for_new_user(row['id'])) for row in users
+                 if row['shard'] != self.shard_for_new_user(row['id'])]
+        if not dry_run:
+            for user_id, _, target in moves:
+                self.move_user(user_id, target)
+        return moves
+
+    def import_database(self, source_path):
+        """
+        Переносит пользователей из обычной (нешардированной) базы, сохраняя их id и логины.
+        Уже импортированные пользователи пропускаются. Возвращает число перенесенных.
+        """
+        source = Database(source_path, pool_size=1, group_commit=False)
+        try:
+            source.init_database()
+            imported = 0
+            with source.read_connection() as source_conn:
+                users = source_conn.execute('SELECT id, username FROM users ORDER BY id').fetchall()
+                for user in users:
+                    with self.catalog.connection() as conn:
+                        known = conn.execute('SELECT 1 FROM users WHERE id=? OR username=?',
+                                             (user['id'], user['username'])).fetchone()
+                    if known:
+                        continue
+                    # Сначала данные, потом запись в каталоге: прерванный импорт можно просто повторить
+                    shard = self.shard_for_new_user(user['id'])
+                    with self.shard(shard) as target, target.connection() as target_conn:
+                        _delete_user(target_conn, user['id'])
+                        _copy_user(source_conn, target_conn, user['id'])
+                    with self.catalog.connection() as conn:
+                        conn.execute('INSERT INTO users (id, username, shard) VALUES (?, ?, ?)',
+                                     (user['id'], user['username'], shard))
+                    self._user_shards[user['id']] = shard
+                    imported += 1
+            return imported
+        finally:
+            source.close()
+
+    def close(self):
+        with self._lock:
+            shards, self._shards = list(self._shards.values()), OrderedDict()
+            empty, self._empty_db = self._empty_db, None
+        for entry in shards:
+            entry.db.close()
+        if empty is not None:
+            empty.close()
+        self.catalog.close_all()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Общие фикстуры тестов. Модули backend импортируются как в приложении: из каталога backend.
+Запуск: python -m pytest (из каталога backend)
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+def open_db(directory):
+    """База в каталоге directory с применёнными миграциями"""
+    database = Database(str(directory / 'db.sqlite3'))
+    database.init_database()
+    return database
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = open_db(tmp_path)
+    yield database
+    database.close()
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """Модуль app: база, отчеты и справочник открываются в текущем каталоге, поэтому — во временном"""
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
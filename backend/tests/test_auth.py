@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Токены сессии (AuthManager.issue_token / verify_token)"""
+
+import pytest
+
+from auth import AuthManager
+
+
+@pytest.fixture
+def auth(db):
+    return AuthManager(db, secret='test-secret')
+
+
+def test_issued_token_is_valid(auth):
+    assert auth.verify_token(auth.issue_token(42)) == 42
+
+
+@pytest.mark.parametrize('token', [None, '', '1.2', 'a.b.c', '1.2.подпись', '1.2.sig.extra'])
+def test_malformed_token_is_rejected(auth, token):
+    assert auth.verify_token(token) is None
+
+
+def test_tampered_signature_is_rejected(auth):
+    token = auth.issue_token(42)
+    assert auth.verify_token(token[:-1] + 'я') is None
+    assert auth.verify_token(token.replace('42.', '43.', 1)) is None
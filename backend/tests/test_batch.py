@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Пакет запросов /api/batch"""
+
+
+def product_names(response):
+    return [product['product_name'] for product in response['body']['products']]
+
+
+def test_gets_see_writes_in_request_order(client):
+    user_id = 7201
+    add = {'method': 'POST', 'path': '/api/products/add',
+           'body': {'user_id': user_id, 'product_name': 'Кефир', 'calories_per_100g': 50}}
+    listing = {'method': 'GET', 'path': f'/api/products/list/{user_id}'}
+
+    response = client.post('/api/batch', json={'requests': [
+        {'id': 'before', **listing},
+        {'id': 'also-before', **listing},
+        {'id': 'add', **add},
+        {'id': 'after', **listing},
+    ]})
+
+    assert response.status_code == 200
+    responses = response.get_json()['responses']
+    assert [item['id'] for item in responses] == ['before', 'also-before', 'add', 'after']
+    assert [item['status'] for item in responses] == [200, 200, 200, 200]
+    assert product_names(responses[0]) == product_names(responses[1]) == []
+    assert product_names(responses[3]) == ['Кефир']
+
+
+def test_excluded_paths_fail_only_their_subrequest(client):
+    response = client.post('/api/batch', json={'requests': [
+        {'id': 'nested', 'method': 'POST', 'path': '/api/batch', 'body': {'requests': []}},
+        {'id': 'export', 'path': '/api/export/1'},
+        {'id': 'page', 'path': '/index.html'},
+        {'id': 'sync', 'path': '/api/sync/7202'},
+    ]})
+
+    responses = response.get_json()['responses']
+    assert [item['status'] for item in responses] == [400, 400, 400, 200]
+
+
+def test_malformed_batch_is_rejected(client, app_module):
+    assert client.post('/api/batch', json={'requests': []}).status_code == 400
+    assert client.post('/api/batch', json={'requests': ['/api/sync/1']}).status_code == 400
+    too_many = [{'path': '/api/sync/1'}] * (app_module.BATCH_MAX_REQUESTS + 1)
+    assert client.post('/api/batch', json={'requests': too_many}).status_code == 400
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Массовый импорт записей (bulk.import_records)"""
+
+import bulk
+
+
+def entry_version(db, entry_id):
+    with db.connection() as conn:
+        return conn.execute("SELECT version FROM change_log WHERE kind='entry' AND row_id=?",
+                            (entry_id,)).fetchone()[0]
+
+
+def test_import_does_not_touch_same_date_in_other_stage(db):
+    first = db.create_stage(1, 'cut', '2025-01-01', 80.0)
+    second = db.create_stage(1, 'cut', '2025-02-01', 79.0)
+    other = db.save_daily_entry(1, first, '2025-01-10', {'morning_weight': 80}, [])
+    version = entry_version(db, other)
+
+    records = [(1, {'type': 'entry', 'entry_date': '2025-01-10', 'stage_id': second,
+                    'daily_params': {'morning_weight': 79}, 'meals': []})]
+    result = list(bulk.import_records(db, 1, records))[-1]
+
+    assert result['entries'] == 1 and result['errors'] == 0
+    # Запись того же дня в другом этапе не изменилась и не попала в журнал изменений
+    assert entry_version(db, other) == version
+    with db.connection() as conn:
+        stages = [row[0] for row in conn.execute(
+            "SELECT stage_id FROM entries WHERE user_id=1 AND entry_date='2025-01-10' ORDER BY stage_id")]
+    assert stages == [first, second]
+
+
+def test_bad_stage_id_fails_only_its_line(db):
+    stage_id = db.create_stage(1, 'cut', '2025-01-01', 80.0)
+    records = [(1, {'type': 'entry', 'entry_date': '2025-01-10', 'stage_id': str(stage_id),
+                    'daily_params': {'morning_weight': 80}, 'meals': []}),
+               (2, {'type': 'entry', 'entry_date': '2025-01-11', 'stage_id': 'abc'}),
+               (3, {'type': 'entry', 'entry_date': '2025-01-12', 'stage_id': 1.5})]
+    result = list(bulk.import_records(db, 1, records))[-1]
+
+    assert result['entries'] == 1 and result['errors'] == 2
+    assert [line['line'] for line in result['error_lines']] == [2, 3]
+    assert [entry['entry_date'] for entry in db.get_user_entries(1)] == ['2025-01-10']
+
+
+def test_product_count_excludes_known_names(db):
+    db.add_product(1, 'Гречка', 330)
+    records = [(1, {'type': 'product', 'product_name': 'гречка', 'calories_per_100g': 330}),
+               (2, {'type': 'product', 'product_name': 'Творог', 'calories_per_100g': 120}),
+               (3, {'type': 'product', 'product_name': 'Творог', 'calories_per_100g': 121})]
+    result = list(bulk.import_records(db, 1, records))[-1]
+
+    assert result['products'] == 1
+    assert sorted(product['product_name'] for product in db.get_user_products(1)) == ['Гречка', 'Творог']
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Кэши процесса (cache.ProductCache, cache.SessionCache) и их сброс при изменении данных"""
+
+from cache import ProductCache, SessionCache
+
+
+def test_stale_products_are_rejected_after_generation_is_trimmed():
+    cache = ProductCache(max_users=1)
+    token = cache.token(1)
+    cache.invalidate(1)
+    # Поколения хранятся для max_users * 4 пользователей: пользователь 1 вытесняется
+    for user_id in range(2, 7):
+        cache.invalidate(user_id)
+    cache.put_products(1, [{'id': 1}], token)
+    assert cache.get_products(1) is None
+
+    cache.put_products(1, [{'id': 2}], cache.token(1))
+    assert cache.get_products(1) == [{'id': 2}]
+
+
+def test_stale_session_is_rejected_after_generation_is_trimmed():
+    sessions = SessionCache(max_entries=1)
+    token = sessions.token(1)
+    for user_id in range(1, 7):
+        sessions.invalidate_user(user_id)
+    sessions.put('token', {'id': 1}, token)
+    assert sessions.get('token') is None
+
+
+def test_entry_with_known_dish_refreshes_product_list_and_version(db):
+    db.add_product(1, 'Творог', 120)
+    stage_id = db.create_stage(1, 'cut', '2025-01-01', 80.0)
+    assert db.get_user_products(1)[0]['last_used'] is None
+    version = db.data_version(1)[0]
+
+    db.save_daily_entry(1, stage_id, '2025-01-02', {}, [{'name': 'Завтрак', 'dishes': [{'name': 'творог'}]}])
+
+    assert db.get_user_products(1)[0]['last_used'] is not None
+    changes = db.get_changes(1, version)
+    assert [product['product_name'] for product in changes['products']] == ['Творог']
+    assert db.data_version(1)[0] == changes['version'] > version
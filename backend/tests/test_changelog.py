@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Журнал изменений (changelog) и дельта-синхронизация /api/sync"""
+
+import changelog
+from conftest import open_db
+
+
+def fill(db, user_id=1):
+    stage_id = db.create_stage(user_id, 'cut', '2025-01-01', 80.0)
+    entry_id = db.save_daily_entry(user_id, stage_id, '2025-01-02', {'weight': 80}, [])
+    db.add_product(user_id, 'Творог', 120)
+    return stage_id, entry_id
+
+
+def test_first_sync_returns_everything(db):
+    stage_id, entry_id = fill(db)
+    fill(db, user_id=2)
+
+    changes = db.get_changes(1, 0)
+
+    assert [stage['id'] for stage in changes['stages']] == [stage_id]
+    assert [entry['id'] for entry in changes['entries']] == [entry_id]
+    assert [product['product_name'] for product in changes['products']] == ['Творог']
+    assert not changes['reset'] and not changes['has_more']
+    assert changes['version'] == db.data_version(1)[0]
+
+
+def test_only_latest_change_of_object_is_returned(db):
+    stage_id, entry_id = fill(db)
+    version = db.get_changes(1, 0)['version']
+
+    for weight in (79, 78, 77):
+        db.save_daily_entry(1, stage_id, '2025-01-02', {'weight': weight}, [])
+    changes = db.get_changes(1, version)
+    assert [entry['id'] for entry in changes['entries']] == [entry_id]
+    assert changes['stages'] == [] and changes['products'] == []
+
+    db.delete_daily_entry(1, '2025-01-02')
+    changes = db.get_changes(1, changes['version'])
+    assert changes['entries'] == []
+    assert changes['deleted']['entries'] == [entry_id]
+    # Повторный запрос с последней версией ничего не возвращает
+    assert db.get_changes(1, changes['version'])['deleted']['entries'] == []
+
+
+def test_changes_are_paged_in_version_order(db):
+    fill(db)
+    first = db.get_changes(1, 0, limit=2)
+    assert first['has_more']
+    assert [len(first[table]) for table in ('stages', 'entries', 'products')] == [1, 1, 0]
+
+    rest = db.get_changes(1, first['version'], limit=2)
+    assert not rest['has_more']
+    assert [product['product_name'] for product in rest['products']] == ['Творог']
+
+
+def test_unknown_or_moved_version_requires_full_sync(db, tmp_path):
+    fill(db)
+    version = db.get_changes(1, 0)['version']
+    assert db.get_changes(1, version + 100)['reset']
+
+    # Пользователь перенесен в другую базу: старая версия клиента там недействительна
+    (tmp_path / 'target').mkdir()
+    target = open_db(tmp_path / 'target')
+    try:
+        fill(target)
+        with db.connection() as source, target.connection() as conn:
+            changelog.carry_over(source, conn, 1)
+        changes = target.get_changes(1, version)
+        assert changes['reset']
+        assert len(changes['stages']) == len(changes['entries']) == len(changes['products']) == 1
+        assert not target.get_changes(1, changes['version'])['reset']
+    finally:
+        target.close()
+
+
+def test_sync_endpoint(client, app_module):
+    user_id = 7001
+    stage_id, entry_id = fill(app_module.db, user_id)
+
+    response = client.get(f'/api/sync/{user_id}?since=-5')
+    data = response.get_json()
+    assert response.status_code == 200 and data['success']
+    assert [entry['id'] for entry in data['entries']] == [entry_id]
+    assert [stage['id'] for stage in data['stages']] == [stage_id]
+
+    app_module.db.delete_daily_entry(user_id, '2025-01-02')
+    data = client.get(f"/api/sync/{user_id}?since={data['version']}").get_json()
+    assert data['entries'] == [] and data['deleted']['entries'] == [entry_id]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Условные GET по версии данных пользователя (app.conditional_by_user)"""
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def executed(monkeypatch):
+    executed = []
+    monkeypatch.setattr(metrics, 'observe_query', lambda sql, seconds: executed.append(sql))
+    return executed
+
+
+def data_queries(executed):
+    """Запросы к данным, кроме чтения версий из журнала изменений"""
+    return [sql for sql in executed if 'change_log' not in sql and not sql.startswith('PRAGMA')]
+
+
+@pytest.mark.parametrize('url', ['/api/products/list/{}', '/api/entry/history/{}', '/api/stats/weight/{}'])
+def test_unchanged_data_is_answered_before_any_query(client, app_module, executed, url):
+    user_id = 7101
+    app_module.db.add_product(user_id, 'Кефир', 50)
+    first = client.get(url.format(user_id))
+    assert first.status_code == 200 and first.headers['ETag']
+    assert data_queries(executed)
+
+    executed.clear()
+    response = client.get(url.format(user_id), headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert data_queries(executed) == []
+
+    response = client.get(url.format(user_id), headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert response.status_code == 304
+
+
+def test_changed_data_gets_new_etag(client, app_module):
+    user_id = 7102
+    app_module.db.add_product(user_id, 'Кефир', 50)
+    stage_id = app_module.db.create_stage(user_id, 'cut', '2025-01-01', 80.0)
+    url = f'/api/products/list/{user_id}'
+    etag = client.get(url).headers['ETag']
+
+    # Продукт из записи дня получает новый last_used — список продуктов изменился
+    app_module.db.save_daily_entry(user_id, stage_id, '2025-01-02', {}, [{'name': 'кефир'}])
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['products'][0]['last_used'] is not None
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""Постраничная история записей (entries.history_query)"""
+
+import pytest
+
+import entries
+
+
+@pytest.mark.parametrize('limit', [0, -5, 'abc', '1.5', None])
+def test_invalid_limit_is_rejected(limit):
+    with pytest.raises(ValueError):
+        entries.history_query(1, limit)
+
+
+@pytest.mark.parametrize('limit, fetched', [(1, 2), ('30', 31), (entries.MAX_HISTORY_LIMIT + 1000,
+                                                                  entries.MAX_HISTORY_LIMIT + 1)])
+def test_limit_is_capped_from_above(limit, fetched):
+    _, params = entries.history_query(1, limit)
+    assert params[-1] == fetched
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Замер SQL-выражений (database.TimedCursor -> metrics)"""
+
+import time
+
+import pytest
+
+import metrics
+from database import ConnectionPool
+
+
+@pytest.fixture
+def observed(tmp_path, monkeypatch):
+    """Пул с таблицей из 50 строк и список замеров (sql, секунды)"""
+    calls = []
+    monkeypatch.setattr(metrics, 'observe_query', lambda sql, seconds: calls.append((sql, seconds)))
+    pool = ConnectionPool(str(tmp_path / 'db.sqlite3'))
+    with pool.connection() as conn:
+        conn.create_function('slow', 1, lambda value: time.sleep(0.002) or value)
+        conn.execute('CREATE TABLE t (v INTEGER)')
+        conn.executemany('INSERT INTO t (v) VALUES (?)', [(i,) for i in range(50)])
+        calls.clear()
+        yield conn, calls
+    pool.close_all()
+
+
+def scan(calls):
+    return [seconds for sql, seconds in calls if sql.startswith('SELECT slow')]
+
+
+@pytest.mark.parametrize('read', [
+    lambda cursor: list(cursor),
+    lambda cursor: cursor.fetchall(),
+    lambda cursor: [row for rows in iter(lambda: cursor.fetchmany(7), []) for row in rows],
+])
+def test_scan_is_timed_until_last_row(observed, read):
+    conn, calls = observed
+    rows = read(conn.execute('SELECT slow(v) FROM t'))
+    assert len(rows) == 50
+    timings = scan(calls)
+    # 50 строк по 2 мс: время до первой строки было бы около 2 мс
+    assert len(timings) == 1 and timings[0] >= 0.09
+
+
+def test_partially_read_cursor_is_recorded_once(observed):
+    conn, calls = observed
+    assert conn.execute('SELECT slow(v) FROM t').fetchone() is not None
+    conn.execute('SELECT 1').fetchone()
+    assert len(scan(calls)) == 1
+
+
+def test_statement_without_rows_is_recorded_immediately(observed):
+    conn, calls = observed
+    conn.execute('UPDATE t SET v = v + 1')
+    assert [sql for sql, _ in calls] == ['UPDATE t SET v = v + 1']
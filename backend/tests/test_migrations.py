@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Миграции схемы и планы частых запросов (migrations.HOT_QUERIES)"""
+
+from datetime import date, timedelta
+
+import pytest
+
+import metrics
+import migrations
+from conftest import open_db
+
+HOT_QUERY_NAMES = sorted(migrations.HOT_QUERIES)
+
+
+def fill(db, users=3, days=60, products=200):
+    """Несколько пользователей с записями и продуктами, чтобы планировщик видел статистику по данным"""
+    start = date(2025, 1, 1)
+    for user_id in range(1, users + 1):
+        stage_id = db.create_stage(user_id, 'cut', start.isoformat(), 80.0)
+        for day in range(days):
+            db.save_daily_entry(user_id, stage_id, (start + timedelta(days=day)).isoformat(),
+                                {'weight': 80.0 - day * 0.05, 'calories': 2000},
+                                [{'name': 'Завтрак', 'dishes': [{'name': 'Курица грудка', 'mass': 150}]}])
+        for number in range(products):
+            db.add_product(user_id, f'Курица грудка {number}' if number % 2 else f'Творог {number}', 110)
+    with db.connection() as conn:
+        conn.execute('ANALYZE')
+
+
+@pytest.fixture(scope='module')
+def filled_db(tmp_path_factory):
+    database = open_db(tmp_path_factory.mktemp('filled'))
+    fill(database)
+    yield database
+    database.close()
+
+
+def test_migrations_are_applied_once(db):
+    with db.connection() as conn:
+        assert migrations.current_version(conn) == max(version for version, _, _ in migrations.MIGRATIONS)
+        assert migrations.apply_migrations(conn) == []
+
+
+@pytest.mark.parametrize('database', ['db', 'filled_db'], ids=['empty', 'filled'])
+@pytest.mark.parametrize('name', HOT_QUERY_NAMES)
+def test_hot_query_uses_index(request, database, name):
+    db = request.getfixturevalue(database)
+    sql, params = migrations.HOT_QUERIES[name]
+    with db.connection() as conn:
+        plan = migrations.explain(conn, sql, params)
+        assert migrations.check_hot_queries(conn, {name: (sql, params)}) == {}, plan
+    assert any('INDEX' in step or 'PRIMARY KEY' in step for step in plan), plan
+
+
+@pytest.mark.parametrize('name, call', [
+    ('get_user_entries', lambda db: db.get_user_entries(1, 30)),
+    ('get_entry_history', lambda db: db.get_entry_history(1, 30, '2025-01-01_100', fields=['weight'])),
+    ('get_active_stage', lambda db: db.get_active_stage(1)),
+    ('get_user_products', lambda db: db.get_user_products(1)),
+    ('search_products_recent', lambda db: db.search_products(1, '')),
+])
+def test_hot_query_is_what_database_runs(db, monkeypatch, name, call):
+    executed = []
+    monkeypatch.setattr(metrics, 'observe_query', lambda sql, seconds: executed.append(sql))
+    call(db)
+    assert migrations.HOT_QUERIES[name][0] in executed
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Общий справочник продуктов (nutrition_ref): сборка из CSV и поиск по отображенному файлу"""
+
+import pytest
+
+import nutrition_ref
+import search
+
+CSV = '''name;calories_per_100g;protein;fat;carbs
+Курица грудка;110;23,1;1,2;
+Куриное филе;113;23,6;1,9;0,4
+Суп куриный с лапшой;45;;;
+Грудка индейки;84;19,2;0,7;0
+Курица;190;16;14;0
+КУРИЦА;999;;;
+Творог  5%;121;17;5;1,8
+Ёжевика;43;;;
+;100;;;
+Хлеб;много;;;
+Масло;-5;;;
+'''
+
+
+@pytest.fixture
+def reference(tmp_path):
+    source = tmp_path / 'ref.csv'
+    source.write_text(CSV, encoding='utf-8')
+    rows, skipped = nutrition_ref.read_csv(source, delimiter=';')
+    assert skipped == 3
+    path = tmp_path / 'ref.bin'
+    # 'КУРИЦА' — повтор 'Курица' после нормализации
+    assert nutrition_ref.build(rows, path) == 7
+    reference = nutrition_ref.open_reference(str(path))
+    yield reference
+    reference.close()
+
+
+def names(items):
+    return [item['product_name'] for item in items]
+
+
+def test_prefix_matches_come_before_word_matches(reference):
+    found = reference.search('кури')
+    assert names(found) == ['Куриное филе', 'Курица', 'Курица грудка', 'Суп куриный с лапшой']
+    assert [item['match_rank'] for item in found] == [1, 1, 1, 2]
+
+
+def test_exact_match_is_first_and_keeps_first_duplicate(reference):
+    found = reference.search('  КУРИЦА ')
+    assert names(found)[0] == 'Курица'
+    assert found[0]['match_rank'] == nutrition_ref.RANK_EXACT
+    assert found[0]['calories_per_100g'] == 190
+
+
+def test_word_prefix_and_macros(reference):
+    found = reference.search('груд')
+    assert names(found) == ['Грудка индейки', 'Курица грудка']
+    assert found[1]['protein'] == 23.1 and found[1]['carbs'] is None
+    assert names(reference.search('ежев')) == ['Ёжевика']
+    assert names(reference.search('творог 5')) == ['Творог 5%']
+
+
+def test_limit_and_empty_query(reference):
+    assert len(reference.search('к', limit=2)) == 2
+    assert reference.search('') == []
+    assert reference.search('ябл') == []
+
+
+def test_user_products_take_precedence(reference):
+    own = [{'id': 5, 'user_id': 1, 'product_name': 'курица', 'calories_per_100g': 200,
+            'last_used': None, 'match_rank': 0}]
+    merged = search.merge_reference(own, reference.search('курица'))
+    assert [(item['product_name'], item['source']) for item in merged] == [
+        ('курица', 'user'), ('Курица грудка', 'reference')]
+
+
+def test_missing_and_foreign_files(tmp_path):
+    assert nutrition_ref.open_reference(str(tmp_path / 'missing.bin')) is None
+    foreign = tmp_path / 'foreign.bin'
+    foreign.write_bytes(b'SQLite format 3\0' + bytes(100))
+    with pytest.raises(nutrition_ref.ReferenceFormatError):
+        nutrition_ref.open_reference(str(foreign))
+    bad_csv = tmp_path / 'bad.csv'
+    bad_csv.write_text('title,kcal\nКурица,110\n', encoding='utf-8')
+    with pytest.raises(ValueError, match='calories_per_100g, name'):
+        nutrition_ref.read_csv(bad_csv)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Разбор шрифта для PDF (pdf_writer.TrueTypeFont)"""
+
+import struct
+
+import pytest
+
+import pdf_writer
+from pdf_writer import TrueTypeFont
+
+FONT = pdf_writer.find_font()
+pytestmark = pytest.mark.skipif(FONT is None, reason='Нет системного TrueType-шрифта')
+
+
+def test_font_without_unicode_cmap_is_rejected(tmp_path):
+    data = bytearray(open(FONT, 'rb').read())
+    cmap = TrueTypeFont(FONT).tables['cmap'][0]
+    # Все подтаблицы cmap помечаются как Macintosh Roman (1, 0)
+    for i in range(struct.unpack_from('>H', data, cmap + 2)[0]):
+        struct.pack_into('>HH', data, cmap + 4 + 8 * i, 1, 0)
+    path = tmp_path / 'font.ttf'
+    path.write_bytes(bytes(data))
+
+    with pytest.raises(ValueError, match='font.ttf'):
+        TrueTypeFont(str(path))
+
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Снимок базы (replica.SnapshotReplica) и закрытие пулов соединений"""
+
+import sqlite3
+
+import pytest
+
+import replica
+from database import ConnectionPool, Database
+
+
+def test_busy_connection_is_closed_when_returned_to_closed_pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'db.sqlite3'))
+    with pool.connection() as conn:
+        pool.close_all()
+        conn.execute('SELECT 1')
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')
+
+
+def test_refresh_closes_connections_of_previous_snapshot(tmp_path):
+    db = Database(str(tmp_path / 'db.sqlite3'), replica_path=str(tmp_path / 'replica.sqlite3'))
+    try:
+        db.init_database()
+        with db.replica.connection() as old:
+            db.replica.refresh()
+            # Читатель старого снимка дочитывает его до конца
+            old.execute('SELECT COUNT(*) FROM entries').fetchone()
+        with pytest.raises(sqlite3.ProgrammingError):
+            old.execute('SELECT 1')
+        with db.replica.connection() as new:
+            assert new is not old
+            new.execute('SELECT COUNT(*) FROM entries').fetchone()
+    finally:
+        db.close()
+
+
+
+class CountingConnection(sqlite3.Connection):
+    """Соединение, которое считает шаги копирования backup()"""
+    steps = []
+
+    def backup(self, target, **kwargs):
+        kwargs['progress'] = lambda status, remaining, total: self.steps.append(remaining)
+        super().backup(target, **kwargs)
+
+
+def test_snapshot_is_copied_in_one_step(tmp_path, monkeypatch):
+    db = Database(str(tmp_path / 'db.sqlite3'), replica_path=str(tmp_path / 'replica.sqlite3'))
+    try:
+        db.init_database()
+        with db.connection() as conn:
+            # Несколько тысяч страниц: больше любой разумной порции копирования
+            conn.execute('CREATE TABLE filler (id INTEGER PRIMARY KEY, data BLOB)')
+            conn.executemany('INSERT INTO filler (data) VALUES (randomblob(4000))', [()] * 3000)
+        connect = sqlite3.connect
+        monkeypatch.setattr(replica.sqlite3, 'connect',
+                            lambda *args, **kwargs: connect(*args, factory=CountingConnection, **kwargs))
+        CountingConnection.steps.clear()
+        db.replica.refresh()
+        # Между шагами запись в основную базу начинала бы копию заново
+        assert CountingConnection.steps == [0]
+        monkeypatch.undo()
+        with db.replica.connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM filler').fetchone()[0] == 3000
+    finally:
+        db.close()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Очередь заданий на отчеты (report_jobs.ReportJobQueue): повторы и лимит на пользователя"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from report_jobs import DONE, FAILED, JobLimitError, ReportJobQueue
+
+
+class FakeGenerator:
+    """Генератор отчетов, который отвечает ошибками из списка errors, а потом строит отчет"""
+
+    def __init__(self, errors=(), release=None):
+        self.errors = list(errors)
+        self.release = release
+        self.calls = 0
+
+    def generate_report(self, user_id, report_date, report_format):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        if self.errors:
+            raise self.errors.pop(0)
+        return f'report_{user_id}_{report_date}.{report_format}'
+
+
+def wait_finished(queue, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.status(job_id)
+        if job['status'] in (DONE, FAILED):
+            return job
+        time.sleep(0.005)
+    raise AssertionError(f'Задание {job_id} не завершилось')
+
+
+@pytest.fixture
+def make_queue():
+    queues = []
+
+    def make(generator, **options):
+        queue = ReportJobQueue(generator, retry_delay=0.01, **options)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.shutdown()
+
+
+def test_transient_error_is_retried(make_queue):
+    generator = FakeGenerator([sqlite3.OperationalError('database is locked')])
+    queue = make_queue(generator)
+    job = wait_finished(queue, queue.submit(1, 'daily', {'date': '2025-01-01'})['job_id'])
+    assert job['status'] == DONE and job['attempts'] == 2
+    assert job['report_url'] == '/reports/report_1_2025-01-01.html'
+
+
+@pytest.mark.parametrize('error', [Exception('Нет записи на эту дату'), ValueError('Неизвестный формат отчета'),
+                                   LookupError('нет этапа')])
+def test_deterministic_error_fails_at_once(make_queue, error):
+    generator = FakeGenerator([error] * 3)
+    queue = make_queue(generator)
+    job = wait_finished(queue, queue.submit(1, 'daily', {'date': '2025-01-01'})['job_id'])
+    assert job['status'] == FAILED and job['attempts'] == 1 and generator.calls == 1
+    assert job['error'] == str(error)
+
+
+def test_user_limit_counts_string_and_int_ids_together(make_queue):
+    release = threading.Event()
+    queue = make_queue(FakeGenerator(release=release), per_user_limit=2)
+    try:
+        first = queue.submit(1, 'daily', {'date': '2025-01-01'})
+        queue.submit('1', 'daily', {'date': '2025-01-02'})
+        with pytest.raises(JobLimitError):
+            queue.submit(1, 'daily', {'date': '2025-01-03'})
+        assert first['user_id'] == 1
+        with pytest.raises(ValueError):
+            queue.submit('abc', 'daily', {'date': '2025-01-03'})
+    finally:
+        release.set()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Хранилище отчетов (report_store.ReportStore) и их отдача (/reports/<имя>)"""
+
+import gzip
+import os
+
+import pytest
+
+from report_store import ReportStore
+
+CONTENT = ''.join(f'<tr><td>{day}</td><td>{80 - day / 10:.1f}</td></tr>\n' for day in range(400)).encode()
+
+
+def put(store, name, content=CONTENT):
+    path = store.temp_path(name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return store.put(name, path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    report_store = ReportStore(str(tmp_path / 'reports'), compression='gzip')
+    yield report_store
+    report_store.close()
+
+
+def test_same_content_is_stored_once_and_compressed(store):
+    put(store, 'report_1_a.html')
+    put(store, 'report_2_a.html')
+    first, second = store.get('report_1_a.html'), store.get('report_2_a.html')
+
+    assert first.path == second.path and first.encoding == 'gzip'
+    assert first.stored_size < first.size == len(CONTENT)
+    assert b''.join(store.iter_content(first)) == CONTENT
+    assert gzip.decompress(b''.join(store.iter_stored(first))) == CONTENT
+
+
+def test_least_recently_used_content_is_evicted(tmp_path):
+    store = ReportStore(str(tmp_path / 'reports'), max_bytes=2500, compression='none')
+    try:
+        paths = [store._blob_path(put(store, f'report_{number}.html', bytes([number]) * 1000), 'identity')
+                 for number in range(4)]
+        # В бюджет 2500 байт помещаются два отчета: два самых старых вытеснены вместе с файлами
+        assert [store.get(f'report_{number}.html') is not None for number in range(4)] == [False, False, True, True]
+        assert [os.path.exists(path) for path in paths] == [False, False, True, True]
+        assert store.evictions == 2
+    finally:
+        store.close()
+
+
+# ---------- отдача через приложение ----------
+
+@pytest.fixture
+def served(app_module):
+    name = f'report_{os.getpid()}_{id(app_module)}.html'
+    put(app_module.report_store, name)
+    return name, app_module.report_store.get(name)
+
+
+def test_report_is_served_compressed_or_plain(client, served):
+    name, report = served
+    response = client.get(f'/reports/{name}', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200 and response.content_encoding == 'gzip'
+    assert gzip.decompress(response.get_data()) == CONTENT
+
+    response = client.get(f'/reports/{name}', headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200 and response.content_encoding is None
+    assert response.get_data() == CONTENT and response.content_length == len(CONTENT)
+
+
+def test_range_of_uncompressed_representation(client, served):
+    name, _ = served
+    response = client.get(f'/reports/{name}', headers={'Accept-Encoding': 'identity', 'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.get_data() == CONTENT[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+
+
+def test_not_modified_and_evicted_reports_do_not_open_the_file(client, app_module, served, monkeypatch):
+    name, report = served
+    etag = client.get(f'/reports/{name}', headers={'Accept-Encoding': 'identity'}).headers['ETag']
+    # Файл вытеснен после того, как get() нашел отчет в индексе
+    monkeypatch.setattr(app_module.report_store, 'get', lambda filename: report)
+    os.remove(report.path)
+
+    response = client.get(f'/reports/{name}', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert client.get(f'/reports/{name}').status_code == 404
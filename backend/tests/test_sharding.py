@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Шардирование по пользователям (sharding.ShardedDatabase): каталог, маршрутизация, диапазоны ключей, перенос"""
+
+import glob
+import os
+
+import pytest
+
+from sharding import SHARD_ID_SPAN, ShardedDatabase, UnknownUserError, shard_of_id
+
+
+def open_sharded(directory, buckets=4):
+    database = ShardedDatabase(str(directory), buckets=buckets)
+    database.init_database()
+    return database
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    database = open_sharded(tmp_path / 'shards')
+    yield database
+    database.close()
+
+
+def shard_files(database):
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(database.shard_dir, 'shard_*')))
+
+
+def fill_user(database, username, days=3):
+    user_id = database.login_user(username)['id']
+    stage_id = database.create_stage(user_id, 'cut', '2025-01-01', 80.0)
+    for day in range(1, days + 1):
+        database.save_daily_entry(user_id, stage_id, f'2025-01-{day:02d}', {'morning_weight': 80 - day}, [])
+    database.add_product(user_id, f'Творог {username}', 120)
+    return user_id, stage_id
+
+
+def test_users_get_bucket_shards_and_keys_from_their_range(sharded):
+    first, first_stage = fill_user(sharded, 'anna')
+    second, second_stage = fill_user(sharded, 'boris')
+
+    assert (sharded.user_shard(first), sharded.user_shard(second)) == (first % 4, second % 4)
+    for user_id, stage_id in ((first, first_stage), (second, second_stage)):
+        shard = sharded.user_shard(user_id)
+        assert shard * SHARD_ID_SPAN < stage_id <= (shard + 1) * SHARD_ID_SPAN
+        assert shard_of_id(stage_id) == shard
+        assert sharded.get_stage_summary(stage_id)['user_id'] == user_id
+        assert [entry['stage_id'] for entry in sharded.get_user_entries(user_id)] == [stage_id] * 3
+    assert sharded.existing_shards() == sorted(sharded.user_shard(user_id) for user_id in (first, second))
+    assert sharded.login_user('anna')['current_stage']['id'] == first_stage
+    assert sharded.get_user_by_id(second)['current_stage']['id'] == second_stage
+
+
+def test_unknown_stage_id_does_not_create_shard(sharded):
+    stage_id = 987654321098765
+    assert sharded.get_stage_summary(stage_id) is None
+    assert sharded.complete_stage(stage_id) is None
+    assert sharded.submit(sharded.complete_stage, stage_id).result() is None
+    sharded.rebuild_stage_rollups([stage_id])
+    assert shard_files(sharded) == []
+
+
+def test_unknown_user_reads_like_plain_database(sharded, db):
+    user_id = 424242
+    for name, args in [('get_active_stage', ()), ('get_user_products', ()), ('search_products', ('кур',)),
+                       ('get_entry_history', ()), ('get_entry_by_date', ('2025-01-01',)),
+                       ('get_weight_statistics', ()), ('range_version', ()), ('poll_changes', ())]:
+        assert getattr(sharded, name)(user_id, *args) == getattr(db, name)(user_id, *args), name
+    assert sharded.data_version(user_id)[0] == 0
+    assert list(sharded.iter_entries(user_id)) == []
+    assert sharded.get_user_by_id(user_id) is None
+    with pytest.raises(ValueError):
+        sharded.get_entry_history(user_id, 0)
+    with pytest.raises(UnknownUserError):
+        sharded.create_stage(user_id, 'cut', '2025-01-01', 80.0)
+    assert shard_files(sharded) == []
+
+
+def test_reads_of_new_user_do_not_create_shard(sharded):
+    user_id = sharded.login_user('anna')['id']
+    assert sharded.get_user_products(user_id) == []
+    assert sharded.get_user_by_id(user_id)['current_stage'] is None
+    assert shard_files(sharded) == []
+    sharded.add_product(user_id, 'Творог', 120)
+    assert [product['product_name'] for product in sharded.get_user_products(user_id)] == ['Творог']
+    assert sharded.existing_shards() == [sharded.user_shard(user_id)]
+
+
+def test_rebalance_moves_users_to_new_buckets(tmp_path):
+    database = open_sharded(tmp_path / 'shards', buckets=4)
+    users = [fill_user(database, name) for name in ('anna', 'boris', 'vera')]
+    database.close()
+
+    database = open_sharded(tmp_path / 'shards', buckets=2)
+    try:
+        expected = [(user_id, user_id % 4, user_id % 2) for user_id, _ in users if user_id % 4 != user_id % 2]
+        assert expected
+        assert database.rebalance(dry_run=True) == expected
+        assert database.rebalance() == expected
+        assert database.rebalance(dry_run=True) == []
+
+        for user_id, _ in users:
+            shard = database.user_shard(user_id)
+            assert shard == user_id % 2
+            stage = database.get_active_stage(user_id)
+            assert shard_of_id(stage['id']) == shard
+            entries = database.get_user_entries(user_id)
+            assert len(entries) == 3 and {entry['stage_id'] for entry in entries} == {stage['id']}
+            assert database.get_stage_summary(stage['id'])['days_logged'] == 3
+            assert len(database.get_user_products(user_id)) == 1
+            if (user_id, user_id % 4, shard) in expected:
+                # Клиент со старой версией получает полную синхронизацию
+                assert database.get_changes(user_id, since=1)['reset']
+                with database.shard(user_id % 4, create=False) as old:
+                    assert old.get_user_entries(user_id) == []
+    finally:
+        database.close()
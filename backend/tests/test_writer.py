@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Поток-писатель с групповой фиксацией (writer.GroupCommitWriter)"""
+
+import sqlite3
+import threading
+
+import pytest
+
+from database import ConnectionPool
+from writer import GroupCommitWriter
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'writer.sqlite3'), size=1, busy_timeout_ms=50)
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE items (name TEXT NOT NULL)')
+    yield pool
+    pool.close_all()
+
+
+# Операции, чьи after_commit были вызваны
+committed = []
+
+
+def insert(pool, name, fail=False):
+    with pool.connection() as conn:
+        conn.execute('INSERT INTO items (name) VALUES (?)', (name,))
+        pool.after_commit(lambda: committed.append(name))
+        if fail:
+            raise ValueError(f'ошибка в {name}')
+    return name
+
+
+def names(pool):
+    with pool.connection() as conn:
+        return sorted(row[0] for row in conn.execute('SELECT name FROM items'))
+
+
+def test_failed_operation_rolls_back_only_itself(pool):
+    committed.clear()
+    # Пачка собирается, пока не наберется max_batch операций: все три попадают в одну транзакцию
+    writer = GroupCommitWriter(pool, max_batch=3, max_delay=5.0)
+    futures = [writer.submit(insert, pool, 'a'), writer.submit(insert, pool, 'b', fail=True),
+               writer.submit(insert, pool, 'c')]
+    try:
+        assert futures[0].result(timeout=5) == 'a'
+        with pytest.raises(ValueError, match='ошибка в b'):
+            futures[1].result(timeout=5)
+        assert futures[2].result(timeout=5) == 'c'
+    finally:
+        writer.close()
+
+    assert writer.stats()['batches'] == 1
+    assert names(pool) == ['a', 'c']
+    assert committed == ['a', 'c']
+
+
+def test_failed_transaction_reaches_every_caller(pool):
+    writer = GroupCommitWriter(pool, max_batch=2, max_delay=5.0)
+    # Блокировка записи у другого соединения: BEGIN IMMEDIATE писателя не проходит
+    other = sqlite3.connect(pool.db_path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        futures = [writer.submit(insert, pool, 'a'), writer.submit(insert, pool, 'b')]
+        for future in futures:
+            with pytest.raises(sqlite3.OperationalError):
+                future.result(timeout=5)
+    finally:
+        other.rollback()
+        other.close()
+        writer.close()
+    assert names(pool) == []
+
+
+def test_close_drains_queued_operations(pool):
+    writer = GroupCommitWriter(pool, max_batch=4, max_delay=0)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+
+    first = writer.submit(blocking)
+    assert started.wait(5)
+    # Пока поток занят первой операцией, остальные ждут в очереди
+    futures = [writer.submit(insert, pool, str(i)) for i in range(10)]
+    closing = threading.Thread(target=writer.close)
+    closing.start()
+    release.set()
+    closing.join(5)
+
+    assert not closing.is_alive()
+    assert first.done() and all(future.done() for future in futures)
+    assert [future.result() for future in futures] == [str(i) for i in range(10)]
+    assert names(pool) == sorted(str(i) for i in range(10))
+    assert writer.stats()['operations'] == 11
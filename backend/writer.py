@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Единственный поток-писатель с групповой фиксацией (group commit).
+Операции записи ставятся в очередь, поток забирает их пачками и выполняет каждую пачку
+в одной транзакции: одна фиксация (и один fsync) на много запросов, без борьбы за блокировку
+записи между потоками. Каждая операция выполняется в своей точке сохранения, поэтому ошибка
+одной из них откатывает только ее. Вызывающий получает Future с результатом операции,
+который выставляется после фиксации всей пачки.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class _Operation:
+    __slots__ = ('func', 'args', 'kwargs', 'future')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class GroupCommitWriter:
+    def __init__(self, pool, max_batch=64, max_delay=0.002):
+        self.pool = pool
+        self.max_batch = max_batch
+        # Сколько первая операция пачки может ждать попутчиков; 0 — брать только то, что уже в очереди
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def _start(self):
+        # Поток запускается при первой записи: процессам-воркерам отчетов он не нужен
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит func(*args, **kwargs) в очередь записи и возвращает Future с ее результатом"""
+        if self._thread is None:
+            self._start()
+        operation = _Operation(func, args, kwargs)
+        self._queue.put(operation)
+        return operation.future
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                operation = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if operation is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(operation)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._execute(batch)
+
+    def _execute(self, batch):
+        done = []
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                for operation in batch:
+                    if not operation.future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.pool.savepoint(conn):
+                            result = operation.func(*operation.args, **operation.kwargs)
+                    except Exception as e:
+                        operation.future.set_exception(e)
+                    else:
+                        done.append((operation.future, result))
+        except Exception as e:
+            # Не удалось начать или зафиксировать транзакцию — ошибка у всех операций пачки
+            for operation in batch:
+                if not operation.future.done():
+                    operation.future.set_exception(e)
+            return
+        self.batches += 1
+        self.operations += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+    def close(self):
+        """Дописывает уже поставленные операции и останавливает поток"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'avg_batch': round(self.operations / self.batches, 2) if self.batches else 0.0,
+            'queued': self._queue.qsize(),
+        }
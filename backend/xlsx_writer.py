@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая запись XLSX без сторонних библиотек.
+Листы пишутся прямо в zip-архив строка за строкой, поэтому память не зависит от числа строк.
+Листы пишутся по очереди: следующий можно начать только после закрытия предыдущего.
+"""
+
+import math
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+_CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+{sheets}
+</Types>'''
+
+_ROOT_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+
+# Стиль 1 — жирный шрифт для заголовков
+_STYLES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>'''
+
+# Символы, запрещенные в XML 1.0
+_INVALID_XML = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+
+
+def column_name(index):
+    """0 -> A, 25 -> Z, 26 -> AA"""
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+def _cell(ref, value, style):
+    style_attr = f' s="{style}"' if style else ''
+    if value is None or value == '':
+        return f'<c r="{ref}"{style_attr}/>' if style else ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"{style_attr}><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)) and not (isinstance(value, float) and not math.isfinite(value)):
+        return f'<c r="{ref}"{style_attr}><v>{value!r}</v></c>'
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    text = escape(str(value).translate(_INVALID_XML))
+    return f'<c r="{ref}" t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class XlsxStreamWriter:
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+        self._sheets = []
+        self._stream = None
+        self._row = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def start_sheet(self, name, column_widths=None):
+        self.end_sheet()
+        self._sheets.append(name[:31])
+        self._stream = self._zip.open(f'xl/worksheets/sheet{len(self._sheets)}.xml', 'w', force_zip64=True)
+        self._row = 0
+        self._write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">')
+        if column_widths:
+            cols = ''.join(f'<col min="{i}" max="{i}" width="{w}" customWidth="1"/>'
+                           for i, w in enumerate(column_widths, start=1))
+            self._write(f'<cols>{cols}</cols>')
+        self._write('<sheetData>')
+
+    def write_row(self, values, style=0):
+        self._row += 1
+        cells = ''.join(_cell(f'{column_name(i)}{self._row}', value, style) for i, value in enumerate(values))
+        self._write(f'<row r="{self._row}">{cells}</row>')
+
+    def end_sheet(self):
+        if self._stream is not None:
+            self._write('</sheetData></worksheet>')
+            self._stream.close()
+            self._stream = None
+
+    def _write(self, text):
+        self._stream.write(text.encode('utf-8'))
+
+    def close(self):
+        self.end_sheet()
+        if not self._sheets:
+            self.start_sheet('Лист1')
+            self.end_sheet()
+        overrides = '\n'.join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, len(self._sheets) + 1))
+        sheets = ''.join(f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>'
+                         for i, name in enumerate(self._sheets, start=1))
+        rels = ''.join(f'<Relationship Id="rId{i}" '
+                       'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                       f'Target="worksheets/sheet{i}.xml"/>' for i in range(1, len(self._sheets) + 1))
+        styles_id = len(self._sheets) + 1
+        rels += (f'<Relationship Id="rId{styles_id}" '
+                 'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>')
+        self._zip.writestr('[Content_Types].xml', _CONTENT_TYPES.format(sheets=overrides))
+        self._zip.writestr('_rels/.rels', _ROOT_RELS)
+        self._zip.writestr('xl/workbook.xml',
+                           '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                           'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                           f'<sheets>{sheets}</sheets></workbook>')
+        self._zip.writestr('xl/_rels/workbook.xml.rels',
+                           '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                           f'{rels}</Relationships>')
+        self._zip.writestr('xl/styles.xml', _STYLES)
+        self._zip.close()
+
+    def _abort(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._zip.close()
@@ -1,7 +1,10 @@
 // Global data storage
 let appData = {
     meals: [],
-    programStartDate: null
+    programStartDate: null,
+    user: null,
+    stage: null,
+    products: []
 };
 
 // Initialize app
@@ -39,6 +42,73 @@ function initApp() {
 
     // Add input change listeners for all form fields
     addGlobalEventListeners();
+
+    // Load session, stage, today's entry and products in one request
+    loadInitialData(today);
+}
+
+// Load everything the page needs on startup with a single /api/batch call
+async function loadInitialData(today) {
+    const userId = localStorage.getItem('user_id');
+    if (!userId) return;
+
+    const token = localStorage.getItem('token');
+    const headers = { 'Content-Type': 'application/json' };
+    if (token) headers['Authorization'] = `Bearer ${token}`;
+
+    try {
+        const res = await fetch('/api/batch', {
+            method: 'POST',
+            headers: headers,
+            body: JSON.stringify({ requests: [
+                { id: 'auth', method: 'POST', path: '/api/auth/check', body: { user_id: Number(userId) } },
+                { id: 'stage', method: 'GET', path: `/api/stage/current/${userId}` },
+                { id: 'entry', method: 'GET', path: `/api/entry/get?user_id=${userId}&date=${today}` },
+                { id: 'products', method: 'GET', path: `/api/products/list/${userId}` }
+            ] })
+        });
+        const data = await res.json();
+        if (!data.success) return;
+
+        const results = {};
+        data.responses.forEach(response => { results[response.id] = response; });
+
+        if (results.auth.status === 401) {
+            window.location.href = '/login';
+            return;
+        }
+        if (results.auth.body && results.auth.body.success) {
+            appData.user = { id: results.auth.body.user_id, username: results.auth.body.username };
+        }
+        if (results.products.body && results.products.body.success) {
+            appData.products = results.products.body.products;
+        }
+
+        const stage = results.stage.body && results.stage.body.stage;
+        if (stage) {
+            appData.stage = stage;
+            document.getElementById('dataNachala').value = stage.start_date;
+            appData.programStartDate = new Date(stage.start_date);
+            calculateDayOfProgram();
+        }
+
+        const entry = results.entry.body && results.entry.body.entry;
+        const meals = entry && entry.meals ? JSON.parse(entry.meals) : [];
+        if (meals.length) {
+            appData.meals = meals.map((meal, index) => ({
+                id: index,
+                dishes: (meal.dishes || []).map(dish => ({
+                    name: dish.name || '',
+                    mass: dish.mass || 0,
+                    calories: dish.calories || 0
+                }))
+            }));
+            renderMeals();
+            calculateDailyTotal();
+        }
+    } catch (error) {
+        console.error('Failed to load initial data:', error);
+    }
 }
 
 // Add global event listeners